@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+"""Benchmarks for diskmapper: parse throughput, report building and end-to-end runs.
+
+    python3 benchmarks/bench.py --disks 2000
+    python3 benchmarks/bench.py --save baseline.json
+    python3 benchmarks/bench.py --compare baseline.json
+
+--compare exits with status 1 when a time or peak memory grew by more than
+--tolerance over a baseline saved with the same options, so it can gate a
+change before it reaches a big chassis.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+import diskmapper
+from generate import CORPUS_DIR, generate, write_fixture
+
+def best_of(function, repeat=5, number=1):
+    """Best wall time of `repeat` rounds of `number` calls, per call"""
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for _ in range(number):
+            function()
+        elapsed = (time.perf_counter() - started) / number
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def bench_parse(iterations):
+    """Parse every corpus file and report per-call time and throughput"""
+    results = {}
+    for name in sorted(os.listdir(CORPUS_DIR)):
+        with open(os.path.join(CORPUS_DIR, name)) as f:
+            output = f.read()
+        seconds = best_of(lambda: diskmapper.parse_smart_data(output), number=iterations)
+        results[f"parse/{name}"] = seconds
+        print(f"  {name:<32} {seconds * 1e6:9.1f} us  {1 / seconds:10.0f} parses/s  "
+              f"{len(output) / seconds / 1e6:7.1f} MB/s")
+    return results
+
+def synthetic_smart_results(device_samples, backend):
+    """SMART results for every generated disk, parsed once per corpus sample"""
+    parsed = {}
+    extension = "json" if backend == "json" else "txt"
+    for sample in set(device_samples.values()):
+        with open(os.path.join(CORPUS_DIR, f"{sample}.{extension}")) as f:
+            output = f.read()
+        parsed[sample] = {"output": output, "data": diskmapper.parse_smart_data(output),
+                          "captured": time.time(), "cached": False}
+    return {device: parsed[sample] for device, sample in device_samples.items()}
+
+def bench_report(disks, pools, width, backend):
+    """Build, print and serialize the report for a synthetic topology, without smartctl"""
+    pool_query, disk_query, device_samples = generate(disks, pools, width, backend=backend)
+    smart_results = synthetic_smart_results(device_samples, backend)
+    index = diskmapper.build_disk_index(disk_query)
+
+    def build():
+        return diskmapper.build_pool_entries(pool_query, *index, smart_results)
+
+    pool_entries = build()
+
+    def render():
+        with contextlib.redirect_stdout(io.StringIO()):
+            for pool_entry in pool_entries:
+                diskmapper.print_pool(pool_entry)
+
+    timings = {
+        "build": best_of(build),
+        "print": best_of(render),
+        "json": best_of(lambda: json.dumps({"pools": pool_entries}, indent=4)),
+    }
+    tracemalloc.start()
+    build()
+    peak_bytes = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    print(f"  {len(device_samples)} disks in {pools} pools")
+    for step, seconds in timings.items():
+        print(f"  {step:<32} {seconds * 1e3:9.1f} ms  {seconds / len(device_samples) * 1e6:8.1f} us/disk")
+    print(f"  {'build peak memory':<32} {peak_bytes / 2**20:9.1f} MiB")
+    results = {f"report/{backend}/{step}": seconds for step, seconds in timings.items()}
+    results[f"report/{backend}/build_peak_bytes"] = peak_bytes
+    return results
+
+def bench_end_to_end(disks, pools, width, backend, workers, delay):
+    """Run diskmapper.py against the stand-in midclt and smartctl"""
+    with tempfile.TemporaryDirectory() as fixture:
+        count = write_fixture(fixture, disks, pools, width, backend=backend)
+        env = dict(os.environ,
+                   PATH=os.path.join(BENCH_DIR, "bin") + os.pathsep + os.environ.get("PATH", ""),
+                   DISKMAPPER_BENCH_DIR=fixture,
+                   DISKMAPPER_BENCH_SMARTCTL_DELAY=str(delay))
+        command = [sys.executable, os.path.join(REPO_DIR, "diskmapper.py"), "--middleware", "midclt",
+                   "--no-cache", "--smart-backend", backend, "--workers", str(workers),
+                   "--json", os.path.join(fixture, "report.json")]
+        started = time.perf_counter()
+        process = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL)
+        _, status, usage = os.wait4(process.pid, 0)
+        elapsed = time.perf_counter() - started
+        process.returncode = os.waitstatus_to_exitcode(status)
+        if process.returncode:
+            raise RuntimeError(f"diskmapper.py exited with status {process.returncode}")
+
+    # ru_maxrss is in KiB on Linux
+    results = {f"e2e/{backend}": elapsed, f"e2e/{backend}_peak_rss_bytes": usage.ru_maxrss * 1024}
+    print(f"  {count} disks, {backend} backend, {workers} workers: {elapsed:.2f} s, "
+          f"peak RSS {usage.ru_maxrss / 1024:.1f} MiB")
+    return results
+
+def compare(results, baseline, tolerance):
+    """Print results that regressed against a baseline; return True if any did"""
+    regressed = False
+    for key, value in sorted(results.items()):
+        if not baseline.get(key):
+            continue
+        ratio = value / baseline[key]
+        unit = "memory" if key.endswith("_bytes") else "time"
+        if ratio > 1 + tolerance:
+            regressed = True
+            print(f"  \033[1;31m{key}: {ratio:.2f}x the {unit} ({baseline[key]:g} -> {value:g})\033[0m")
+        elif ratio < 1 - tolerance:
+            print(f"  \033[1;32m{key}: {ratio:.2f}x the {unit} ({baseline[key]:g} -> {value:g})\033[0m")
+    return regressed
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark SMART parsing, report building and full runs')
+    parser.add_argument('--disks', type=int, default=2000, help='Synthetic disks for the report benchmark (default: 2000)')
+    parser.add_argument('--pools', type=int, default=2, help='Synthetic pools (default: 2)')
+    parser.add_argument('--width', type=int, default=12, help='Disks per raidz2 vdev (default: 12)')
+    parser.add_argument('--parse-iterations', type=int, default=200,
+                        help='Parses per timing round for every corpus file (default: 200)')
+    parser.add_argument('--e2e-disks', type=int, default=500,
+                        help='Synthetic disks for the end-to-end run, 0 to skip it (default: 500)')
+    parser.add_argument('--smart-backend', choices=['text', 'json', 'both'], default='both',
+                        help='smartctl output used by the report and end-to-end benchmarks (default: both)')
+    parser.add_argument('--workers', type=int, default=8, help='--workers for the end-to-end run (default: 8)')
+    parser.add_argument('--smartctl-delay', type=float, default=0,
+                        help='Seconds every stand-in smartctl call takes (default: 0)')
+    parser.add_argument('--save', type=str, metavar='FILE', help='Save the results as a baseline')
+    parser.add_argument('--compare', type=str, metavar='FILE', help='Compare against a saved baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='Growth allowed by --compare, as a fraction (default: 0.25)')
+    args = parser.parse_args()
+
+    backends = ['text', 'json'] if args.smart_backend == 'both' else [args.smart_backend]
+    results = {}
+    # The end-to-end runs go first: a forked child inherits the peak RSS of this
+    # process, which grows with the in-process benchmarks
+    if args.e2e_disks:
+        print("\033[1;36mEnd to end\033[0m")
+        for backend in backends:
+            results.update(bench_end_to_end(args.e2e_disks, args.pools, args.width, backend,
+                                            args.workers, args.smartctl_delay))
+    print("\033[1;36mParse throughput\033[0m")
+    results.update(bench_parse(args.parse_iterations))
+    for backend in backends:
+        print(f"\033[1;36mReport ({backend})\033[0m")
+        results.update(bench_report(args.disks, args.pools, args.width, backend))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=4, sort_keys=True)
+        print(f"\n\033[1;32mResults saved to {args.save}\033[0m")
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print(f"\n\033[1;36mCompared to {args.compare}\033[0m")
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
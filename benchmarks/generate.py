@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""Generate synthetic pool.query/disk.query payloads for benchmarking.
+
+The output directory can be used directly with --middleware-fixture, or with
+the stand-in midclt and smartctl in benchmarks/bin (see bench.py).
+"""
+import argparse
+import json
+import os
+import random
+
+CORPUS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "corpus")
+
+# How often each corpus sample is handed out, roughly what a large chassis looks like
+SAMPLE_WEIGHTS = {
+    "sas_hgst_ultrastar": 40,
+    "sas_seagate_exos": 15,
+    "sata_wdc_ultrastar": 20,
+    "sata_seagate_ironwolf": 15,
+    "sata_failing": 2,
+    "nvme_samsung": 5,
+    "nvme_no_selftest": 2,
+    "usb_bridge": 1,
+}
+
+def corpus_samples(backend="text"):
+    """Return the corpus sample names available for a smartctl backend"""
+    extension = ".json" if backend == "json" else ".txt"
+    return sorted(name[:-len(extension)] for name in os.listdir(CORPUS_DIR) if name.endswith(extension))
+
+def device_name(index):
+    """sda, sdb, ... sdz, sdaa, ... like the kernel names them"""
+    letters = ""
+    index += 1
+    while index:
+        index, remainder = divmod(index - 1, 26)
+        letters = chr(ord('a') + remainder) + letters
+    return f"sd{letters}"
+
+class TopologyGenerator:
+    """Builds pools out of raidz vdevs, with the nested and auxiliary vdevs of a real system"""
+
+    def __init__(self, seed=0, backend="text", samples=None):
+        self.random = random.Random(seed)
+        available = set(corpus_samples(backend))
+        self.samples = {name: weight for name, weight in (samples or SAMPLE_WEIGHTS).items()
+                        if name in available}
+        self.disk_query = []
+        self.device_samples = {}
+        self.sd_count = 0
+        self.nvme_count = 0
+
+    def _sample(self, nvme):
+        names = [name for name in self.samples if name.startswith("nvme") == nvme] or list(self.samples)
+        return self.random.choices(names, [self.samples[name] for name in names])[0]
+
+    def disk(self, nvme=False, errors=0.002, known=0.998):
+        """Return a topology DISK entry and register it in disk.query"""
+        if nvme:
+            device = f"nvme{self.nvme_count}n1"
+            partition = f"{device}p1"
+            self.nvme_count += 1
+        else:
+            device = device_name(self.sd_count)
+            partition = f"{device}1"
+            self.sd_count += 1
+        guid = str(self.random.getrandbits(63))
+        partuuid = "%08x-%04x-%04x-%04x-%012x" % tuple(self.random.getrandbits(bits) for bits in (32, 16, 16, 16, 48))
+        has_errors = self.random.random() < errors
+        sample = self._sample(nvme)
+        self.device_samples[device] = sample
+
+        # A few disks are missing from disk.query, like a disk that was just pulled
+        if self.random.random() < known:
+            index = self.sd_count + self.nvme_count
+            self.disk_query.append({
+                "name": device,
+                "devname": device,
+                "serial": f"BENCH{index:07d}",
+                "model": sample.upper(),
+                "size": 1000204886016 if nvme else 8001563222016,
+                "zfs_guid": guid,
+                "lunid": None if nvme else f"5000cca0{index:08x}",
+                "enclosure": None if nvme else {"number": index // 60, "slot": index % 60},
+                "type": "SSD" if nvme else "HDD"
+            })
+        return {
+            "type": "DISK",
+            "name": partuuid,
+            "guid": guid,
+            "device": partition,
+            "disk": device,
+            "path": f"/dev/disk/by-partuuid/{partuuid}",
+            "status": "ONLINE",
+            "children": [],
+            "stats": {
+                "read_errors": self.random.randint(1, 5) if has_errors else 0,
+                "write_errors": 0,
+                "checksum_errors": self.random.randint(1, 50) if has_errors else 0
+            }
+        }
+
+    def vdev(self, vdev_type, name, children):
+        return {"type": vdev_type, "name": name, "guid": str(self.random.getrandbits(63)),
+                "status": "ONLINE", "children": children}
+
+    def raidz(self, index, width):
+        children = [self.disk() for _ in range(width)]
+        # Every 8th vdev has a hot spare or a replacement in progress nested inside it
+        if index % 8 == 7:
+            nested = "SPARE" if index % 16 == 7 else "REPLACING"
+            slot = index % width
+            children[slot] = self.vdev(nested, f"{nested.lower()}-{slot}", [children[slot], self.disk()])
+        return self.vdev("RAIDZ2", f"raidz2-{index}", children)
+
+    def pool(self, name, disks, width=12):
+        """A pool with about `disks` data disks plus log, cache, special and spares"""
+        data = [self.raidz(index, width) for index in range(max(1, disks // width))]
+        index = len(data)
+        return {
+            "name": name,
+            "status": "ONLINE",
+            "scan": None,
+            "topology": {
+                "data": data,
+                "log": [self.vdev("MIRROR", f"mirror-{index}", [self.disk(nvme=True), self.disk(nvme=True)])],
+                "cache": [self.disk(nvme=True)],
+                "spare": [self.disk() for _ in range(2)],
+                "special": [self.vdev("MIRROR", f"mirror-{index + 1}",
+                                      [self.disk(nvme=True) for _ in range(3)])],
+                "dedup": []
+            }
+        }
+
+def generate(disks=2000, pools=2, width=12, seed=0, backend="text"):
+    """Return (pool.query, disk.query, {device: corpus sample}) for about `disks` disks"""
+    generator = TopologyGenerator(seed, backend)
+    pool_query = [generator.pool(f"tank{index}", disks // pools, width) for index in range(pools)]
+    # disk.query is not in topology order on a real system either
+    generator.random.shuffle(generator.disk_query)
+    return pool_query, generator.disk_query, generator.device_samples
+
+def write_fixture(path, disks=2000, pools=2, width=12, seed=0, backend="text"):
+    """Write pool.query.json, disk.query.json and smartctl.json into a directory"""
+    pool_query, disk_query, device_samples = generate(disks, pools, width, seed, backend)
+    os.makedirs(path, exist_ok=True)
+    for name, payload in (("pool.query", pool_query), ("disk.query", disk_query), ("smartctl", device_samples)):
+        with open(os.path.join(path, f"{name}.json"), 'w') as f:
+            json.dump(payload, f)
+    return len(device_samples)
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a synthetic middleware fixture for benchmarks')
+    parser.add_argument('output', help='Directory to write pool.query.json, disk.query.json and smartctl.json to')
+    parser.add_argument('--disks', type=int, default=2000, help='Approximate number of data disks (default: 2000)')
+    parser.add_argument('--pools', type=int, default=2, help='Number of pools (default: 2)')
+    parser.add_argument('--width', type=int, default=12, help='Disks per raidz2 vdev (default: 12)')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed (default: 0)')
+    parser.add_argument('--smart-backend', choices=['text', 'json'], default='text',
+                        help='Only use corpus samples available for this backend (default: text)')
+    args = parser.parse_args()
+    count = write_fixture(args.output, args.disks, args.pools, args.width, args.seed, args.smart_backend)
+    print(f"Wrote {count} disks to {args.output}")
+
+if __name__ == "__main__":
+    main()
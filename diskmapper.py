@@ -1,18 +1,42 @@
 #!/usr/bin/env python3
+"""Map ZFS pools to their disks, read SMART data and flag failing disks on TrueNAS.
+
+Run it as a script, or import it: scan() returns the report of every pool
+disk, and collect_topology(), collect_smart() and analyze() are its steps.
+Importing does no work; modules only some modes need are imported on use.
+"""
 import subprocess
 import json
 import math
 import re
 import argparse
 import os
-from collections import defaultdict
+import sys
+import signal
+import stat
+import threading
+import time
+import zlib
+import base64
+import bisect
+import fcntl
+import shlex
+import operator
+import fnmatch
+import string
+import contextlib
+import queue
+import itertools
+import warnings
 from datetime import datetime
 
-# Initialize JSON output structure
-json_output = {
-    "pools": [],
-    "timestamp": datetime.now().isoformat()
-}
+__all__ = [
+    'scan', 'collect_topology', 'collect_smart', 'analyze', 'evaluate_warnings', 'main',
+    'connect_middleware', 'MiddlewareClient', 'MidcltClient', 'StaticMiddlewareClient', 'MiddlewareError',
+    'LocalTransport', 'SshTransport', 'SmartCollector', 'SmartCache', 'SmartHistory', 'DiskSelection',
+    'RuleSet', 'PeerAnalysis', 'LatencySampler', 'DiskWatcher', 'HistoryError', 'BundleError',
+    'get_smart_result', 'parse_smart_data', 'build_pool_entries', 'iter_report_disks', 'new_report',
+]
 
 def convert_size(size_bytes):
     """Convert bytes to human-readable format"""
@@ -24,160 +48,1248 @@ def convert_size(size_bytes):
     s = round(size_bytes / p, 2)
     return f"{s} {size_name[i]}"
 
-def get_smart_data(device):
-    """Retrieve SMART data for a device using smartctl"""
+class Span:
+    """One timed piece of work; records itself into its Tracer when it ends"""
+    __slots__ = ('tracer', 'phase', 'name', 'args', 'started')
+
+    def __init__(self, tracer, phase, name, args):
+        self.tracer = tracer
+        self.phase = phase
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.tracer.record(self.phase, self.name, self.started, time.perf_counter() - self.started, self.args)
+
+class Tracer:
+    """Times the phases of a run (middleware queries, every smartctl call,
+    parsing, rules, rendering...) for --timings and --trace.
+
+    Disabled by default: span() then hands back a shared no-op context, so the
+    instrumented code costs next to nothing. Spans are kept with the thread
+    that ran them and can be summed per phase or written as a Chrome trace.
+    """
+
+    def __init__(self, max_spans=1000000):
+        self.enabled = False
+        self.max_spans = max_spans
+        self.spans = []
+        self.dropped = 0
+        self.threads = {}
+        self.origin = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def enable(self):
+        """Start recording, forgetting earlier spans"""
+        with self._lock:
+            self.spans = []
+            self.dropped = 0
+            self.threads = {}
+            self.origin = time.perf_counter()
+            self.enabled = True
+
+    def span(self, phase, name=None, **args):
+        """Context manager timing one piece of work of a phase"""
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, phase, name, args)
+
+    def record(self, phase, name, started, duration, args=None):
+        thread = threading.current_thread()
+        with self._lock:
+            # Watch mode would grow the spans forever
+            if len(self.spans) >= self.max_spans:
+                self.dropped += 1
+                return
+            self.threads.setdefault(thread.ident, thread.name)
+            self.spans.append((phase, name, started - self.origin, duration, thread.ident, args))
+
+    def summary(self):
+        """{phase: {"calls", "total", "max", "slowest"}} in the order phases first ran"""
+        phases = {}
+        for phase, name, started, duration, thread, args in self.spans:
+            stats = phases.setdefault(phase, {"calls": 0, "total": 0.0, "max": 0.0, "slowest": None})
+            stats["calls"] += 1
+            stats["total"] += duration
+            if duration >= stats["max"]:
+                stats["max"] = duration
+                stats["slowest"] = name
+        return phases
+
+    def by_label(self, phase, label):
+        """Like summary(), for the spans of one phase grouped by one of their args"""
+        groups = {}
+        for span_phase, name, started, duration, thread, args in self.spans:
+            if span_phase != phase or not args or args.get(label) is None:
+                continue
+            stats = groups.setdefault(args[label], {"calls": 0, "total": 0.0, "max": 0.0, "slowest": None})
+            stats["calls"] += 1
+            stats["total"] += duration
+            if duration >= stats["max"]:
+                stats["max"] = duration
+                stats["slowest"] = name
+        return groups
+
+    def chrome_trace(self):
+        """The spans as Chrome trace events, for chrome://tracing or Perfetto"""
+        pid = os.getpid()
+        events = [{"name": "thread_name", "ph": "M", "pid": pid, "tid": thread, "args": {"name": name}}
+                  for thread, name in self.threads.items()]
+        for phase, name, started, duration, thread, args in self.spans:
+            event = {"name": phase if name is None else f"{phase} {name}", "cat": phase, "ph": "X",
+                     "ts": round(started * 1e6, 1), "dur": round(duration * 1e6, 1), "pid": pid, "tid": thread}
+            if args:
+                event["args"] = {key: value for key, value in args.items() if value is not None}
+            events.append(event)
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def write_trace(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.chrome_trace(), f)
+
+NULL_SPAN = contextlib.nullcontext()
+
+# Every instrumented phase records into this one, see --timings and --trace
+TRACER = Tracer()
+
+def format_timings(tracer, elapsed=None):
+    """Return the lines of the --timings summary table"""
+    def table(title, heading, groups):
+        lines = [f"\033[1;36m{title}\033[0m",
+                 f"  {heading:<16} {'Calls':>7} {'Total s':>9} {'Mean ms':>9} {'Max ms':>9}  Slowest"]
+        for key, stats in sorted(groups.items(), key=lambda item: -item[1]["total"]):
+            lines.append(f"  {str(key):<16} {stats['calls']:>7} {stats['total']:>9.3f} "
+                         f"{stats['total'] / stats['calls'] * 1e3:>9.1f} {stats['max'] * 1e3:>9.1f}  "
+                         f"{stats['slowest'] if stats['slowest'] is not None else ''}")
+        return lines
+
+    title = "Phase timings" if elapsed is None else f"Phase timings ({elapsed:.2f} s wall clock)"
+    lines = table(title, "Phase", tracer.summary())
+    # smartctl runs in parallel, so the busiest controller says more than the phase total
+    controllers = tracer.by_label("smartctl", "controller")
+    # A disk without a sysfs controller is its own controller, which says nothing new
+    devices = {name for phase, name, *_ in tracer.spans if phase == "smartctl"}
+    if controllers and len(controllers) < len(devices):
+        lines += table("smartctl by controller", "Controller", controllers)
+    hosts = tracer.by_label("smartctl", "host")
+    if len(hosts) > 1:
+        lines += table("smartctl by host", "Host", hosts)
+    if tracer.dropped:
+        lines.append(f"\033[1;33m{tracer.dropped} spans over the limit of {tracer.max_spans} were not recorded\033[0m")
+    return lines
+
+# Bits of the smartctl exit status meaning the device could not be read at all
+SMARTCTL_FATAL_STATUS = 0x03
+# The one of them that may pass: the device could not be opened (a reset, a
+# busy controller). The other, a command line smartctl refused, never will.
+SMARTCTL_OPEN_FAILED = 0x02
+
+# Seconds a killed command gets to exit; one stuck in the kernel is left behind
+KILL_GRACE = 5
+
+class LocalTransport:
+    """Runs the smartctl and midclt commands on this machine.
+
+    timeout caps every command, deadline (a time.monotonic() value) caps all
+    of them together; a command that runs into either is killed, together
+    with everything it started (sudo, smartctl, ssh).
+    """
+    local = True
+
+    def __init__(self, name="localhost", timeout=None, deadline=None):
+        self.name = name
+        self.timeout = timeout
+        self.deadline = deadline
+        # Cleared once smartctl is found not to understand -j, so "auto" stops retrying it
+        self.smartctl_json_supported = True
+
+    def command(self, argv):
+        return argv
+
+    def run(self, argv, timeout=None):
+        """Run argv and return the CompletedProcess with text output, without checking it"""
+        timeout = timeout or self.timeout
+        if self.deadline is not None:
+            remaining = self.deadline - time.monotonic()
+            if remaining <= 0:
+                raise subprocess.TimeoutExpired(argv, 0)
+            timeout = min(timeout, remaining) if timeout else remaining
+        # A session of its own, so a timeout can kill sudo and smartctl as one group
+        process = subprocess.Popen(self.command(argv), stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                   text=True, start_new_session=True)
+        try:
+            stdout, stderr = process.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            self.kill(process)
+            raise subprocess.TimeoutExpired(argv, timeout) from None
+        return subprocess.CompletedProcess(process.args, process.returncode, stdout, stderr)
+
+    @staticmethod
+    def kill(process):
+        """Kill a command's process group; don't wait forever for one stuck in the kernel"""
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            process.kill()
+        try:
+            process.communicate(timeout=KILL_GRACE)
+        except subprocess.TimeoutExpired:
+            # Still in uninterruptible sleep (a disk in error recovery); leave it
+            for pipe in (process.stdout, process.stderr):
+                pipe.close()
+
+class SshTransport(LocalTransport):
+    """Runs the commands on another host through non-interactive ssh"""
+    local = False
+
+    def __init__(self, host, port=None, options=(), timeout=None, deadline=None, connect_timeout=10):
+        user, at, address = host.rpartition('@')
+        # An IPv6 address is bracketed when a port follows, as in the inventory
+        if port and ':' in address:
+            address = f"[{address}]"
+        super().__init__(host if not port else f"{user}{at}{address}:{port}", timeout, deadline)
+        self.host = host
+        self.port = port
+        self.options = list(options)
+        self.connect_timeout = connect_timeout
+
+    def command(self, argv):
+        ssh = ["ssh", "-o", "BatchMode=yes", "-o", f"ConnectTimeout={self.connect_timeout}"]
+        if self.port:
+            ssh += ["-p", str(self.port)]
+        return ssh + self.options + [self.host, "--", shlex.join(argv)]
+
+LOCAL_TRANSPORT = LocalTransport()
+
+# How a smartctl that predates JSON output (before 7.0) refuses -j
+SMARTCTL_NO_JSON = re.compile(r"UNRECOGNIZED OPTION|invalid option", re.IGNORECASE)
+
+# smartctl -n standby leaves a disk that is spun down alone and says so
+STANDBY_MESSAGE = re.compile(r"Device is in (\w+) mode")
+
+def smartctl_options(device, wake=True):
+    """smartctl options for reading a device; without wake, disks in standby are not spun up"""
+    # NVMe drives have no spindle to spin up
+    if wake or device.startswith("nvme"):
+        return ["-a"]
+    return ["-n", "standby", "-a"]
+
+def smartctl_span(device, transport):
+    """Trace span for one smartctl call, labelled with the host and controller"""
+    if not TRACER.enabled:
+        return NULL_SPAN
+    return TRACER.span("smartctl", device, host=transport.name,
+                       controller=get_disk_controller(device) if transport.local else None)
+
+def timeout_message(error):
+    """What a smartctl call that ran into its timeout (or the run's deadline) returns"""
+    if not error.timeout:
+        return "Timeout: the run's deadline passed before smartctl could run"
+    return f"Timeout: smartctl did not finish within {error.timeout:.0f}s and was killed"
+
+def smartctl_failure(status, message):
+    """What a smartctl call whose exit status has fatal bits returns: "Failed: ..."
+    if only the device could not be opened, which is worth retrying, else "Error: ..."."""
+    if status & SMARTCTL_FATAL_STATUS == SMARTCTL_OPEN_FAILED:
+        return f"Failed: {message}"
+    return f"Error: {message}"
+
+def get_smart_data(device, backend="auto", transport=None, wake=True, timeout=None):
+    """Retrieve SMART data for a device using smartctl.
+
+    The "json" backend asks smartctl for structured output (-j) and "text" for
+    the classic report; "auto" uses JSON and falls back to text on older
+    smartmontools releases, or for one call whose JSON could not be read. Without wake a disk in standby is left alone and
+    "Standby: <power mode>" is returned instead; a call that runs past timeout
+    (or the transport's limits) is killed and "Timeout: ..." returned. When the
+    device could not be opened, which may pass, "Failed: ..." is returned;
+    other errors, such as sudo or smartctl missing, are "Error: ...".
+    """
+    transport = transport or LOCAL_TRANSPORT
+    if backend == "json" or (backend == "auto" and transport.smartctl_json_supported):
+        smart_output = get_smart_json(device, transport, wake, timeout)
+        if smart_output is not None:
+            return smart_output
+        if backend == "json":
+            if not transport.smartctl_json_supported:
+                return "Error: smartctl does not support JSON output (-j)"
+            return "Error: smartctl did not print valid JSON"
     try:
-        result = subprocess.run(
-            ["sudo", "smartctl", "-a", f"/dev/{device}"],
-            capture_output=True,
-            text=True,
-            check=True
-        )
+        with smartctl_span(device, transport):
+            result = transport.run(["sudo", "smartctl", *smartctl_options(device, wake), f"/dev/{device}"], timeout)
+        standby = STANDBY_MESSAGE.search(result.stdout) if not wake else None
+        if standby:
+            return f"Standby: {standby.group(1)}"
+        # As with JSON, the informational exit bits still come with a full report
+        if result.returncode & SMARTCTL_FATAL_STATUS:
+            lines = (result.stderr.strip() or result.stdout.strip()).splitlines()
+            return smartctl_failure(result.returncode,
+                                    lines[-1] if lines else f"smartctl exit status {result.returncode}")
         return result.stdout
-    except subprocess.CalledProcessError as e:
-        return f"Error: {e.stderr.strip()}"
+    except subprocess.TimeoutExpired as e:
+        return timeout_message(e)
     except Exception as e:
         return f"Error: {str(e)}"
 
+def get_smart_json(device, transport=None, wake=True, timeout=None):
+    """Retrieve SMART data as smartctl JSON, or None if there is no JSON to read.
+
+    Only when smartctl rejects -j is the transport marked as not supporting
+    JSON, so "auto" sticks to text; any other output that is not JSON (a
+    truncated document, a wrapper's message) only falls back for this call.
+    """
+    transport = transport or LOCAL_TRANSPORT
+    try:
+        with smartctl_span(device, transport):
+            result = transport.run(["sudo", "smartctl", *smartctl_options(device, wake), "-j", f"/dev/{device}"],
+                                   timeout)
+    except subprocess.TimeoutExpired as e:
+        return timeout_message(e)
+    except Exception as e:
+        return f"Error: {str(e)}"
+    try:
+        document = json.loads(result.stdout)
+    except json.JSONDecodeError:
+        if SMARTCTL_NO_JSON.search(result.stdout) or SMARTCTL_NO_JSON.search(result.stderr):
+            transport.smartctl_json_supported = False
+        return None
+    # smartctl sets informational exit bits (failing attributes, error log
+    # entries...) even when the data was read fine, so only the low bits count
+    smartctl_info = document.get('smartctl', {})
+    exit_status = smartctl_info.get('exit_status', result.returncode)
+    messages = [m.get('string', '') for m in smartctl_info.get('messages', [])]
+    standby = STANDBY_MESSAGE.search("\n".join(messages)) if not wake else None
+    if standby:
+        return f"Standby: {standby.group(1)}"
+    if exit_status & SMARTCTL_FATAL_STATUS:
+        return smartctl_failure(exit_status, '; '.join(m for m in messages if m) or result.stderr.strip())
+    return result.stdout
+
+def get_disk_controller(device):
+    """Return the controller (SCSI host or NVMe controller) a disk is attached to"""
+    try:
+        sys_path = os.path.realpath(f"/sys/block/{device}")
+    except OSError:
+        return device
+    match = re.search(r"/(host\d+|nvme\d+)/", sys_path)
+    # Without a sysfs path the disk gets its own slot rather than sharing one
+    return match.group(1) if match else device
+
+def get_disk_enclosure(disk_info):
+    """Return an identifier for the enclosure a disk sits in, if middleware knows it"""
+    enclosure = disk_info.get('enclosure') if disk_info else None
+    if not enclosure:
+        return None
+    if isinstance(enclosure, dict):
+        return enclosure.get('id', enclosure.get('number'))
+    return enclosure
+
+class SmartCollector:
+    """Run smartctl for many disks through a bounded worker pool.
+
+    Besides the overall worker count, concurrency can be capped per controller
+    and per enclosure so a large JBOD does not saturate a single HBA.
+    """
+
+    def __init__(self, workers=8, per_controller=4, per_enclosure=0, backend="auto",
+                 cache=None, refresh=False, transport=None, wake=True, timeout=None, retries=0, backoff=1):
+        self.workers = max(1, workers)
+        self.wake = wake
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.transport = transport or LOCAL_TRANSPORT
+        self.backend = backend
+        self.cache = cache
+        self.refresh = refresh
+        self.per_controller = per_controller
+        self.per_enclosure = per_enclosure
+        self._limits = {}
+        self._lock = threading.Lock()
+
+    def _limit(self, key, size):
+        with self._lock:
+            if key not in self._limits:
+                self._limits[key] = threading.BoundedSemaphore(size)
+            return self._limits[key]
+
+    def _slots(self, device, disk_info):
+        # Always acquired in the same order (controller, then enclosure)
+        slots = []
+        # The controller is looked up in the local sysfs
+        if self.per_controller > 0 and self.transport.local:
+            controller = get_disk_controller(device)
+            slots.append(self._limit(("controller", controller), self.per_controller))
+        enclosure = get_disk_enclosure(disk_info)
+        if self.per_enclosure > 0 and enclosure is not None:
+            slots.append(self._limit(("enclosure", enclosure), self.per_enclosure))
+        return slots
+
+    def fetch(self, device, disk_info=None, retry=False):
+        """Get the SMART result for a single device, running smartctl once its
+        controller/enclosure has room unless the cache already has a fresh result"""
+        if self.cache is not None and not self.refresh and not retry:
+            cached = self.cache.get(get_cache_key(disk_info))
+            if cached is not None:
+                return cached
+        slots = self._slots(device, disk_info)
+        with TRACER.span("queue", device):
+            for slot in slots:
+                slot.acquire()
+        try:
+            return get_smart_result(device, disk_info, self.backend, self.cache, refresh=True,
+                                    transport=self.transport, wake=self.wake, timeout=self.timeout)
+        finally:
+            for slot in reversed(slots):
+                slot.release()
+
+    def retry_delay(self, result, attempt):
+        """Seconds to wait before reading a disk again after attempt, or None to keep
+        the result. Only failures that may pass are retried, with exponential backoff;
+        a timeout is not: a disk stuck in error recovery would only hold the run longer."""
+        if not result.get("transient") or attempt >= self.retries:
+            return None
+        delay = self.backoff * 2 ** attempt
+        deadline = self.transport.deadline
+        if deadline is not None and time.monotonic() + delay >= deadline:
+            return None
+        return delay
+
+    def collect(self, disks, on_result=None):
+        """Fetch SMART results for (device, disk_info) pairs, returning {device: result}.
+
+        on_result(device, result) is called in the calling thread as each disk completes.
+        A retry waits out its backoff here, not in a worker holding the disk's
+        controller and enclosure slots, so other disks are read in the meantime.
+        """
+        import heapq
+        from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+        results = {}
+        if not disks:
+            return results
+        retries = []
+        order = itertools.count()
+        with ThreadPoolExecutor(max_workers=min(self.workers, len(disks))) as pool:
+            futures = {pool.submit(self.fetch, device, disk_info): (device, disk_info, 0)
+                       for device, disk_info in disks}
+            while futures or retries:
+                now = time.monotonic()
+                while retries and retries[0][0] <= now:
+                    _, _, device, disk_info, attempt = heapq.heappop(retries)
+                    futures[pool.submit(self.fetch, device, disk_info, True)] = (device, disk_info, attempt)
+                done, _ = wait(futures, timeout=max(0, retries[0][0] - now) if retries else None,
+                               return_when=FIRST_COMPLETED)
+                for future in done:
+                    device, disk_info, attempt = futures.pop(future)
+                    result = future.result()
+                    delay = self.retry_delay(result, attempt)
+                    if delay is not None:
+                        heapq.heappush(retries, (time.monotonic() + delay, next(order), device, disk_info,
+                                                 attempt + 1))
+                        continue
+                    results[device] = result
+                    if on_result is not None:
+                        on_result(device, result)
+        return results
+
+class SmartRecord:
+    """Base for the compact per-row SMART records; fields are listed in __slots__"""
+    __slots__ = ()
+
+    def __init__(self, *values, **fields):
+        for name, value in zip(self.__slots__, values):
+            setattr(self, name, value)
+        for name in self.__slots__[len(values):]:
+            setattr(self, name, fields.get(name))
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**{name: data.get(name) for name in cls.__slots__})
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.as_dict() == other.as_dict()
+
+    def __repr__(self):
+        fields = ", ".join(f"{name}={getattr(self, name)!r}" for name in self.__slots__)
+        return f"{type(self).__name__}({fields})"
+
+class SmartAttribute(SmartRecord):
+    """One row of the ATA SMART attribute table"""
+    __slots__ = ('id', 'name', 'flags', 'value', 'worst', 'thresh', 'when_failed', 'raw')
+
+    # Built once per table row, so spelled out rather than going through setattr
+    def __init__(self, id=None, name=None, flags=None, value=None, worst=None, thresh=None,
+                 when_failed=None, raw=None):
+        self.id = id
+        self.name = name
+        self.flags = flags
+        self.value = value
+        self.worst = worst
+        self.thresh = thresh
+        self.when_failed = when_failed
+        self.raw = raw
+
+class ErrorCounter(SmartRecord):
+    """One row (read, write or verify) of the SAS error counter log"""
+    __slots__ = ('operation', 'ecc_fast', 'ecc_delayed', 'rereads', 'total_corrected',
+                 'invocations', 'gigabytes', 'uncorrected')
+
+class NvmeHealth(SmartRecord):
+    """The NVMe SMART/Health Information log, named as in smartctl's JSON output"""
+    __slots__ = ('critical_warning', 'temperature', 'available_spare', 'available_spare_threshold',
+                 'percentage_used', 'data_units_read', 'data_units_written', 'host_reads',
+                 'host_writes', 'controller_busy_time', 'power_cycles', 'power_on_hours',
+                 'unsafe_shutdowns', 'media_errors', 'num_err_log_entries', 'warning_temp_time',
+                 'critical_comp_time')
+
+# Labels of the NVMe health log in smartctl's text report
+NVME_HEALTH_LABELS = {
+    "Critical Warning": 'critical_warning',
+    "Temperature": 'temperature',
+    "Available Spare": 'available_spare',
+    "Available Spare Threshold": 'available_spare_threshold',
+    "Percentage Used": 'percentage_used',
+    "Data Units Read": 'data_units_read',
+    "Data Units Written": 'data_units_written',
+    "Host Read Commands": 'host_reads',
+    "Host Write Commands": 'host_writes',
+    "Controller Busy Time": 'controller_busy_time',
+    "Power Cycles": 'power_cycles',
+    "Power On Hours": 'power_on_hours',
+    "Unsafe Shutdowns": 'unsafe_shutdowns',
+    "Media and Data Integrity Errors": 'media_errors',
+    "Error Information Log Entries": 'num_err_log_entries',
+    "Warning Comp. Temperature Time": 'warning_temp_time',
+    "Critical Comp. Temperature Time": 'critical_comp_time',
+}
+
+# ATA attribute IDs reported under their own result keys
+SATA_ATTRIBUTE_KEYS = {
+    1: 'raw_read_error_rate',
+    7: 'seek_error_rate',
+    198: 'offline_uncorrectable',
+    199: 'udma_crc_error_count',
+}
+
+LEADING_INT = re.compile(r"\d+")
+SELF_TEST_VALUE = re.compile(r"^(\d+%?|-+)$")
+TOKEN = re.compile(r"\S+")
+
+# Lines of the text report that open a table or carry a single value
+TEXT_LINE_KEY = re.compile(
+    r"ID#|Error counter log|SMART/Health Information|Num(?=\s+Test)"
+    r"|SMART overall-health self-assessment test result:|SMART Health Status:"
+    r"|Accumulated power on time|Self-test execution status:|Elements in grown defect list:"
+    r"|Firmware Version:|Revision:"
+)
+
+def _to_int(token):
+    """Parse a smartctl number ("1,234", "0x00", "100%", "403 (Average 399)")"""
+    if token.isdigit():
+        return int(token)
+    token = token.replace(',', '')
+    if token.startswith('0x'):
+        try:
+            return int(token, 16)
+        except ValueError:
+            return None
+    match = LEADING_INT.match(token)
+    return int(match.group(0)) if match else None
+
+def _no_test():
+    return {'description': 'N/A', 'status': 'N/A', 'lifetime_hours': 'N/A'}
+
 def parse_smart_data(smart_output):
-    """Parse SMART output with separate paths for SATA, SAS, and NVMe"""
-    results = defaultdict(lambda: "N/A")
+    """Parse smartctl output, using the JSON mapping when smartctl produced JSON"""
+    if smart_output.lstrip().startswith('{'):
+        try:
+            return parse_smart_json(json.loads(smart_output))
+        except json.JSONDecodeError:
+            pass
+    return parse_smart_text(smart_output)
+
+def summarize_smart_records(results):
+    """Fill the per-drive-type result keys from the parsed records"""
+    drive_type = results['drive_type']
+    if drive_type == "NVMe":
+        health = results.get('nvme_health')
+        results['media_errors'] = (health.media_errors if health else None) or 0
+        results['error_log_entries'] = (health.num_err_log_entries if health else None) or 0
+        if results['power_on_hours'] == "N/A" and health and health.power_on_hours is not None:
+            results['power_on_hours'] = health.power_on_hours
+    elif drive_type == "SAS":
+        counters = results.get('error_counters', {})
+        for operation in ('read', 'write', 'verify'):
+            counter = counters.get(operation)
+            results[f'{operation}_corrected'] = (counter.total_corrected if counter else None) or 0
+            results[f'{operation}_errors'] = (counter.uncorrected if counter else None) or 0
+    else:  # SATA
+        raw_values = {attribute.id: attribute.raw for attribute in results.get('attributes', [])}
+        for attribute_id, key in SATA_ATTRIBUTE_KEYS.items():
+            results[key] = raw_values.get(attribute_id) or 0
+    return results
+
+def parse_smart_json(document):
+    """Map a smartctl -j document onto the same result keys as the text parser"""
+    results = {}
     
-    # Determine drive type
-    drive_type = "SATA"  # Default to SATA
-    if "NVMe" in smart_output or "Namespace" in smart_output:
+    # The protocol reported by smartctl is exact, no guessing needed
+    protocol = document.get('device', {}).get('protocol', '')
+    if protocol == "NVMe" or 'nvme_smart_health_information_log' in document:
         drive_type = "NVMe"
-    elif "SAS" in smart_output or "SCSI" in smart_output:
+    elif protocol == "SCSI" or 'scsi_error_counter_log' in document:
         drive_type = "SAS"
+    else:
+        drive_type = "SATA"
     results['drive_type'] = drive_type
     
-    # Extract health status based on drive type
-    if drive_type == "SAS":
-        # SAS-specific health status
-        health_match = re.search(r"SMART Health Status:\s*(\w+)", smart_output)
-        health_status = health_match.group(1) if health_match else "UNKNOWN"
-        # Convert "OK" to "PASSED" for consistency
-        results['health_status'] = "PASSED" if health_status == "OK" else health_status
-    else:
-        # Standard health status for other drives
-        health_match = re.search(
-            r"SMART overall-health self-assessment test result:\s*(\w+)", 
-            smart_output
-        )
-        results['health_status'] = health_match.group(1) if health_match else "UNKNOWN"
-    
-    # Extract Power_On_Hours using SMART ID 9 for all drive types
-    hours_match = re.search(r"9\s+Power_On_Hours\s+.*?-\s+(\d+)", smart_output)
-    if hours_match:
-        results['power_on_hours'] = int(hours_match.group(1))
+    smart_status = document.get('smart_status', {})
+    if 'passed' in smart_status:
+        results['health_status'] = "PASSED" if smart_status['passed'] else "FAILED"
     else:
-        # Fallback to other patterns
-        hours_match = re.search(r"Power_?On_?Hours[:\s]*([\d,]+)", smart_output, re.IGNORECASE)
-        if hours_match:
-            hours_str = hours_match.group(1).replace(',', '')
-            results['power_on_hours'] = int(hours_str)
-        else:
-            # Try alternative pattern for current power on hours
-            hours_match = re.search(r"Accumulated power on time.*?(\d+):\d+", smart_output, re.IGNORECASE)
-            if hours_match:
-                results['power_on_hours'] = int(hours_match.group(1))
-            else:
-                results['power_on_hours'] = "N/A"
+        results['health_status'] = "UNKNOWN"
+    
+    results['power_on_hours'] = document.get('power_on_time', {}).get('hours', "N/A")
+    # SCSI devices report a revision instead of a firmware version
+    results['firmware'] = document.get('firmware_version') or document.get('scsi_revision')
     
-    # Drive type specific parsing
     if drive_type == "NVMe":
-        # NVMe-specific patterns
-        media_errors_match = re.search(r"Media and Data Integrity Errors:\s*(\d+)", smart_output)
-        error_log_match = re.search(r"Error Information Log Entries:\s*(\d+)", smart_output)
+        health_log = document.get('nvme_smart_health_information_log')
+        results['nvme_health'] = NvmeHealth.from_dict(health_log) if health_log else None
         
-        results['media_errors'] = int(media_errors_match.group(1)) if media_errors_match else 0
-        results['error_log_entries'] = int(error_log_match.group(1)) if error_log_match else 0
+        tests = document.get('nvme_self_test_log', {}).get('table', [])
+        last_test = tests[0] if tests else None
+        if last_test:
+            results['last_test'] = {
+                'description': last_test.get('self_test_code', {}).get('string', 'N/A'),
+                'status': last_test.get('self_test_result', {}).get('string', 'N/A'),
+                'lifetime_hours': last_test.get('power_on_hours', 'N/A')
+            }
         
     elif drive_type == "SAS":
-        # SAS-specific patterns
-        read_match = re.search(r"read:\s+.*?\s+(\d+)$", smart_output, re.MULTILINE)
-        write_match = re.search(r"write:\s+.*?\s+(\d+)$", smart_output, re.MULTILINE)
-        verify_match = re.search(r"verify:\s+.*?\s+(\d+)$", smart_output, re.MULTILINE)
-        
-        # Improved grown defects detection with fallback
-        grown_defects_match = re.search(r"Elements in grown defect list:\s*(\d+)", smart_output)
-        if not grown_defects_match:
-            # Alternative pattern for some SAS drives
-            grown_defects_match = re.search(r"grown defect list:\s*(\d+)", smart_output)
-        results['grown_defects'] = int(grown_defects_match.group(1)) if grown_defects_match else 0
-        
-        # Parse corrected errors
-        read_corrected = re.search(r"read:\s+(\d+)\s+(\d+)\s+(\d+)\s+(\d+)", smart_output)
-        write_corrected = re.search(r"write:\s+(\d+)\s+(\d+)\s+(\d+)\s+(\d+)", smart_output)
-        verify_corrected = re.search(r"verify:\s+(\d+)\s+(\d+)\s+(\d+)\s+(\d+)", smart_output)
-        
-        results['read_corrected'] = int(read_corrected.group(4)) if read_corrected else 0
-        results['write_corrected'] = int(write_corrected.group(4)) if write_corrected else 0
-        results['verify_corrected'] = int(verify_corrected.group(4)) if verify_corrected else 0
-        
-        results['read_errors'] = int(read_match.group(1)) if read_match else 0
-        results['write_errors'] = int(write_match.group(1)) if write_match else 0
-        results['verify_errors'] = int(verify_match.group(1)) if verify_match else 0
+        results['grown_defects'] = document.get('scsi_grown_defect_list', 0)
         
-    else:  # SATA
-        # SATA-specific patterns using SMART IDs
-        patterns = {
-            'raw_read_error_rate': r"1\s+Raw_Read_Error_Rate.*?\s+\d+\s+\d+\s+\d+\s+\S+\s+\S+\s+-\s+(\d+)",
-            'seek_error_rate': r"7\s+Seek_Error_Rate.*?\s+\d+\s+\d+\s+\d+\s+\S+\s+\S+\s+-\s+(\d+)",
-            'offline_uncorrectable': r"198\s+Offline_Uncorrectable.*?\s+\d+\s+\d+\s+\d+\s+\S+\s+\S+\s+-\s+(\d+)",
-            'udma_crc_error_count': r"199\s+UDMA_CRC_Error_Count.*?\s+\d+\s+\d+\s+\d+\s+\S+\s+\S+\s+-\s+(\d+)"
+        counter_log = document.get('scsi_error_counter_log', {})
+        results['error_counters'] = {
+            operation: ErrorCounter(
+                operation,
+                counters.get('errors_corrected_by_eccfast'),
+                counters.get('errors_corrected_by_eccdelayed'),
+                counters.get('errors_corrected_by_rereads_rewrites'),
+                counters.get('total_errors_corrected'),
+                counters.get('correction_algorithm_invocations'),
+                float(counters.get('gigabytes_processed') or 0),
+                counters.get('total_uncorrected_errors'))
+            for operation, counters in counter_log.items()
         }
         
-        for key, pattern in patterns.items():
-            match = re.search(pattern, smart_output)
-            results[key] = int(match.group(1)) if match else 0
-    
-    # Improved test log parsing for all drive types
-    test_log_match = re.search(
-        r"#\s*1\s+([\w\s]+?)\s+(\w+(?:\s+\w+)?)\s+.*?(\d+)\s",
-        smart_output,
-        re.MULTILINE
-    )
-    
-    if test_log_match:
-        results['last_test'] = {
-            'description': test_log_match.group(1).strip(),
-            'status': test_log_match.group(2).strip(),
-            'lifetime_hours': int(test_log_match.group(3))
-        }
-    else:
-        # Try alternative pattern for test logs with different formats
-        alt_test_match = re.search(
-            r"#\s*1\s+([\w\s]+?)\s+(\w+).*?(\d+)\s",
-            smart_output,
-            re.MULTILINE
-        )
-        if alt_test_match:
+        last_test = document.get('scsi_self_test_0')
+        if last_test:
             results['last_test'] = {
-                'description': alt_test_match.group(1).strip(),
-                'status': alt_test_match.group(2).strip(),
-                'lifetime_hours': int(alt_test_match.group(3))
+                'description': last_test.get('code', {}).get('string', 'N/A'),
+                'status': last_test.get('result', {}).get('string', 'N/A'),
+                'lifetime_hours': last_test.get('power_on_time', {}).get('hours', 'N/A')
             }
+        
+    else:  # SATA
+        results['attributes'] = [
+            SmartAttribute(
+                attribute.get('id'),
+                attribute.get('name'),
+                attribute.get('flags', {}).get('value'),
+                attribute.get('value'),
+                attribute.get('worst'),
+                attribute.get('thresh'),
+                attribute.get('when_failed') or '-',
+                # Same leading number the text report shows; raw.value packs extra fields
+                _to_int(attribute.get('raw', {}).get('string', '')) if attribute.get('raw', {}).get('string')
+                else attribute.get('raw', {}).get('value'))
+            for attribute in document.get('ata_smart_attributes', {}).get('table', [])
+        ]
+        
+        test_log = document.get('ata_smart_self_test_log', {})
+        tests = (test_log.get('extended') or test_log.get('standard') or {}).get('table', [])
+        last_test = tests[0] if tests else None
+        if last_test:
+            results['last_test'] = {
+                'description': last_test.get('type', {}).get('string', 'N/A'),
+                'status': last_test.get('status', {}).get('string', 'N/A'),
+                'lifetime_hours': last_test.get('lifetime_hours', 'N/A')
+            }
+    
+    results.setdefault('last_test', _no_test())
+    
+    return summarize_smart_records(results)
+
+def _parse_self_test_row(line, columns):
+    """Split the newest self-test log row using the column positions of its header"""
+    desc_col, status_col, hours_col = columns
+    status_words = []
+    in_status = True
+    lifetime_hours = 'N/A'
+    for match in TOKEN.finditer(line):
+        if match.start() < status_col:
+            continue
+        token = match.group(0)
+        if SELF_TEST_VALUE.match(token):
+            # The status text ends at the first value column (remaining %, segment...)
+            in_status = False
+            if token.isdigit() and match.end() > hours_col:
+                lifetime_hours = int(token)
+                break
+        elif in_status:
+            status_words.append(token)
+    
+    return {
+        'description': line[desc_col:status_col].strip() or 'N/A',
+        'status': " ".join(status_words) or 'N/A',
+        'lifetime_hours': lifetime_hours
+    }
+
+def parse_smart_text(smart_output):
+    """Parse the classic smartctl report for SATA, SAS, and NVMe in a single pass"""
+    results = {}
+    attributes = []
+    error_counters = {}
+    nvme_fields = {}
+    overall_health = None
+    sas_health = None
+    grown_defects = None
+    accumulated_hours = None
+    execution_status = None
+    firmware = None
+    last_test = None
+    
+    # Table currently being read, and the layout of its header
+    section = None
+    attribute_split = 9
+    failed_index = 8
+    test_columns = None
+    
+    for line in smart_output.splitlines():
+        text = line.strip()
+        if not text:
+            section = None
+            continue
+        
+        # Rows of the table we are inside of
+        if section == 'attributes':
+            tokens = text.split(None, attribute_split)
+            if len(tokens) > attribute_split and tokens[0].isdigit():
+                flags, value, worst, thresh, raw = tokens[2], tokens[3], tokens[4], tokens[5], tokens[-1]
+                attributes.append(SmartAttribute(
+                    int(tokens[0]),
+                    tokens[1],
+                    _to_int(flags) if flags.startswith('0x') else flags,
+                    int(value) if value.isdigit() else None,
+                    int(worst) if worst.isdigit() else None,
+                    int(thresh) if thresh.isdigit() else None,
+                    tokens[failed_index] if failed_index is not None else '-',
+                    int(raw) if raw.isdigit() else _to_int(raw)))
+                continue
+        elif section == 'counters':
+            if text.startswith(('read:', 'write:', 'verify:')):
+                tokens = text.split()
+                if len(tokens) >= 8:
+                    operation = tokens[0][:-1]
+                    try:
+                        gigabytes = float(tokens[6])
+                    except ValueError:
+                        gigabytes = None
+                    error_counters[operation] = ErrorCounter(
+                        operation, _to_int(tokens[1]), _to_int(tokens[2]), _to_int(tokens[3]),
+                        _to_int(tokens[4]), _to_int(tokens[5]), gigabytes, _to_int(tokens[-1]))
+                continue
+        elif section == 'nvme_health':
+            label, separator, value = text.partition(':')
+            field = NVME_HEALTH_LABELS.get(" ".join(label.split()))
+            if separator and field:
+                nvme_fields[field] = _to_int(value.strip())
+                continue
+        elif section == 'self_test':
+            first = text.split(None, 1)[0]
+            if first.startswith('#') or first.isdigit():
+                last_test = _parse_self_test_row(line, test_columns)
+                section = None
+                continue
+        
+        # Table headers and single-line values
+        match = TEXT_LINE_KEY.match(text)
+        if not match:
+            continue
+        key = match.group(0)
+        if key == "ID#":
+            header = text.split()
+            attribute_split = len(header) - 1
+            if 'WHEN_FAILED' in header:
+                failed_index = header.index('WHEN_FAILED')
+            elif 'FAIL' in header:
+                failed_index = header.index('FAIL')
+            else:
+                failed_index = None
+            section = 'attributes'
+        elif key == "Error counter log":
+            section = 'counters'
+        elif key == "SMART/Health Information":
+            section = 'nvme_health'
+        elif key == "Num":
+            status_col = max(line.find("Status"), line.find("Result"))
+            hours_col = max(line.find("LifeTime"), line.find("POH"))
+            if last_test is None and status_col > 0 and hours_col > 0:
+                test_columns = (line.find("Test"), status_col, hours_col)
+                section = 'self_test'
+        elif key.endswith("grown defect list:"):
+            grown_defects = _to_int(text[match.end():].strip())
+        elif key == "Accumulated power on time":
+            hours_match = re.search(r"(\d+):\d+", text)
+            accumulated_hours = int(hours_match.group(1)) if hours_match else None
+        elif key == "Self-test execution status:":
+            status_match = re.search(r"\(\s*\d+\)\s+(.*)", text)
+            execution_status = status_match.group(1).strip() if status_match else None
+        elif key in ("Firmware Version:", "Revision:"):
+            firmware = firmware or text[match.end():].strip() or None
         else:
-            # Fallback to NVMe pattern
-            nvme_test_match = re.search(
-                r"Self-test execution status:\s+\(\s*\d+\)\s+(.*?)\n",
-                smart_output
-            )
-            if nvme_test_match:
-                results['last_test'] = {
-                    'description': "Self-test",
-                    'status': nvme_test_match.group(1).strip(),
-                    'lifetime_hours': results.get('power_on_hours', 'N/A')
-                }
+            health_match = re.match(r"\s*(\w+)", text[match.end():])
+            if key == "SMART Health Status:":
+                sas_health = health_match.group(1) if health_match else None
             else:
-                results['last极test'] = {
-                    'description': 'N/A',
-                    'status': 'N/A',
-                    'lifetime_hours': 'N/A'
-                }
+                overall_health = health_match.group(1) if health_match else None
+    
+    # Drive type markers anywhere in the report
+    is_nvme = "NVMe" in smart_output or "Namespace" in smart_output
+    is_sas = not is_nvme and ("SAS" in smart_output or "SCSI" in smart_output)
+    
+    drive_type = "NVMe" if is_nvme else "SAS" if is_sas else "SATA"
+    results['drive_type'] = drive_type
+    
+    if drive_type == "SAS":
+        # Convert "OK" to "PASSED" for consistency
+        health_status = sas_health or "UNKNOWN"
+        results['health_status'] = "PASSED" if health_status == "OK" else health_status
+    else:
+        results['health_status'] = overall_health or "UNKNOWN"
+    
+    # Power on hours from SMART ID 9, otherwise from the SAS accumulated time
+    power_on_hours = next((attribute.raw for attribute in attributes
+                           if attribute.id == 9 and attribute.name.startswith("Power_On_Hours")),
+                          accumulated_hours)
+    results['power_on_hours'] = power_on_hours if power_on_hours is not None else "N/A"
+    results['firmware'] = firmware
+    
+    if drive_type == "NVMe":
+        results['nvme_health'] = NvmeHealth(**nvme_fields) if nvme_fields else None
+    elif drive_type == "SAS":
+        results['grown_defects'] = grown_defects or 0
+        results['error_counters'] = error_counters
+    else:
+        results['attributes'] = attributes
+    summarize_smart_records(results)
+    
+    if last_test is None and execution_status:
+        # No self-test log, fall back to the execution status line
+        last_test = {
+            'description': "Self-test",
+            'status': execution_status,
+            'lifetime_hours': results['power_on_hours']
+        }
+    results['last_test'] = last_test or _no_test()
+    
+    return results
+
+# Shared between runs and between consumers on the same host; only root can
+# create directories under /var/cache, unlike the world-writable /var/tmp
+DEFAULT_CACHE_PATH = "/var/cache/diskmapper/smart-cache.json"
+
+def private_directory(directory):
+    """Create the directory of a cache or state file, or make sure an existing one
+    is safe: a directory that someone else owns or can write to could be used to
+    swap the files under us, so it is refused with PermissionError"""
+    if not directory:
+        return
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    info = os.lstat(directory)
+    if not stat.S_ISDIR(info.st_mode):
+        raise PermissionError(f"{directory} is not a directory")
+    if info.st_uid not in (0, os.geteuid()) or info.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        raise PermissionError(f"{directory} is owned by another user or writable by others, not using it")
+
+def serialize_smart_data(smart_data):
+    """Convert a parsed SMART result to plain JSON-compatible values"""
+    data = dict(smart_data)
+    if 'attributes' in data:
+        data['attributes'] = [attribute.as_dict() for attribute in data['attributes']]
+    if 'error_counters' in data:
+        data['error_counters'] = {operation: counter.as_dict()
+                                  for operation, counter in data['error_counters'].items()}
+    if data.get('nvme_health') is not None:
+        data['nvme_health'] = data['nvme_health'].as_dict()
+    return data
+
+def deserialize_smart_data(data):
+    """Rebuild a parsed SMART result, records included, from serialize_smart_data output"""
+    smart_data = dict(data)
+    if 'attributes' in smart_data:
+        smart_data['attributes'] = [SmartAttribute.from_dict(attribute)
+                                    for attribute in smart_data['attributes']]
+    if 'error_counters' in smart_data:
+        smart_data['error_counters'] = {operation: ErrorCounter.from_dict(counter)
+                                        for operation, counter in smart_data['error_counters'].items()}
+    if smart_data.get('nvme_health') is not None:
+        smart_data['nvme_health'] = NvmeHealth.from_dict(smart_data['nvme_health'])
+    return smart_data
+
+def get_cache_key(disk_info):
+    """Cache key for a disk: its serial plus WWN, or None if the serial is unknown"""
+    serial = (disk_info or {}).get('serial')
+    if not serial:
+        return None
+    wwn = disk_info.get('lunid') or disk_info.get('wwn') or ''
+    return f"{serial}:{wwn}"
+
+class SmartCache:
+    """Persistent SMART results keyed by disk serial and WWN.
+
+    Each entry holds the raw smartctl output (compressed), the parsed result and
+    its capture time. Results older than max_age are ignored, and once the cache
+    holds more than max_entries the least recently used entries are evicted. The
+    file is merged and replaced under an exclusive lock, so several consumers on
+    the same host can share one smartctl sweep.
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_age=300, max_entries=1024):
+        self.path = path
+        self.max_age = max_age
+        self.max_entries = max_entries
+        self._entries = {}
+        self._dirty = set()
+        self._lock = threading.Lock()
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                entries = json.load(f)
+            return entries if isinstance(entries, dict) else {}
+        except (OSError, ValueError):
+            return {}
+
+    def _locked(self):
+        private_directory(os.path.dirname(self.path))
+        lock_file = open(self.path + ".lock", "a")
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        return lock_file
+
+    def load(self):
+        """Read the cache file, if there is one"""
+        try:
+            with self._locked():
+                entries = self._read()
+        except OSError:
+            entries = {}
+        with self._lock:
+            self._entries = entries
+            self._dirty.clear()
+        return self
+
+    def get(self, key, max_age=None):
+        """Return the cached result for key if it is fresh enough, else None"""
+        if key is None:
+            return None
+        max_age = self.max_age if max_age is None else max_age
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or now - entry.get('captured', 0) > max_age:
+                return None
+            entry['accessed'] = now
+            self._dirty.add(key)
+        try:
+            output = zlib.decompress(base64.b64decode(entry['output'])).decode()
+            data = deserialize_smart_data(entry['data'])
+        except (KeyError, TypeError, ValueError, zlib.error):
+            return None
+        return {"output": output, "data": data, "captured": entry['captured'], "cached": True}
+
+    def put(self, key, result):
+        """Store a freshly captured SMART result"""
+        if key is None:
+            return
+        entry = {
+            "output": base64.b64encode(zlib.compress(result['output'].encode())).decode(),
+            "data": serialize_smart_data(result['data']),
+            "captured": result['captured'],
+            "accessed": result['captured']
+        }
+        with self._lock:
+            self._entries[key] = entry
+            self._dirty.add(key)
+
+    def save(self):
+        """Merge our changes into the cache file, evict old entries and replace it atomically"""
+        with self._lock:
+            changes = {key: self._entries[key] for key in self._dirty if key in self._entries}
+            self._dirty.clear()
+        if not changes:
+            return
+        with self._locked():
+            entries = self._read()
+            for key, entry in changes.items():
+                current = entries.get(key)
+                if current is None or current.get('captured', 0) <= entry['captured']:
+                    entries[key] = entry
+                else:
+                    # Another consumer stored a newer capture meanwhile; keep it
+                    current['accessed'] = max(current.get('accessed', 0), entry['accessed'])
+            if len(entries) > self.max_entries:
+                by_use = sorted(entries, key=lambda k: entries[k].get('accessed', 0))
+                for key in by_use[:len(entries) - self.max_entries]:
+                    del entries[key]
+            temp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(temp_path, 'w') as f:
+                json.dump(entries, f, separators=(',', ':'))
+            os.replace(temp_path, self.path)
+        with self._lock:
+            self._entries = entries
+
+def get_smart_result(device, disk_info=None, backend="auto", cache=None, refresh=False, transport=None,
+                     wake=True, timeout=None):
+    """Return the SMART result for a device: raw output, parsed data and capture time.
+
+    A fresh cached result is used unless refresh is set; new results that could be
+    parsed are stored back into the cache. Without wake a disk in standby is not
+    read: its last cached result is returned however old it is, with "standby"
+    set to the power mode smartctl reported. A disk whose smartctl timed out
+    gets its last cached result the same way, with "timed_out" set. A read that
+    failed in a way that may pass has "transient" set.
+    """
+    key = get_cache_key(disk_info)
+    if cache is not None and not refresh:
+        cached = cache.get(key)
+        if cached is not None:
+            return cached
+    smart_output = get_smart_data(device, backend, transport, wake, timeout)
+    if smart_output.startswith("Timeout: "):
+        message = smart_output[len("Timeout: "):]
+        result = cache.get(key, max_age=math.inf) if cache is not None else None
+        if result is None:
+            result = {"output": f"Error: {message}", "data": {}, "captured": time.time(), "cached": False}
+        result["timed_out"] = message
+        return result
+    if smart_output.startswith("Standby: "):
+        power_mode = smart_output[len("Standby: "):]
+        result = cache.get(key, max_age=math.inf) if cache is not None else None
+        if result is None:
+            result = {"output": f"Error: disk is in {power_mode} mode and was not woken up, "
+                                f"no SMART data cached yet",
+                      "data": {}, "captured": time.time(), "cached": False}
+        result["standby"] = power_mode
+        return result
+    if smart_output.startswith("Failed: "):
+        return {"output": f"Error: {smart_output[len('Failed: '):]}", "data": {}, "captured": time.time(),
+                "cached": False, "transient": True}
+    with TRACER.span("parse", device):
+        smart_data = parse_smart_data(smart_output) if not smart_output.startswith("Error") else {}
+    result = {"output": smart_output, "data": smart_data, "captured": time.time(), "cached": False}
+    if cache is not None and smart_data:
+        cache.put(key, result)
+    return result
+
+DEFAULT_HISTORY_PATH = "/var/db/diskmapper/smart-history.sqlite"
+
+# SMART counters kept in the history, per drive type
+HISTORY_COUNTERS = {
+    "SAS": ('power_on_hours', 'read_corrected', 'write_corrected', 'verify_corrected',
+            'read_errors', 'write_errors', 'verify_errors', 'grown_defects'),
+    "NVMe": ('power_on_hours', 'media_errors', 'error_log_entries'),
+    "SATA": ('power_on_hours', 'raw_read_error_rate', 'seek_error_rate',
+             'offline_uncorrectable', 'udma_crc_error_count'),
+}
+
+# A counter counts as accelerating once its recent rate is this many times the earlier rate
+TREND_ACCELERATION = 2
+# A counter needs this much history (seconds) before it counts as flat
+TREND_MIN_SPAN = 86400
+
+HISTORY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS disks (id INTEGER PRIMARY KEY, serial TEXT NOT NULL UNIQUE);
+CREATE TABLE IF NOT EXISTS counters (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE);
+CREATE TABLE IF NOT EXISTS samples (
+    disk_id INTEGER NOT NULL,
+    counter_id INTEGER NOT NULL,
+    time INTEGER NOT NULL,
+    value INTEGER NOT NULL,
+    PRIMARY KEY (disk_id, counter_id, time)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS samples_time ON samples (time);
+"""
+
+def analyze_trend(points):
+    """Summarize the (time, value) samples of one counter, oldest first.
+
+    The samples are split at the middle of their time span; the counter is
+    accelerating when it grows faster in the recent half than in the earlier
+    one, and has an onset when it only started growing in the recent half.
+    """
+    # A counter that went backwards was reset, only the samples after that count
+    start = 0
+    for index in range(1, len(points)):
+        if points[index][1] < points[index - 1][1]:
+            start = index
+    points = points[start:]
+    if len(points) < 2 or points[-1][0] <= points[0][0]:
+        return None
     
-    return dict(results)
+    (first_time, first_value), (last_time, last_value) = points[0], points[-1]
+    span = last_time - first_time
+    middle_time, middle_value = points[0]
+    for point in points[1:-1]:
+        if point[0] > first_time + span / 2:
+            break
+        middle_time, middle_value = point
+    
+    trend = {
+        "delta": last_value - first_value,
+        "per_day": round((last_value - first_value) * 86400 / span, 2),
+        "span_days": round(span / 86400, 2),
+        "flat": last_value == first_value and span >= TREND_MIN_SPAN,
+        "recent_delta": last_value - middle_value,
+        "recent_per_day": None,
+        "earlier_per_day": None,
+        "accelerating": False,
+        "onset": False
+    }
+    if middle_time > first_time:
+        trend["earlier_per_day"] = round((middle_value - first_value) * 86400 / (middle_time - first_time), 2)
+        trend["recent_per_day"] = round((last_value - middle_value) * 86400 / (last_time - middle_time), 2)
+        # Any growth after none at all is a multiple of nothing, so it is an onset rather than acceleration
+        trend["accelerating"] = (last_value > middle_value and trend["earlier_per_day"] > 0 and
+                                 trend["recent_per_day"] > TREND_ACCELERATION * trend["earlier_per_day"])
+        trend["onset"] = last_value > middle_value and middle_value == first_value
+    return trend
+
+class HistoryError(Exception):
+    """The SMART history database could not be opened, read or written"""
+
+class SmartHistory:
+    """SQLite time series of SMART counters per disk serial.
+
+    Samples are keyed by the time smartctl ran, so recording a cached result
+    twice stores it once. Samples older than raw_days are downsampled to the
+    last one per day, and samples older than retention_days are dropped.
+    """
+
+    def __init__(self, path=DEFAULT_HISTORY_PATH, retention_days=365, raw_days=7):
+        self.path = path
+        self.retention_days = retention_days
+        self.raw_days = raw_days
+        self._db = None
+        self._lock = threading.Lock()
+        self._disk_ids = {}
+        self._counter_ids = {}
+
+    @contextlib.contextmanager
+    def _database(self):
+        """The open database, held under the lock; any failure is raised as HistoryError"""
+        import sqlite3
+        with self._lock:
+            try:
+                if self._db is None:
+                    private_directory(os.path.dirname(self.path))
+                    # Watch and exporter mode record from a background thread
+                    self._db = sqlite3.connect(self.path, check_same_thread=False)
+                    self._db.executescript(HISTORY_SCHEMA)
+                yield self._db
+            except (OSError, sqlite3.Error) as e:
+                raise HistoryError(f"{self.path}: {str(e)}") from e
+
+    def _id(self, table, column, value, ids):
+        if value not in ids:
+            db = self._db
+            db.execute(f"INSERT OR IGNORE INTO {table} ({column}) VALUES (?)", (value,))
+            ids[value] = db.execute(f"SELECT id FROM {table} WHERE {column} = ?", (value,)).fetchone()[0]
+        return ids[value]
+
+    def record(self, disks, smart_results):
+        """Store the counters of every (device, disk_info) that has SMART data"""
+        with self._database() as db:
+            rows = []
+            for device, disk_info in disks:
+                result = smart_results.get(device)
+                serial = disk_info.get('serial')
+                if not serial or not result or not result['data']:
+                    continue
+                smart_data = result['data']
+                disk_id = self._id('disks', 'serial', serial, self._disk_ids)
+                for counter in HISTORY_COUNTERS.get(smart_data.get('drive_type'), ()):
+                    value = smart_data.get(counter)
+                    if isinstance(value, int):
+                        counter_id = self._id('counters', 'name', counter, self._counter_ids)
+                        rows.append((disk_id, counter_id, int(result['captured']), value))
+            db.executemany("INSERT OR IGNORE INTO samples VALUES (?, ?, ?, ?)", rows)
+            db.commit()
+
+    def trends(self, serials, window_days=7, now=None):
+        """Return {serial: {counter: trend}} over the last window_days"""
+        since = int((now or time.time()) - window_days * 86400)
+        trends = {}
+        with self._database() as db:
+            for serial in serials:
+                series = {}
+                for counter, sample_time, value in db.execute(
+                        "SELECT counters.name, samples.time, samples.value FROM samples"
+                        " JOIN disks ON disks.id = samples.disk_id"
+                        " JOIN counters ON counters.id = samples.counter_id"
+                        " WHERE disks.serial = ? AND samples.time >= ?"
+                        " ORDER BY samples.counter_id, samples.time", (serial, since)):
+                    series.setdefault(counter, []).append((sample_time, value))
+                trends[serial] = {}
+                for counter, points in series.items():
+                    trend = analyze_trend(points)
+                    if trend is not None:
+                        trends[serial][counter] = trend
+        return trends
+
+    def prune(self, now=None):
+        """Apply retention and downsample old samples to one per day"""
+        now = now or time.time()
+        with self._database() as db:
+            db.execute("DELETE FROM samples WHERE time < ?", (int(now - self.retention_days * 86400),))
+            db.execute(
+                "DELETE FROM samples WHERE time < ? AND EXISTS ("
+                " SELECT 1 FROM samples AS later WHERE later.disk_id = samples.disk_id"
+                " AND later.counter_id = samples.counter_id AND later.time > samples.time"
+                " AND later.time < (samples.time / 86400 + 1) * 86400)",
+                (int(now - self.raw_days * 86400),))
+            db.commit()
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+def update_history(history, disks, smart_results, window_days=7, prune=True, on_error=None):
+    """Record new SMART results and return the trends for the disks, None on failure.
+    A failure is printed, or passed to on_error(message) if given."""
+    try:
+        with TRACER.span("history", f"{len(disks)} disks"):
+            history.record(disks, smart_results)
+            if prune:
+                history.prune()
+            return history.trends({disk_info['serial'] for device, disk_info in disks
+                                   if disk_info.get('serial')}, window_days)
+    except HistoryError as e:
+        if on_error is None:
+            print(f"\033[1;31mError updating SMART history: {str(e)}\033[0m")
+        else:
+            on_error(f"Error updating SMART history: {str(e)}")
+        return None
 
 def format_time_ago(current_hours, test_hours):
     """Format time since last test"""
@@ -200,106 +1312,2547 @@ def calculate_days_since(current_hours, test_hours):
     if hours_ago < 0:
         return "N/A"
     
-    return hours_ago / 24
+    return hours_ago / 24
+
+# Only these fields of the middleware queries are used
+POOL_QUERY_FIELDS = ['name', 'status', 'scan', 'topology']
+DISK_QUERY_FIELDS = ['name', 'devname', 'serial', 'model', 'size', 'zfs_guid', 'lunid', 'enclosure']
+
+class MiddlewareError(Exception):
+    """A middleware call failed or returned something unusable"""
+
+class MiddlewareClient:
+    """Base for the ways of talking to the TrueNAS middleware.
+
+    Subclasses implement call(); query() adds filters and field selection the
+    same way middleware's own query methods take them.
+    """
+
+    def call(self, method, *params):
+        raise NotImplementedError
+
+    def query(self, method, filters=None, select=None):
+        """Run a *.query method, returning only the selected fields"""
+        options = {'select': select} if select else {}
+        with TRACER.span("middleware", method):
+            return self.call(method, filters or [], options)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class WebsocketMiddlewareClient(MiddlewareClient):
+    """Keeps one in-process connection to middlewared open for all calls"""
+
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+        try:
+            from truenas_api_client import Client
+        except ImportError:
+            from middlewared.client import Client
+        try:
+            self._client = Client()
+        except Exception as e:
+            raise MiddlewareError(f"cannot connect to middleware: {e}") from e
+
+    def call(self, method, *params):
+        try:
+            if self.timeout:
+                return self._client.call(method, *params, timeout=self.timeout)
+            return self._client.call(method, *params)
+        except Exception as e:
+            raise MiddlewareError(f"{method}: {e}") from e
+
+    def close(self):
+        self._client.close()
+
+class MidcltClient(MiddlewareClient):
+    """Spawns midclt for every call; works wherever midclt is on the PATH,
+    locally or through a transport on another host.
+
+    A failed call is retried with exponential backoff (middlewared restarting,
+    a busy websocket); one that runs into the timeout is not.
+    """
+
+    def __init__(self, transport=None, timeout=None, retries=0, backoff=1):
+        self.transport = transport or LOCAL_TRANSPORT
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+
+    def call(self, method, *params):
+        argv = ["midclt", "call", method] + [json.dumps(param) for param in params]
+        for attempt in range(self.retries + 1):
+            try:
+                result = self.transport.run(argv, self.timeout)
+                if result.returncode != 0:
+                    raise MiddlewareError(f"{method}: {result.stderr.strip() or f'exit status {result.returncode}'}")
+                return json.loads(result.stdout)
+            except subprocess.TimeoutExpired as e:
+                raise MiddlewareError(f"{method}: timed out after {e.timeout:.0f}s" if e.timeout
+                                      else f"{method}: the run's deadline passed") from e
+            except (OSError, subprocess.SubprocessError, json.JSONDecodeError, MiddlewareError) as e:
+                delay = self.backoff * 2 ** attempt
+                deadline = self.transport.deadline
+                if attempt == self.retries or (deadline is not None and time.monotonic() + delay >= deadline):
+                    if isinstance(e, MiddlewareError):
+                        raise
+                    raise MiddlewareError(f"{method}: {e}") from e
+                time.sleep(delay)
+
+def _filter_value(item, field):
+    for part in field.split('.'):
+        if not isinstance(item, dict):
+            return None
+        item = item.get(part)
+    return item
+
+def _match_filter(item, query_filter):
+    """Evaluate one middleware query filter ([field, op, value] or ["OR", [...]])"""
+    if query_filter[0] == "OR":
+        return any(_match_filter(item, sub) if isinstance(sub[0], str) else
+                   all(_match_filter(item, f) for f in sub) for sub in query_filter[1])
+    field, op, value = query_filter
+    current = _filter_value(item, field)
+    if op == '=':
+        return current == value
+    if op == '!=':
+        return current != value
+    if op == 'in':
+        return current in value
+    if op == 'nin':
+        return current not in value
+    if op in ('>', '<', '>=', '<='):
+        if current is None:
+            return False
+        return {'>': current > value, '<': current < value,
+                '>=': current >= value, '<=': current <= value}[op]
+    if op == '^':
+        return isinstance(current, str) and current.startswith(value)
+    if op == '$':
+        return isinstance(current, str) and current.endswith(value)
+    if op == '~':
+        return isinstance(current, str) and re.search(value, current) is not None
+    raise MiddlewareError(f"unsupported filter operator {op!r}")
+
+class StaticMiddlewareClient(MiddlewareClient):
+    """Local stand-in for middleware serving canned query results.
+
+    Filters and select are applied like middleware would, so tests and
+    benchmarks exercise the same code paths as a live system.
+    """
+
+    def __init__(self, responses):
+        self.responses = responses
+
+    @classmethod
+    def from_directory(cls, path):
+        """Load <method>.json files (e.g. pool.query.json) from a directory"""
+        responses = {}
+        for name in os.listdir(path):
+            if name.endswith('.json'):
+                with open(os.path.join(path, name)) as f:
+                    responses[name[:-5]] = json.load(f)
+        return cls(responses)
+
+    def call(self, method, *params):
+        if method not in self.responses:
+            raise MiddlewareError(f"{method}: no canned response")
+        result = self.responses[method]
+        if not method.endswith('.query'):
+            return result
+        filters = params[0] if params else []
+        options = params[1] if len(params) > 1 else {}
+        result = [item for item in result if all(_match_filter(item, f) for f in filters)]
+        if options.get('select'):
+            result = [{field: item[field] for field in options['select'] if field in item}
+                      for item in result]
+        if options.get('get'):
+            if not result:
+                raise MiddlewareError(f"{method}: no matching entry")
+            return result[0]
+        return result
+
+def connect_middleware(kind="auto", fixture=None, transport=None, timeout=None, retries=0, backoff=1):
+    """Open a middleware client: in-process websocket, midclt, or canned responses"""
+    if fixture:
+        return StaticMiddlewareClient.from_directory(fixture)
+    if kind in ("auto", "client"):
+        try:
+            return WebsocketMiddlewareClient(timeout)
+        except (ImportError, MiddlewareError):
+            if kind == "client":
+                raise
+    return MidcltClient(transport, timeout, retries, backoff)
+
+def build_disk_index(disk_data):
+    """Create the disk lookup tables by ZFS GUID and by device name"""
+    guid_to_disk = {}
+    devname_to_disk = {}
+    for disk in disk_data:
+        if disk.get('zfs_guid'):
+            guid_to_disk[str(disk['zfs_guid'])] = disk
+        if disk.get('devname'):
+            devname_to_disk[disk['devname']] = disk
+        # Also index by gptid if available
+        if disk.get('name') and disk['name'].startswith('gptid/'):
+            devname_to_disk[disk['name'][6:]] = disk
+        # The sysfs inventory knows the partitions of every disk
+        for partition in disk.get('partitions', ()):
+            devname_to_disk.setdefault(partition, disk)
+    return guid_to_disk, devname_to_disk
+
+def lookup_disk_info(disk_child, guid_to_disk, devname_to_disk):
+    """Find the disk.query record for a topology disk entry"""
+    whole_disk = disk_child.get('disk', 'UNKNOWN')
+    zfs_guid = disk_child.get('guid', '')
+    return (guid_to_disk.get(str(zfs_guid)) or devname_to_disk.get(whole_disk)
+            or devname_to_disk.get(os.path.basename(disk_child.get('device') or '')) or {})
+
+DEFAULT_SYSFS_ROOT = "/sys"
+# Fields a sysfs record needs before middleware is left out for that disk
+SYSFS_REQUIRED_FIELDS = ('serial', 'model', 'size')
+# Block devices that are never pool members in their own right (CD drives, floppies)
+SYSFS_SKIPPED_DEVICES = ('sr', 'fd')
+
+def _sysfs_read(path):
+    """The stripped contents of a sysfs attribute, None if it is missing or empty"""
+    try:
+        with open(path, errors='replace') as f:
+            return f.read().strip() or None
+    except OSError:
+        return None
+
+def _sysfs_vpd_serial(path):
+    """The unit serial number from a SCSI VPD page 0x80 (4 byte header, then the serial)"""
+    try:
+        with open(path, 'rb') as f:
+            page = f.read()
+    except OSError:
+        return None
+    length = int.from_bytes(page[2:4], 'big')
+    return page[4:4 + length].decode('ascii', 'replace').strip() or None
+
+def read_sysfs_enclosures(sysfs_root=DEFAULT_SYSFS_ROOT):
+    """Return {disk name: {"id", "slot"}} from the SES enclosures in /sys/class/enclosure"""
+    slots = {}
+    enclosure_dir = os.path.join(sysfs_root, "class", "enclosure")
+    try:
+        enclosures = sorted(os.listdir(enclosure_dir))
+    except OSError:
+        return slots
+    for enclosure in enclosures:
+        try:
+            components = sorted(os.listdir(os.path.join(enclosure_dir, enclosure)))
+        except OSError:
+            continue
+        for component in components:
+            component_dir = os.path.join(enclosure_dir, enclosure, component)
+            # Only populated slots link to the SCSI device of their disk
+            try:
+                disks = os.listdir(os.path.join(component_dir, "device", "block"))
+            except OSError:
+                continue
+            slot = _sysfs_read(os.path.join(component_dir, "slot"))
+            if slot is None:
+                digits = re.search(r"\d+", component)
+                slot = digits.group() if digits else component
+            for name in disks:
+                slots[name] = {"id": enclosure, "slot": int(slot) if slot.isdigit() else slot}
+    return slots
+
+def read_sysfs_disks(sysfs_root=DEFAULT_SYSFS_ROOT):
+    """Read the disks in <sysfs_root>/block into records shaped like disk.query's.
+
+    Size, model, vendor, serial (also from VPD page 0x80), WWN and rotational
+    come from the disk's sysfs directory, the enclosure slot from
+    /sys/class/enclosure. "partitions" lists the partition names, so a pool
+    member can be resolved to its disk. Virtual devices are left out.
+    """
+    block_dir = os.path.join(sysfs_root, "block")
+    enclosures = read_sysfs_enclosures(sysfs_root)
+    disks = []
+    try:
+        names = sorted(os.listdir(block_dir))
+    except OSError:
+        return disks
+    for name in names:
+        disk_dir = os.path.join(block_dir, name)
+        if name.startswith(SYSFS_SKIPPED_DEVICES) or "/virtual/" in os.path.realpath(disk_dir):
+            continue
+        device_dir = os.path.join(disk_dir, "device")
+        sectors = _sysfs_read(os.path.join(disk_dir, "size"))
+        wwid = _sysfs_read(os.path.join(device_dir, "wwid")) or _sysfs_read(os.path.join(disk_dir, "wwid"))
+        rotational = _sysfs_read(os.path.join(disk_dir, "queue", "rotational"))
+        try:
+            partitions = sorted(entry for entry in os.listdir(disk_dir)
+                                if os.path.exists(os.path.join(disk_dir, entry, "partition")))
+        except OSError:
+            partitions = []
+        disks.append({
+            "name": name,
+            "devname": name,
+            "serial": (_sysfs_read(os.path.join(device_dir, "serial")) or _sysfs_read(os.path.join(disk_dir, "serial"))
+                       or _sysfs_vpd_serial(os.path.join(device_dir, "vpd_pg80"))),
+            "model": _sysfs_read(os.path.join(device_dir, "model")),
+            "vendor": _sysfs_read(os.path.join(device_dir, "vendor")),
+            # The size file counts 512 byte sectors whatever the disk's sector size
+            "size": int(sectors) * 512 if sectors and sectors.isdigit() else None,
+            "zfs_guid": None,
+            "lunid": wwid[4:] if wwid and wwid.startswith("naa.") else None,
+            "enclosure": enclosures.get(name),
+            "type": None if rotational is None else ("HDD" if rotational == "1" else "SSD"),
+            "partitions": partitions,
+        })
+    return disks
+
+def sysfs_disk_inventory(client, pool_data, sysfs_root=DEFAULT_SYSFS_ROOT):
+    """The disk records for build_disk_index() read from sysfs instead of disk.query.
+
+    Pool members whose topology entry only names the partition get their
+    disk filled in, and every pool disk its ZFS GUID from the topology, which
+    sysfs does not know. Middleware is only asked about pool disks that sysfs
+    does not know or lacks a serial, model or size for, and only for the
+    fields that are missing.
+    """
+    disks = read_sysfs_disks(sysfs_root)
+    by_name = {disk["devname"]: disk for disk in disks}
+    partition_disks = {partition: disk["devname"] for disk in disks for partition in disk["partitions"]}
+    
+    wanted = set()
+    for pool_name, vdev, vdev_type, disk_child in iter_topology_disks(pool_data):
+        if not disk_child.get('disk'):
+            partition = os.path.basename(disk_child.get('device') or '')
+            if partition in partition_disks:
+                disk_child['disk'] = partition_disks[partition]
+        if disk_child.get('disk'):
+            wanted.add(disk_child['disk'])
+            disk = by_name.get(disk_child['disk'])
+            if disk is not None and disk["zfs_guid"] is None and disk_child.get('guid'):
+                disk["zfs_guid"] = str(disk_child['guid'])
+    missing = sorted(name for name in wanted
+                     if name not in by_name or not all(by_name[name].get(field) for field in SYSFS_REQUIRED_FIELDS))
+    if not missing:
+        return disks
+    
+    with TRACER.span("middleware", f"disk.query for {len(missing)} disks"):
+        records = client.query('disk.query', [['devname', 'in', missing]], select=DISK_QUERY_FIELDS)
+    for record in records:
+        disk = by_name.get(record.get('devname'))
+        if disk is None:
+            disks.append(record)
+            continue
+        for field, value in record.items():
+            if disk.get(field) in (None, "") and value not in (None, ""):
+                disk[field] = value
+    return disks
+
+def query_disks(client, pool_data, selection=None, sysfs_root=None):
+    """The disk records of the pools: disk.query, or the sysfs inventory when sysfs_root is set"""
+    if sysfs_root is not None:
+        return sysfs_disk_inventory(client, pool_data, sysfs_root)
+    return client.query('disk.query', (selection or ALL_DISKS).disk_filters(), select=DISK_QUERY_FIELDS)
+
+def iter_vdev_disks(vdev):
+    """Yield the DISK entries below a vdev in display order"""
+    for child in vdev.get('children', []):
+        if child.get('type') == 'DISK':
+            yield child
+        else:
+            yield from iter_vdev_disks(child)
+
+class DiskSelection:
+    """The pools, vdevs and disks asked for with --pool/--vdev/--serial/--device.
+
+    Pools limit which pools are looked at; vdevs (by name or GUID), serials and
+    devices pick what to keep inside them, any of them matching is enough. The
+    topology is pruned before smartctl runs, so only selected disks are polled.
+    """
+
+    def __init__(self, pools=(), vdevs=(), serials=(), devices=()):
+        self.pools = set(pools or ())
+        self.vdevs = set(vdevs or ())
+        self.serials = set(serials or ())
+        self.devices = {device[5:] if device.startswith('/dev/') else device for device in devices or ()}
+
+    def pool_filters(self):
+        """pool.query filters, so middleware only returns the selected pools"""
+        return [['name', 'in', sorted(self.pools)]] if self.pools else []
+
+    def disk_filters(self):
+        """disk.query filters; only narrowed when disks are picked by serial alone"""
+        if self.serials and not (self.vdevs or self.devices):
+            return [['serial', 'in', sorted(self.serials)]]
+        return []
+
+    def _disk_selected(self, disk_child, guid_to_disk, devname_to_disk):
+        if disk_child.get('disk') in self.devices or disk_child.get('device') in self.devices:
+            return True
+        disk_info = lookup_disk_info(disk_child, guid_to_disk, devname_to_disk)
+        return disk_info.get('serial') in self.serials
+
+    def _select_vdev(self, vdev, guid_to_disk, devname_to_disk):
+        """Return the vdev pruned to the selected parts, or None"""
+        if vdev.get('name') in self.vdevs or str(vdev.get('guid')) in self.vdevs:
+            return vdev
+        if vdev.get('type') == 'DISK':
+            return vdev if self._disk_selected(vdev, guid_to_disk, devname_to_disk) else None
+        children = [child for child in (self._select_vdev(child, guid_to_disk, devname_to_disk)
+                                        for child in vdev.get('children', [])) if child is not None]
+        return dict(vdev, children=children) if children else None
+
+    def select(self, pool_data, guid_to_disk, devname_to_disk):
+        """Return pool_data reduced to the selection"""
+        selected = []
+        for pool in pool_data:
+            if self.pools and pool.get('name') not in self.pools:
+                continue
+            if not (self.vdevs or self.serials or self.devices):
+                selected.append(pool)
+                continue
+            topology = {}
+            for vdev_type, vdev_list in pool.get('topology', {}).items():
+                topology[vdev_type] = [vdev for vdev in (self._select_vdev(vdev, guid_to_disk, devname_to_disk)
+                                                         for vdev in vdev_list) if vdev is not None]
+            if any(topology.values()):
+                selected.append(dict(pool, topology=topology))
+        return selected
+
+# Selects everything
+ALL_DISKS = DiskSelection()
+
+def iter_topology_disks(pool_data):
+    """Yield (pool name, parent vdev, vdev type, disk child) for every disk in the pools"""
+    def walk(pool_name, vdev, vdev_type):
+        for child in vdev.get('children', []):
+            if child.get('type') == 'DISK':
+                yield pool_name, vdev, vdev_type, child
+            else:
+                yield from walk(pool_name, child, child.get('type', 'UNKNOWN'))
+    
+    for pool in pool_data:
+        for vdev_type, vdev_list in pool.get('topology', {}).items():
+            for vdev in vdev_list:
+                yield from walk(pool.get('name', 'UNKNOWN'), vdev, vdev_type)
+
+def collect_pool_disks(pool_data, guid_to_disk, devname_to_disk):
+    """Return (device, disk_info) pairs for every disk in the pools, without duplicates"""
+    disks = []
+    seen = set()
+    for pool in pool_data:
+        for vdev_list in pool.get('topology', {}).values():
+            for vdev in vdev_list:
+                for child in iter_vdev_disks(vdev):
+                    whole_disk = child.get('disk')
+                    if not whole_disk or whole_disk in seen:
+                        continue
+                    seen.add(whole_disk)
+                    disks.append((whole_disk, lookup_disk_info(child, guid_to_disk, devname_to_disk)))
+    return disks
+
+# zpool iostat -l columns after the vdev name; with -p the waits are in nanoseconds
+IOSTAT_COLUMNS = ('alloc', 'free', 'read_ops', 'write_ops', 'read_bytes', 'write_bytes',
+                  'total_wait_read', 'total_wait_write', 'disk_wait_read', 'disk_wait_write',
+                  'syncq_wait_read', 'syncq_wait_write', 'asyncq_wait_read', 'asyncq_wait_write',
+                  'scrub_wait', 'trim_wait', 'rebuild_wait')
+# Below this many operations per second a disk's latency is too noisy to compare
+LATENCY_MIN_OPS = 2
+# Disks under these vdevs are in the middle of being swapped, their load is not comparable
+LATENCY_SKIP_VDEVS = ('SPARE', 'REPLACING')
+
+def parse_zpool_iostat(output, pool_name):
+    """Return {vdev GUID: stats} from the last report in `zpool iostat -v -l -p -H -g` output.
+
+    With an interval the first report covers the time since import and the
+    last one only the interval, so the last one is used.
+    """
+    reports = []
+    for line in output.splitlines():
+        fields = line.split()
+        if len(fields) < 11:
+            continue
+        if fields[0] == pool_name:
+            reports.append({})
+        if reports:
+            reports[-1][fields[0]] = {column: int(value) if value.isdigit() else None
+                                      for column, value in zip(IOSTAT_COLUMNS, fields[1:])}
+    return reports[-1] if reports else {}
+
+def compare_vdev_latency(pool_data, samples, min_ratio=2.0, min_ms=5.0):
+    """Compare every disk's device latency with the other disks in its vdev.
+
+    samples maps vdev GUIDs to parse_zpool_iostat() stats. Returns {disk GUID:
+    latency entry}; a direction is in "slow" when the disk's average wait is
+    at least min_ratio times the median of its peers and min_ms above it.
+    """
+    import statistics
+    groups = {}
+    for pool_name, vdev, vdev_type, disk_child in iter_topology_disks(pool_data):
+        groups.setdefault(id(vdev), (vdev, []))[1].append(disk_child)
+    
+    latency = {}
+    for vdev, disk_children in groups.values():
+        measured = {}
+        for disk_child in disk_children:
+            stats = samples.get(str(disk_child.get('guid')))
+            if not stats:
+                continue
+            entry = {"read_ops": stats['read_ops'], "write_ops": stats['write_ops'], "slow": []}
+            for direction in ('read', 'write'):
+                wait = stats[f'disk_wait_{direction}']
+                enough = (stats[f'{direction}_ops'] or 0) >= LATENCY_MIN_OPS and wait is not None
+                entry[f"{direction}_ms"] = round(wait / 1e6, 3) if enough else None
+            measured[str(disk_child.get('guid'))] = entry
+        
+        for guid, entry in measured.items():
+            for direction in ('read', 'write'):
+                peers = [other[f"{direction}_ms"] for other_guid, other in measured.items()
+                         if other_guid != guid and other[f"{direction}_ms"] is not None]
+                peer_ms = round(statistics.median(peers), 3) if peers else None
+                entry[f"peer_{direction}_ms"] = peer_ms
+                value = entry[f"{direction}_ms"]
+                if (value is None or peer_ms is None or vdev.get('type') in LATENCY_SKIP_VDEVS):
+                    continue
+                if value >= peer_ms * min_ratio and value - peer_ms >= min_ms:
+                    entry["slow"].append(direction)
+            latency[guid] = entry
+    return latency
+
+class LatencySampler:
+    """Samples per-disk latency with zpool iostat while the SMART data is collected.
+
+    Every pool is sampled over `interval` seconds at the same time, then each
+    disk is compared with its vdev peers by compare_vdev_latency().
+    """
+
+    def __init__(self, interval=5, min_ratio=2.0, min_ms=5.0):
+        self.interval = interval
+        self.min_ratio = min_ratio
+        self.min_ms = min_ms
+
+    def sample_pool(self, pool_name, transport=None):
+        """Return the iostat stats of a pool's vdevs over the interval, {} if zpool failed"""
+        transport = transport or LOCAL_TRANSPORT
+        argv = ["zpool", "iostat", "-v", "-l", "-p", "-H", "-g", pool_name, str(self.interval), "2"]
+        try:
+            with TRACER.span("latency", pool_name, host=transport.name):
+                result = transport.run(argv, timeout=self.interval + 60)
+        except (OSError, subprocess.TimeoutExpired) as e:
+            print(f"\033[1;31mError sampling latency of {pool_name}: {str(e)}\033[0m")
+            return {}
+        if result.returncode != 0:
+            print(f"\033[1;31mError sampling latency of {pool_name}: {result.stderr.strip()}\033[0m")
+            return {}
+        return parse_zpool_iostat(result.stdout, pool_name)
+
+    def sample(self, pool_data, transport=None):
+        """Sample all pools and return {disk GUID: latency entry}"""
+        from concurrent.futures import ThreadPoolExecutor
+        samples = {}
+        pool_names = [pool.get('name') for pool in pool_data if pool.get('name')]
+        if pool_names:
+            with ThreadPoolExecutor(max_workers=len(pool_names)) as pool:
+                for pool_samples in pool.map(lambda name: self.sample_pool(name, transport), pool_names):
+                    samples.update(pool_samples)
+        return compare_vdev_latency(pool_data, samples, self.min_ratio, self.min_ms)
+
+    def start(self, pool_data, transport=None):
+        """Start sampling in the background and return its Future"""
+        from concurrent.futures import ThreadPoolExecutor
+        executor = ThreadPoolExecutor(max_workers=1)
+        future = executor.submit(self.sample, pool_data, transport)
+        executor.shutdown(wait=False)
+        return future
+
+# Parts of a disk's SMART data that move on their own and do not count as a change
+VOLATILE_SMART_FIELDS = ('captured', 'cached', 'power_on_hours', 'attributes', 'error_counters',
+                         'health_log')
+
+def iter_disk_entries(vdev_entry):
+    """Yield (vdev_entry, disk_entry) for the disks below a vdev entry"""
+    for disk_entry in vdev_entry["children"]:
+        yield vdev_entry, disk_entry
+    for child_entry in vdev_entry.get("vdevs", []):
+        yield from iter_disk_entries(child_entry)
+
+def disk_signature(disk_entry):
+    """Summarize the parts of a disk entry that matter when looking for changes"""
+    smart_data = {key: value for key, value in (disk_entry["smart_data"] or {}).items()
+                  if key not in VOLATILE_SMART_FIELDS}
+    if 'last_test' in smart_data:
+        smart_data['last_test'] = {key: value for key, value in smart_data['last_test'].items()
+                                   if key != 'time_since'}
+    return json.dumps([disk_entry["disk"], disk_entry["serial"], disk_entry["errors"],
+                       smart_data, disk_entry["warnings"]], sort_keys=True, default=str)
+
+def smart_result_due(result, max_age, now):
+    """Whether a disk needs smartctl again: never read, in standby, failed or
+    timed out last time (all worth retrying soon), or read max_age seconds ago"""
+    return (result is None or result.get('standby') or result.get('timed_out')
+            or result['output'].startswith("Error") or now - result['captured'] >= max_age)
+
+class DiskWatcher:
+    """Keeps the topology and disk index in memory and refreshes them incrementally.
+
+    Every poll re-reads the pools (cheap, over the open middleware connection) to
+    pick up ZFS error counters, but only runs smartctl for disks whose SMART data
+    is older than smart_interval. Disks that were in standby, or whose smartctl
+    failed or timed out, are checked again every poll, so a transient failure
+    or a disk spun up by something else is picked up on the next cycle.
+    poll() returns the disks whose data changed. Errors that do not stop a
+    poll (saving the cache or history) are printed, or passed to on_error.
+    """
+
+    def __init__(self, client, collector, smart_interval=3600, history=None, trend_window=7,
+                 selection=None, rules=None, sysfs_root=None):
+        self.client = client
+        self.selection = selection or ALL_DISKS
+        self.rules = rules
+        self.sysfs_root = sysfs_root
+        self.collector = collector
+        self.smart_interval = smart_interval
+        self.history = history
+        self.trend_window = trend_window
+        self.trends = None
+        self.guid_to_disk = {}
+        self.devname_to_disk = {}
+        self.smart_results = {}
+        self.pool_entries = []
+        self.vdev_disks = {}
+        self._signatures = {}
+        self._unresolved = None
+        self.on_error = None
+
+    def error(self, message):
+        if self.on_error is None:
+            print(f"\033[1;31m{message}\033[0m")
+        else:
+            self.on_error(message)
+
+    def refresh_index(self, pool_data=()):
+        """Re-read disk.query, e.g. after a disk was added or replaced"""
+        disk_data = query_disks(self.client, pool_data, self.selection, self.sysfs_root)
+        self.guid_to_disk, self.devname_to_disk = build_disk_index(disk_data)
+
+    def poll(self, on_disk=None):
+        """Run one refresh cycle and return the changed (pool, vdev, disk) entries.
+
+        on_disk(pool name, vdev name, vdev type, disk entry) is called for every
+        disk whose smartctl finishes, before the whole report is rebuilt.
+        """
+        all_pools = self.client.query('pool.query', self.selection.pool_filters(), select=POOL_QUERY_FIELDS)
+        pool_data = self.selection.select(all_pools, self.guid_to_disk, self.devname_to_disk)
+        disks = collect_pool_disks(pool_data, self.guid_to_disk, self.devname_to_disk)
+        
+        # Only go back to disk.query when a disk shows up that the index doesn't know
+        unresolved = {device for device, disk_info in disks if not disk_info}
+        if self._unresolved is None or not unresolved <= self._unresolved:
+            self.refresh_index(all_pools)
+            pool_data = self.selection.select(all_pools, self.guid_to_disk, self.devname_to_disk)
+            disks = collect_pool_disks(pool_data, self.guid_to_disk, self.devname_to_disk)
+            unresolved = {device for device, disk_info in disks if not disk_info}
+        self._unresolved = unresolved
+        self.vdev_disks = {str(disk_child.get('guid')): (pool_name, disk_child.get('disk'))
+                           for pool_name, vdev, vdev_type, disk_child in iter_topology_disks(pool_data)}
+        
+        now = time.time()
+        due = [(device, disk_info) for device, disk_info in disks
+               if smart_result_due(self.smart_results.get(device), self.smart_interval, now)]
+        on_result = None
+        if on_disk is not None:
+            placements = {}
+            for pool_name, vdev, vdev_type, disk_child in iter_topology_disks(pool_data):
+                placements.setdefault(disk_child.get('disk'), []).append((pool_name, vdev, vdev_type, disk_child))
+            
+            def on_result(device, result):
+                for pool_name, vdev, vdev_type, disk_child in placements.get(device, []):
+                    disk_entry = build_disk_entry(disk_child, self.guid_to_disk, self.devname_to_disk,
+                                                  {device: result}, self.trends, rules=self.rules)
+                    on_disk(pool_name, vdev.get('name', 'UNKNOWN'), vdev_type, disk_entry)
+        if due:
+            self.smart_results.update(self.collector.collect(due, on_result))
+            if self.collector.cache is not None:
+                try:
+                    with TRACER.span("cache"):
+                        self.collector.cache.save()
+                except OSError as e:
+                    self.error(f"Error saving SMART cache: {str(e)}")
+        if self.history is not None and (due or self.trends is None):
+            self.trends = update_history(self.history, disks, self.smart_results, self.trend_window,
+                                         on_error=self.on_error)
+        
+        self.pool_entries = build_pool_entries(pool_data, self.guid_to_disk, self.devname_to_disk,
+                                               self.smart_results, self.trends, rules=self.rules)
+        changed, self._signatures = self._changes(self.pool_entries)
+        return changed
+
+    def _changes(self, pool_entries):
+        """The disks of pool_entries that differ from the last report, and their new signatures"""
+        changed = []
+        signatures = {}
+        for pool_entry in pool_entries:
+            for top_entry in pool_entry["vdevs"]:
+                for vdev_entry, disk_entry in iter_disk_entries(top_entry):
+                    key = (pool_entry["name"], str(disk_entry["zfs_guid"]))
+                    signatures[key] = disk_signature(disk_entry)
+                    if self._signatures.get(key) != signatures[key]:
+                        changed.append((pool_entry, vdev_entry, disk_entry))
+        return changed, signatures
+
+    def locate(self, event):
+        """The (pool name, device) a ZFS event is about, None if it is not about a known disk"""
+        guid = event.get('vdev_guid')
+        if guid is not None:
+            if str(guid) in self.vdev_disks:
+                return self.vdev_disks[str(guid)]
+            disk_info = self.guid_to_disk.get(str(guid))
+            if disk_info and event.get('pool'):
+                return event['pool'], disk_info.get('devname')
+        # Events of a vdev that is not in the topology yet only carry its path
+        disk_info = self.devname_to_disk.get(os.path.basename(event.get('vdev_path') or ''))
+        if disk_info and event.get('pool'):
+            return event['pool'], disk_info.get('devname')
+        return None
+
+    def refresh_disks(self, targets, min_age=0):
+        """Refresh only some disks and return the changed entries like poll().
+
+        targets maps pool names to devices: only those pools are re-read (for
+        their ZFS state and error counters) and only those devices get
+        smartctl, unless their SMART data is less than min_age seconds old.
+        """
+        filters = self.selection.pool_filters() + [['name', 'in', sorted(targets)]]
+        pools = self.client.query('pool.query', filters, select=POOL_QUERY_FIELDS)
+        pool_data = self.selection.select(pools, self.guid_to_disk, self.devname_to_disk)
+        devices = set().union(*targets.values())
+        now = time.time()
+        disks = [(device, disk_info) for device, disk_info
+                 in collect_pool_disks(pool_data, self.guid_to_disk, self.devname_to_disk)
+                 if device in devices]
+        due = [(device, disk_info) for device, disk_info in disks
+               if smart_result_due(self.smart_results.get(device), min_age, now)]
+        if due:
+            self.smart_results.update(self.collector.collect(due))
+            if self.collector.cache is not None:
+                try:
+                    with TRACER.span("cache"):
+                        self.collector.cache.save()
+                except OSError as e:
+                    self.error(f"Error saving SMART cache: {str(e)}")
+            if self.history is not None:
+                trends = update_history(self.history, due, self.smart_results, self.trend_window, prune=False,
+                                        on_error=self.on_error)
+                if trends is not None:
+                    self.trends = {**(self.trends or {}), **trends}
+        for pool_name, vdev, vdev_type, disk_child in iter_topology_disks(pool_data):
+            self.vdev_disks[str(disk_child.get('guid'))] = (pool_name, disk_child.get('disk'))
+        
+        pool_entries = build_pool_entries(pool_data, self.guid_to_disk, self.devname_to_disk,
+                                          self.smart_results, self.trends, rules=self.rules)
+        refreshed = {pool_entry["name"]: pool_entry for pool_entry in pool_entries}
+        self.pool_entries = [refreshed.pop(pool_entry["name"], pool_entry) for pool_entry in self.pool_entries]
+        self.pool_entries.extend(refreshed.values())
+        changed, signatures = self._changes(pool_entries)
+        self._signatures = {key: signature for key, signature in self._signatures.items()
+                            if key[0] not in targets}
+        self._signatures.update(signatures)
+        return changed
+
+def write_json(path, report):
+    """Write a report, replacing the previous file atomically"""
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with TRACER.span("json", path):
+        with open(temp_path, 'w') as f:
+            json.dump(report, f, indent=4)
+        os.replace(temp_path, path)
+
+def print_changes(changed, timestamp):
+    """Print the disks that changed since the last cycle under a timestamped banner"""
+    print(f"\n\033[1;36m{' ' + timestamp + ': ' + str(len(changed)) + ' disk(s) changed ':=^80}\033[0m")
+    for pool_entry, vdev_entry, disk_entry in changed:
+        print(f"\n  \033[1;33mPOOL: {pool_entry['name']}  VDEV: {vdev_entry['name']} ({vdev_entry['type'].upper()})\033[0m")
+        print_disk(disk_entry, 2)
+
+def run_watch(watcher, interval, json_path=None):
+    """Poll until interrupted, printing the full tree once and then only changed disks"""
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    first_cycle = True
+    try:
+        while not stop.is_set():
+            try:
+                changed = watcher.poll()
+            except MiddlewareError as e:
+                print(f"\033[1;31mError fetching data: {str(e)}\033[0m")
+                changed = None
+            
+            if changed is not None:
+                timestamp = datetime.now().isoformat(timespec='seconds')
+                if first_cycle:
+                    for pool_entry in watcher.pool_entries:
+                        print_pool(pool_entry)
+                    first_cycle = False
+                elif changed:
+                    print_changes(changed, timestamp)
+                
+                if changed and json_path:
+                    try:
+                        write_json(json_path, new_report(watcher.pool_entries))
+                    except Exception as e:
+                        print(f"\n\033[1;31mError saving JSON: {str(e)}\033[0m")
+            sys.stdout.flush()
+            stop.wait(interval)
+    except KeyboardInterrupt:
+        pass
+
+# `zpool events -v`: a "<date> <class>" line, then indented "name = value" fields
+ZFS_EVENT_HEADER = re.compile(r"^(\w{3} +\d+ \d{4} [\d:.]+) +(\S+)$")
+ZFS_EVENT_FIELD = re.compile(r"^\s+(\S+) = (.*)$")
+# Events after which the pools are swept in full, since disks came or went
+ZFS_TOPOLOGY_EVENTS = ('sysevent.fs.zfs.vdev_add', 'sysevent.fs.zfs.vdev_remove', 'sysevent.fs.zfs.vdev_attach',
+                       'sysevent.fs.zfs.pool_create', 'sysevent.fs.zfs.pool_destroy', 'sysevent.fs.zfs.pool_import',
+                       'sysevent.fs.zfs.pool_export', 'sysevent.fs.zfs.resilver_finish')
+# A disk flooding delay or io events gets smartctl at most this often
+ZFS_EVENT_SMART_COOLDOWN = 60
+
+def zfs_event_value(value):
+    """A quoted string, a hex number as an int, anything else (arrays, timestamps) as is"""
+    if value.startswith('"'):
+        return value[1:value.find('"', 1)]
+    if re.fullmatch(r"0x[0-9a-f]+", value):
+        return int(value, 16)
+    return value
+
+def parse_zfs_events(lines):
+    """Yield the events of `zpool events -v` output as dicts of their class and top-level fields.
+
+    Works on a live `zpool events -f` stream: an event is yielded at the blank
+    line that ends it. Embedded nvlists such as the detector are skipped.
+    """
+    event = None
+    depth = 0
+    for line in lines:
+        line = line.rstrip('\n')
+        header = ZFS_EVENT_HEADER.match(line)
+        if header:
+            if event is not None:
+                yield event
+            event = {"class": header.group(2)}
+            depth = 0
+            continue
+        if event is None:
+            continue
+        stripped = line.strip()
+        if not stripped:
+            yield event
+            event = None
+        elif stripped.startswith("(end "):
+            depth = max(0, depth - 1)
+        elif stripped.startswith("(start "):
+            depth += 1
+        else:
+            field = ZFS_EVENT_FIELD.match(line)
+            if field is None:
+                continue
+            name, value = field.groups()
+            if value == "(embedded nvlist)":
+                depth += 1
+            elif depth == 0:
+                event[name] = zfs_event_value(value)
+    if event is not None:
+        yield event
+
+def zfs_event_time(event):
+    """The event's time in seconds since the epoch, None if it has none"""
+    words = str(event.get('time', '')).split()
+    try:
+        return int(words[0], 16) if words else None
+    except ValueError:
+        return None
+
+def plan_event_refresh(watcher, events):
+    """Turn a batch of ZFS events into ({pool: devices} to refresh, whether to sweep every pool)"""
+    targets = {}
+    sweep = False
+    for event in events:
+        if event["class"] in ZFS_TOPOLOGY_EVENTS:
+            sweep = True
+            continue
+        if event.get('vdev_guid') is None and not event.get('vdev_path'):
+            continue
+        located = watcher.locate(event)
+        if located is not None:
+            pool_name, device = located
+            targets.setdefault(pool_name, set()).add(device)
+        elif event.get('pool') in {pool_entry["name"] for pool_entry in watcher.pool_entries}:
+            # A raidz or mirror vdev changed state: its pool's counters, no smartctl
+            targets.setdefault(event['pool'], set())
+    return targets, sweep
+
+def run_events(watcher, events_path=None, interval=None, json_path=None, batch=2):
+    """Refresh only the disks ZFS reports events about, until interrupted.
+
+    Follows `zpool events -f -v` (or replays a recorded stream from
+    events_path) and maps each event's vdev GUID to a disk. The events of
+    `batch` seconds are refreshed together: their pools are re-read and their
+    disks get smartctl. Disks added or removed trigger a full sweep, as does
+    every `interval` seconds if given.
+    """
+    stop = threading.Event()
+    events = queue.Queue()
+    
+    def stop_reading(signum, frame):
+        stop.set()
+        events.put(None)
+    signal.signal(signal.SIGTERM, stop_reading)
+    
+    process = None
+    since = None
+    if events_path:
+        stream = open(events_path)
+    else:
+        # The stream starts with every event still in the kernel's buffer; those are old news
+        try:
+            process = subprocess.Popen(["zpool", "events", "-f", "-v"], stdout=subprocess.PIPE,
+                                       stderr=subprocess.PIPE, text=True, start_new_session=True)
+        except OSError as e:
+            print(f"\033[1;31mError following zpool events: {str(e)}\033[0m")
+            return
+        stream = process.stdout
+        since = int(time.time())
+    
+    def read():
+        try:
+            for event in parse_zfs_events(stream):
+                if since is None or (zfs_event_time(event) or since) >= since:
+                    events.put(event)
+        except (OSError, ValueError):
+            pass
+        events.put(None)
+    
+    def report(changed):
+        if changed:
+            print_changes(changed, datetime.now().isoformat(timespec='seconds'))
+            if json_path:
+                try:
+                    write_json(json_path, new_report(watcher.pool_entries))
+                except Exception as e:
+                    print(f"\n\033[1;31mError saving JSON: {str(e)}\033[0m")
+        sys.stdout.flush()
+    
+    try:
+        try:
+            watcher.poll()
+        except MiddlewareError as e:
+            print(f"\033[1;31mError fetching data: {str(e)}\033[0m")
+            return
+        for pool_entry in watcher.pool_entries:
+            print_pool(pool_entry)
+        if json_path:
+            try:
+                write_json(json_path, new_report(watcher.pool_entries))
+            except Exception as e:
+                print(f"\n\033[1;31mError saving JSON: {str(e)}\033[0m")
+        sys.stdout.flush()
+        threading.Thread(target=read, name="zfs-events", daemon=True).start()
+        
+        next_sweep = time.monotonic() + interval if interval else None
+        finished = False
+        while not finished and not stop.is_set():
+            pending = []
+            try:
+                event = events.get(timeout=None if next_sweep is None else max(0, next_sweep - time.monotonic()))
+                if event is None:
+                    finished = True
+                else:
+                    pending.append(event)
+                    batch_end = time.monotonic() + batch
+                    while not finished:
+                        event = events.get(timeout=max(0, batch_end - time.monotonic()))
+                        if event is None:
+                            finished = True
+                        else:
+                            pending.append(event)
+            except queue.Empty:
+                pass
+            
+            targets, sweep = plan_event_refresh(watcher, pending)
+            if next_sweep is not None and time.monotonic() >= next_sweep:
+                sweep = True
+                next_sweep = time.monotonic() + interval
+            try:
+                if sweep:
+                    report(watcher.poll())
+                elif targets:
+                    report(watcher.refresh_disks(targets, ZFS_EVENT_SMART_COOLDOWN))
+            except MiddlewareError as e:
+                print(f"\033[1;31mError fetching data: {str(e)}\033[0m")
+        if process is not None and not stop.is_set():
+            # zpool exited on its own, e.g. no ZFS module or not root
+            error = process.stderr.read().strip()
+            print(f"\033[1;31mzpool events stopped{': ' + error if error else ''}\033[0m")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if process is not None and process.poll() is None:
+            LocalTransport.kill(process)
+        else:
+            stream.close()
+
+# Severity of a disk on the dashboard, most urgent first
+DASHBOARD_SEVERITIES = ('critical', 'slowdown', 'caution', 'error', 'ok')
+DASHBOARD_SORTS = ('topology', 'severity', 'errors', 'power-on', 'device')
+DASHBOARD_FILTERS = ('all', 'problems', 'critical')
+
+def disk_severity(disk_entry):
+    """The most urgent of a disk's warnings, "error" if SMART could not be read, else "ok\""""
+    warnings = disk_entry.get("warnings") or {}
+    for severity in ('critical', 'slowdown', 'caution'):
+        if warnings.get(severity):
+            return severity
+    if (disk_entry.get("smart_data") or {}).get("error"):
+        return "error"
+    return "ok"
+
+class DashboardRow:
+    """What the dashboard shows of one disk; the text is formatted once per change"""
+    __slots__ = ('pool', 'vdev', 'vdev_type', 'order', 'device', 'severity', 'errors', 'power_on_hours',
+                 'signature', 'cells')
+
+    def __init__(self, pool_name, vdev_name, vdev_type, order, disk_entry):
+        self.pool = pool_name
+        self.vdev = vdev_name
+        self.vdev_type = vdev_type
+        self.order = order
+        self.device = disk_entry.get("disk") or disk_entry.get("partition") or disk_label(disk_entry)
+        self.severity = disk_severity(disk_entry)
+        self.errors = sum(disk_entry["errors"].values())
+        smart_data = disk_entry.get("smart_data") or {}
+        power_on_hours = smart_data.get("power_on_hours")
+        self.power_on_hours = power_on_hours if isinstance(power_on_hours, int) else -1
+        self.signature = disk_signature(disk_entry)
+        
+        warnings = disk_entry.get("warnings") or {}
+        reasons = warnings.get("critical") or warnings.get("slowdown") or warnings.get("caution") or []
+        last_test = smart_data.get("last_test") or {}
+        if smart_data.get("error"):
+            test, reason = "", smart_data["error"].splitlines()[0]
+        else:
+            test = f"{last_test.get('description', 'N/A')}, {last_test.get('time_since', 'N/A')}"
+            reason = reasons[0] + (f" (+{len(reasons) - 1})" if len(reasons) > 1 else "") if reasons else ""
+        errors = disk_entry["errors"]
+        self.cells = (self.severity.upper(), self.device, str(disk_entry.get("serial", "")),
+                      str(smart_data.get("health_status", "")),
+                      f"{errors['read']}/{errors['write']}/{errors['checksum']}",
+                      str(power_on_hours) if self.power_on_hours >= 0 else "", test, reason)
+
+class Dashboard:
+    """The state of the live view: one row per pool disk, sorted and filtered
+    for display. Collection threads update rows, the screen loop reads them."""
+    columns = (("SEVERITY", 9), ("DEVICE", 10), ("SERIAL", 21), ("HEALTH", 7), ("ZFS R/W/C", 11),
+               ("POH", 7), ("LAST TEST", 30), ("REASON", 0))
+
+    def __init__(self):
+        self.rows = {}
+        self.sort = 0
+        self.filter = 0
+        self.status = "Collecting..."
+        self.updated = None
+        self.dirty = True
+        self._view = None
+        self._lock = threading.Lock()
+
+    def disk(self, pool_name, vdev_name, vdev_type, disk_entry):
+        """Update one disk; only a row whose data changed is redrawn"""
+        key = (pool_name, str(disk_entry["zfs_guid"]))
+        with self._lock:
+            current = self.rows.get(key)
+            order = current.order if current is not None else len(self.rows)
+            row = DashboardRow(pool_name, vdev_name, vdev_type, order, disk_entry)
+            if current is None or current.signature != row.signature or current.cells != row.cells:
+                self.rows[key] = row
+                self._view = None
+                self.dirty = True
+
+    def replace(self, pool_entries):
+        """Take the disks of a full refresh, dropping the ones that left the pools"""
+        keys = set()
+        order = 0
+        for pool_entry in pool_entries:
+            for top_entry in pool_entry["vdevs"]:
+                for vdev_entry, disk_entry in iter_disk_entries(top_entry):
+                    key = (pool_entry["name"], str(disk_entry["zfs_guid"]))
+                    keys.add(key)
+                    self.disk(pool_entry["name"], vdev_entry["name"], vdev_entry["type"], disk_entry)
+                    # Topology order comes from the full report, not from when smartctl finished
+                    with self._lock:
+                        self.rows[key].order = order
+                    order += 1
+        with self._lock:
+            for key in set(self.rows) - keys:
+                del self.rows[key]
+            self._view = None
+            self.updated = datetime.now().strftime('%H:%M:%S')
+            self.dirty = True
+
+    def set_status(self, status):
+        with self._lock:
+            self.status = status
+            self.dirty = True
+
+    def cycle(self, sort=0, filter=0):
+        with self._lock:
+            self.sort = (self.sort + sort) % len(DASHBOARD_SORTS)
+            self.filter = (self.filter + filter) % len(DASHBOARD_FILTERS)
+            self._view = None
+            self.dirty = True
+
+    def view(self):
+        """The rows to show, as ("pool"|"vdev"|"disk", text or row), sorted and filtered"""
+        with self._lock:
+            if self._view is not None:
+                return self._view
+            rows = list(self.rows.values())
+            sort, filter = DASHBOARD_SORTS[self.sort], DASHBOARD_FILTERS[self.filter]
+        if filter == "problems":
+            rows = [row for row in rows if row.severity != "ok"]
+        elif filter == "critical":
+            rows = [row for row in rows if row.severity == "critical"]
+        
+        if sort == "topology":
+            rows.sort(key=lambda row: row.order)
+            view = []
+            pool = vdev = None
+            for row in rows:
+                if row.pool != pool:
+                    pool, vdev = row.pool, None
+                    view.append(("pool", f"POOL: {pool}"))
+                if row.vdev != vdev:
+                    vdev = row.vdev
+                    view.append(("vdev", f"  {vdev} ({row.vdev_type.upper()})"))
+                view.append(("disk", row))
+        else:
+            rank = {severity: i for i, severity in enumerate(DASHBOARD_SEVERITIES)}
+            keys = {
+                "severity": lambda row: (rank[row.severity], -row.errors, row.order),
+                "errors": lambda row: (-row.errors, rank[row.severity], row.order),
+                "power-on": lambda row: (-row.power_on_hours, row.order),
+                "device": lambda row: (len(row.device), row.device, row.pool),
+            }
+            rows.sort(key=keys[sort])
+            view = [("disk", row) for row in rows]
+        with self._lock:
+            self._view = view
+        return view
+
+    def header(self):
+        counts = {}
+        for row in list(self.rows.values()):
+            counts[row.severity] = counts.get(row.severity, 0) + 1
+        summary = "  ".join(f"{severity}: {counts[severity]}" for severity in DASHBOARD_SEVERITIES if counts.get(severity))
+        updated = f"updated {self.updated}" if self.updated else ""
+        return (f"diskmapper  {len(self.rows)} disks  {summary}  |  sort: {DASHBOARD_SORTS[self.sort]}  "
+                f"filter: {DASHBOARD_FILTERS[self.filter]}  |  {self.status} {updated}")
+
+    def format_row(self, row, indent):
+        parts = []
+        for (heading, width), cell in zip(self.columns, row.cells):
+            parts.append(cell.ljust(width - 1)[:width - 1] if width else cell)
+        if indent:
+            return "    " + " ".join(parts)
+        return f"{row.pool[:12]:<12} {row.vdev[:12]:<12} " + " ".join(parts)
+
+    def heading(self, indent):
+        parts = " ".join(heading.ljust(width - 1) if width else heading for heading, width in self.columns)
+        return "    " + parts if indent else f"{'POOL':<12} {'VDEV':<12} " + parts
+
+def run_dashboard(watcher, interval):
+    """Show the pool disks full-screen and keep them current until q is pressed.
+
+    A background thread polls the watcher every `interval` seconds; each disk
+    is updated as its smartctl finishes. Keys: s sort, f filter by severity,
+    r refresh now, arrows/PgUp/PgDn/Home/End scroll, q quit.
+    """
+    # Only needed here, and not every Python build has it
+    import curses
+    
+    dashboard = Dashboard()
+    stop = threading.Event()
+    wake = threading.Event()
+    # curses owns the terminal, so errors go to the status line instead of stdout
+    errors = []
+    watcher.on_error = errors.append
+    
+    def collect():
+        while not stop.is_set():
+            dashboard.set_status("Collecting...")
+            errors.clear()
+            try:
+                watcher.poll(dashboard.disk)
+                dashboard.replace(watcher.pool_entries)
+                dashboard.set_status("; ".join(errors + [f"next refresh in {interval}s"]))
+            except MiddlewareError as e:
+                dashboard.set_status(f"Error fetching data: {str(e)}")
+            except Exception as e:
+                # The thread has to live on, or the screen would silently stop updating
+                dashboard.set_status(f"Error refreshing: {type(e).__name__}: {str(e)}")
+            wake.wait(interval)
+            wake.clear()
+    
+    def screen(stdscr):
+        curses.curs_set(0)
+        curses.use_default_colors()
+        colors = {}
+        for pair, (name, color) in enumerate((("critical", curses.COLOR_RED), ("slowdown", curses.COLOR_MAGENTA),
+                                               ("caution", curses.COLOR_YELLOW), ("error", curses.COLOR_RED),
+                                               ("ok", curses.COLOR_GREEN), ("pool", curses.COLOR_CYAN),
+                                               ("vdev", curses.COLOR_YELLOW)), start=1):
+            curses.init_pair(pair, color, -1)
+            colors[name] = curses.color_pair(pair) | (curses.A_BOLD if name in ("critical", "pool") else 0)
+        stdscr.timeout(200)
+        top = 0
+        drawn = {}
+        
+        while True:
+            key = stdscr.getch()
+            height, width = stdscr.getmaxyx()
+            page = max(1, height - 3)
+            if key in (ord('q'), ord('Q'), 27):
+                return
+            if key == curses.KEY_RESIZE:
+                drawn.clear()
+                stdscr.clear()
+            elif key == ord('s'):
+                dashboard.cycle(sort=1)
+                top = 0
+            elif key == ord('f'):
+                dashboard.cycle(filter=1)
+                top = 0
+            elif key == ord('r'):
+                wake.set()
+            elif key in (curses.KEY_DOWN, ord('j')):
+                top += 1
+            elif key in (curses.KEY_UP, ord('k')):
+                top -= 1
+            elif key in (curses.KEY_NPAGE, ord(' ')):
+                top += page
+            elif key == curses.KEY_PPAGE:
+                top -= page
+            elif key == curses.KEY_HOME:
+                top = 0
+            elif key == curses.KEY_END:
+                top = len(dashboard.view())
+            elif key == -1 and not dashboard.dirty:
+                continue
+            dashboard.dirty = False
+            
+            view = dashboard.view()
+            top = max(0, min(top, len(view) - page))
+            indent = DASHBOARD_SORTS[dashboard.sort] == "topology"
+            lines = [(dashboard.header(), curses.A_REVERSE), (dashboard.heading(indent), curses.A_BOLD)]
+            for kind, item in view[top:top + page]:
+                if kind == "disk":
+                    lines.append((dashboard.format_row(item, indent), colors[item.severity]))
+                else:
+                    lines.append((item, colors[kind]))
+            lines.append((f"rows {top + 1}-{min(top + page, len(view))} of {len(view)}  "
+                          f"[s]ort [f]ilter [r]efresh [q]uit", curses.A_DIM))
+            
+            # Only the screen lines whose text changed are rewritten
+            for y in range(height):
+                line = lines[y] if y < len(lines) - 1 else (lines[-1] if y == height - 1 else ("", 0))
+                if drawn.get(y) == line:
+                    continue
+                drawn[y] = line
+                text, attr = line
+                try:
+                    stdscr.addnstr(y, 0, text.ljust(width), width - 1, attr)
+                except curses.error:
+                    pass
+            stdscr.refresh()
+    
+    collector = threading.Thread(target=collect, daemon=True)
+    collector.start()
+    try:
+        curses.wrapper(screen)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop.set()
+        wake.set()
+
+DEFAULT_SELFTEST_STATE_PATH = "/var/db/diskmapper/self-test-state.json"
+
+# How smartctl -a shows a self-test that is still running: ATA says how much is
+# left, NVMe how much is done, SCSI only lists it in the self-test log
+SELFTEST_REMAINING = re.compile(r"Self-test routine in progress\.\.\.\s*(\d+)% of test remaining")
+SELFTEST_COMPLETED = re.compile(r"Self-test status: (?!No )[^\n]*in progress \((\d+)% completed\)")
+SELFTEST_RUNNING = re.compile(r"Self-test routine in progress|Self-test status: (?!No )[^\n]*in progress|Self test in progress")
+# smartctl -t says the test has begun, or refuses to abort a test that is already running
+SELFTEST_BEGUN = re.compile(r"\btest(?:ing)? has begun", re.IGNORECASE)
+SELFTEST_BUSY = re.compile(r"Can't start self-test without aborting current test|in progress", re.IGNORECASE)
+SELFTEST_FINISHED = ('passed', 'failed', 'skipped', 'error')
+
+def pool_scan(pool):
+    """Return "scrub" or "resilver" while a pool is scanning (and not paused), else None"""
+    scan = pool.get('scan') or {}
+    if scan.get('state') == 'SCANNING' and not scan.get('pause'):
+        return (scan.get('function') or 'scan').lower()
+    return None
+
+def self_test_passed(status):
+    """Whether a self-test log status means the test found nothing"""
+    status = (status or '').lower()
+    return 'without error' in status or 'success' in status or status == 'completed'
+
+class SelfTestScheduler:
+    """Runs SMART self-tests on the pool disks a few at a time.
+
+    At most per_vdev disks of a top-level vdev and per_pool disks of a pool
+    (0 for no limit) test at once, and a pool that is scrubbing or resilvering
+    gets no new tests until the scan is done. Running tests are polled every
+    poll_interval seconds. The progress is kept in a JSON state file, so a run
+    that was interrupted picks up where it stopped: the drives carry on with
+    their tests meanwhile and are polled again, finished disks are not retested.
+    """
+
+    def __init__(self, client, test_type="short", per_vdev=1, per_pool=0, poll_interval=60,
+                 state_path=DEFAULT_SELFTEST_STATE_PATH, skip_days=0, selection=None, transport=None, timeout=None,
+                 sysfs_root=None):
+        self.client = client
+        self.test_type = test_type
+        self.per_vdev = per_vdev
+        self.per_pool = per_pool
+        self.poll_interval = poll_interval
+        self.state_path = state_path
+        self.skip_days = skip_days
+        self.selection = selection or ALL_DISKS
+        self.transport = transport or LOCAL_TRANSPORT
+        self.timeout = timeout
+        self.sysfs_root = sysfs_root
+        self.state = None
+        self.guid_to_disk = {}
+        self.devname_to_disk = {}
+        self.placements = {}
+        self.scanning = {}
+
+    def log(self, message, color="1;36"):
+        print(f"\033[{color}m[{datetime.now().strftime('%H:%M:%S')}] {message}\033[0m")
+        sys.stdout.flush()
+
+    def load_state(self):
+        """Resume the run in the state file if it is unfinished and for the same test, else start a new one"""
+        try:
+            with open(self.state_path) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            state = None
+        if (isinstance(state, dict) and state.get('test_type') == self.test_type
+                and any(disk.get('state') not in SELFTEST_FINISHED for disk in state.get('disks', {}).values())):
+            done = sum(disk.get('state') in SELFTEST_FINISHED for disk in state['disks'].values())
+            self.log(f"Resuming the {self.test_type} self-test run started {state.get('created')}: "
+                     f"{done} of {len(state['disks'])} disks done")
+            self.state = state
+        else:
+            self.state = {"test_type": self.test_type, "created": datetime.now().isoformat(timespec='seconds'),
+                          "disks": {}}
+        return self
+
+    def save_state(self):
+        """Replace the state file atomically"""
+        private_directory(os.path.dirname(self.state_path))
+        temp_path = f"{self.state_path}.{os.getpid()}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(self.state, f, indent=4)
+        os.replace(temp_path, self.state_path)
+
+    def _placements(self, pool_data):
+        """{cache key: where the disk sits} for the disks of the pools"""
+        placements = {}
+        for pool in pool_data:
+            pool_name = pool.get('name', 'UNKNOWN')
+            for vdev_list in pool.get('topology', {}).values():
+                for vdev in vdev_list:
+                    # Limits count per top-level vdev, whatever is nested below it
+                    vdev_name = vdev.get('name') or vdev.get('guid') or 'UNKNOWN'
+                    for child in iter_vdev_disks(vdev):
+                        device = child.get('disk')
+                        if not device:
+                            continue
+                        disk_info = lookup_disk_info(child, self.guid_to_disk, self.devname_to_disk)
+                        key = get_cache_key(disk_info) or device
+                        placements.setdefault(key, {"device": device, "pool": pool_name, "vdev": vdev_name,
+                                                    "serial": disk_info.get('serial')})
+        return placements
+
+    def refresh(self):
+        """Re-read the pools: where every disk sits now and which pools are scanning.
+
+        Every pool is read, not only the selected ones, so a resumed run can
+        tell a disk that left the pools from one this run's selection leaves out.
+        """
+        all_pools = self.client.query('pool.query', [], select=POOL_QUERY_FIELDS)
+        if not self.guid_to_disk:
+            disk_data = query_disks(self.client, all_pools, ALL_DISKS, self.sysfs_root)
+            self.guid_to_disk, self.devname_to_disk = build_disk_index(disk_data)
+        pool_data = self.selection.select(all_pools, self.guid_to_disk, self.devname_to_disk)
+        
+        self.scanning = {pool.get('name'): pool_scan(pool) for pool in all_pools}
+        self.placements = self._placements(pool_data)
+        present = self._placements(all_pools)
+        
+        # Disks that joined the pools are tested too, disks that left are given up on; disks
+        # outside the selection keep their state for a later run that selects them
+        for key, placement in self.placements.items():
+            disk = self.state["disks"].setdefault(key, {"state": "pending", "progress": None, "started": None,
+                                                       "finished": None, "result": None})
+            disk.update(placement)
+        for key, disk in self.state["disks"].items():
+            if key not in present and disk['state'] not in SELFTEST_FINISHED:
+                disk.update(state="error", result="no longer in the pools",
+                            finished=datetime.now().isoformat(timespec='seconds'))
+
+    def smartctl(self, device, *options):
+        with smartctl_span(device, self.transport):
+            return self.transport.run(["sudo", "smartctl", *options, f"/dev/{device}"], self.timeout)
+
+    def poll(self, device):
+        """Return (running, progress %, parsed SMART data) for a device"""
+        result = self.smartctl(device, "-a")
+        if result.returncode & SMARTCTL_FATAL_STATUS:
+            lines = (result.stderr.strip() or result.stdout.strip()).splitlines()
+            raise OSError(lines[-1] if lines else f"smartctl exit status {result.returncode}")
+        output = result.stdout
+        remaining = SELFTEST_REMAINING.search(output)
+        if remaining:
+            return True, 100 - int(remaining.group(1)), None
+        completed = SELFTEST_COMPLETED.search(output)
+        if completed:
+            return True, int(completed.group(1)), None
+        if SELFTEST_RUNNING.search(output):
+            return True, None, None
+        return False, None, parse_smart_data(output)
+
+    def start(self, key, disk):
+        """Start the test on a disk, or adopt one that is already running"""
+        now = datetime.now().isoformat(timespec='seconds')
+        running, progress, smart_data = self.poll(disk['device'])
+        if running:
+            disk.update(state="running", progress=progress, started=now)
+            self.log(f"{disk['pool']} {disk['vdev']} {disk['device']}: a self-test is already running, waiting for it")
+            return
+        if self.skip_days:
+            last_test = smart_data.get('last_test', {})
+            days = calculate_days_since(smart_data.get('power_on_hours', 'N/A'), last_test.get('lifetime_hours', 'N/A'))
+            if isinstance(days, float) and days < self.skip_days and self_test_passed(last_test.get('status')):
+                disk.update(state="skipped", finished=now, result=f"last test passed {days:.0f} days ago")
+                self.log(f"{disk['pool']} {disk['vdev']} {disk['device']}: skipped, {disk['result']}", "1;34")
+                return
+        # The exit status also carries the disk's health bits, so go by what smartctl says
+        result = self.smartctl(disk['device'], "-t", self.test_type)
+        if not SELFTEST_BEGUN.search(result.stdout):
+            if SELFTEST_BUSY.search(result.stdout):
+                disk.update(state="running", progress=None, started=now)
+                self.log(f"{disk['pool']} {disk['vdev']} {disk['device']}: a self-test is already running, waiting for it")
+                return
+            lines = (result.stderr.strip() or result.stdout.strip()).splitlines()
+            disk.update(state="error", finished=now, result=lines[-1] if lines else f"exit status {result.returncode}")
+            self.log(f"{disk['pool']} {disk['vdev']} {disk['device']}: could not start the test: {disk['result']}",
+                     "1;31")
+            return
+        disk.update(state="running", progress=0, started=now)
+        self.log(f"{disk['pool']} {disk['vdev']} {disk['device']}: {self.test_type} self-test started")
+
+    def check(self, key, disk):
+        """Poll a running test and record its result once it is done"""
+        running, progress, smart_data = self.poll(disk['device'])
+        if running:
+            disk['progress'] = progress
+            return
+        status = smart_data.get('last_test', {}).get('status')
+        disk.update(state="passed" if self_test_passed(status) else "failed", progress=100, result=status,
+                    finished=datetime.now().isoformat(timespec='seconds'))
+        if disk['state'] == "passed":
+            self.log(f"{disk['pool']} {disk['vdev']} {disk['device']}: passed ({status})", "1;32")
+        else:
+            self.log(f"{disk['pool']} {disk['vdev']} {disk['device']}: FAILED ({status or 'no result'})", "1;31")
+
+    def step(self):
+        """Poll the running tests and start new ones where the limits allow; return
+        the number of disks still pending or running"""
+        self.refresh()
+        disks = self.state["disks"]
+        for key, disk in disks.items():
+            if disk['state'] == "running" and key in self.placements:
+                try:
+                    self.check(key, disk)
+                except (OSError, subprocess.SubprocessError) as e:
+                    self.log(f"{disk['pool']} {disk['vdev']} {disk['device']}: error polling the test: {str(e)}",
+                             "1;31")
+        
+        per_pool, per_vdev = {}, {}
+        for disk in disks.values():
+            if disk['state'] == "running":
+                per_pool[disk['pool']] = per_pool.get(disk['pool'], 0) + 1
+                per_vdev[(disk['pool'], disk['vdev'])] = per_vdev.get((disk['pool'], disk['vdev']), 0) + 1
+        for key, disk in disks.items():
+            if disk['state'] != "pending" or key not in self.placements:
+                continue
+            pool_name, vdev = disk['pool'], (disk['pool'], disk['vdev'])
+            if self.scanning.get(pool_name):
+                continue
+            if self.per_pool and per_pool.get(pool_name, 0) >= self.per_pool:
+                continue
+            if self.per_vdev and per_vdev.get(vdev, 0) >= self.per_vdev:
+                continue
+            try:
+                self.start(key, disk)
+            except (OSError, subprocess.SubprocessError) as e:
+                disk.update(state="error", result=str(e), finished=datetime.now().isoformat(timespec='seconds'))
+                self.log(f"{pool_name} {disk['vdev']} {disk['device']}: could not start the test: {str(e)}", "1;31")
+            if disk['state'] == "running":
+                per_pool[pool_name] = per_pool.get(pool_name, 0) + 1
+                per_vdev[vdev] = per_vdev.get(vdev, 0) + 1
+        self.save_state()
+        return sum(disk['state'] in ("pending", "running") for key, disk in disks.items() if key in self.placements)
+
+    def run(self):
+        """Test every disk, returning the state once all are done. Interrupting
+        leaves the state file for the next run to resume."""
+        self.load_state()
+        waiting_on = set()
+        last_status = None
+        try:
+            while True:
+                left = self.step()
+                if not left:
+                    break
+                selected = [self.state["disks"][key] for key in self.placements]
+                scanning = {name: scan for name, scan in self.scanning.items() if scan and any(
+                    disk['pool'] == name and disk['state'] == "pending" for disk in selected)}
+                for name in scanning.keys() - waiting_on:
+                    self.log(f"{name}: {scanning[name]} in progress, no new self-tests until it is done", "1;33")
+                waiting_on = set(scanning)
+                running = [disk for disk in selected if disk['state'] == "running"]
+                progress = ", ".join(f"{disk['device']} {disk['progress']}%" if disk['progress'] is not None
+                                     else disk['device'] for disk in running)
+                status = f"{len(running)} testing, {left - len(running)} waiting" + (f": {progress}" if progress else "")
+                if status != last_status:
+                    self.log(status, "0;37")
+                last_status = status
+                time.sleep(self.poll_interval)
+        except KeyboardInterrupt:
+            self.save_state()
+            self.log(f"Interrupted; running self-tests carry on, run again to resume from {self.state_path}", "1;33")
+            return self.state
+        
+        counts = {}
+        for key in self.placements:
+            state = self.state["disks"][key]['state']
+            counts[state] = counts.get(state, 0) + 1
+        self.log("Self-tests done: " + ", ".join(f"{count} {state}" for state, count in sorted(counts.items())),
+                 "1;31" if counts.get('failed') or counts.get('error') else "1;32")
+        return self.state
+
+# Exported metrics: name, help text, and how to read the value(s) from a disk entry
+EXPORTER_METRICS = (
+    ('diskmapper_zfs_errors', 'ZFS errors counted for the pool device'),
+    ('diskmapper_smart_healthy', 'SMART overall health passed (1) or not (0)'),
+    ('diskmapper_power_on_hours', 'Power on hours reported by SMART'),
+    ('diskmapper_smart_age_seconds', 'Age of the SMART data behind these metrics'),
+    ('diskmapper_disk_standby', 'Disk was in standby and not woken up to read SMART (1) or not (0)'),
+    ('diskmapper_smart_timed_out', 'The last smartctl call for the disk timed out and was killed (1) or not (0)'),
+    ('diskmapper_sas_corrected_errors', 'SAS errors corrected, by operation'),
+    ('diskmapper_sas_uncorrected_errors', 'SAS uncorrected errors, by operation'),
+    ('diskmapper_sas_grown_defects', 'Elements in the SAS grown defect list'),
+    ('diskmapper_nvme_media_errors', 'NVMe media and data integrity errors'),
+    ('diskmapper_nvme_error_log_entries', 'NVMe error information log entries'),
+    ('diskmapper_sata_offline_uncorrectable', 'SATA offline uncorrectable sectors (SMART 198)'),
+    ('diskmapper_sata_udma_crc_errors', 'SATA UDMA CRC error count (SMART 199)'),
+    ('diskmapper_warnings', 'Number of warning reasons, by severity'),
+    ('diskmapper_smart_test_overdue', 'Last SMART self-test is older than 60 days'),
+)
+
+METRIC_LABEL_ESCAPES = str.maketrans({'\\': '\\\\', '"': '\\"', '\n': '\\n'})
+
+def _metric_labels(labels):
+    escaped = (f'{key}="{str(value).translate(METRIC_LABEL_ESCAPES)}"' for key, value in labels.items())
+    return "{" + ",".join(escaped) + "}"
+
+def disk_metric_samples(disk_entry, labels, now):
+    """Yield (metric, extra labels, value) samples for a disk entry"""
+    for error_type, count in disk_entry["errors"].items():
+        yield 'diskmapper_zfs_errors', {'type': error_type}, count
+    
+    warnings = disk_entry["warnings"]
+    for severity in ('critical', 'caution', 'slowdown'):
+        yield 'diskmapper_warnings', {'severity': severity}, len(warnings[severity])
+    yield 'diskmapper_smart_test_overdue', {}, int(warnings["test_warning"])
+    
+    smart_data = disk_entry["smart_data"] or {}
+    yield 'diskmapper_disk_standby', {}, int('standby' in smart_data)
+    yield 'diskmapper_smart_timed_out', {}, int('timed_out' in smart_data)
+    if 'error' in smart_data:
+        return
+    yield 'diskmapper_smart_healthy', {}, int(smart_data['health_status'] == "PASSED")
+    if isinstance(smart_data['power_on_hours'], int):
+        yield 'diskmapper_power_on_hours', {}, smart_data['power_on_hours']
+    if smart_data.get('captured'):
+        yield 'diskmapper_smart_age_seconds', {}, round(now - datetime.fromisoformat(smart_data['captured']).timestamp(), 3)
+    
+    drive_type = smart_data['drive_type']
+    if drive_type == "SAS":
+        for operation, count in smart_data['corrected_errors'].items():
+            yield 'diskmapper_sas_corrected_errors', {'operation': operation}, count
+        for operation, count in smart_data['uncorrected_errors'].items():
+            yield 'diskmapper_sas_uncorrected_errors', {'operation': operation}, count
+        yield 'diskmapper_sas_grown_defects', {}, smart_data['grown_defects']
+    elif drive_type == "NVMe":
+        yield 'diskmapper_nvme_media_errors', {}, smart_data['media_errors']
+        yield 'diskmapper_nvme_error_log_entries', {}, smart_data['error_log_entries']
+    else:
+        yield 'diskmapper_sata_offline_uncorrectable', {}, smart_data['offline_uncorrectable']
+        yield 'diskmapper_sata_udma_crc_errors', {}, smart_data['udma_crc_error_count']
+
+def render_metrics(pool_entries, refreshed=None, duration=None, up=None, refresh_errors=0):
+    """Render pool entries in the Prometheus text exposition format.
+
+    refreshed and duration describe the last successful refresh; up says
+    whether the latest one succeeded, by default whether there was one.
+    """
+    now = time.time()
+    samples = {name: [] for name, _ in EXPORTER_METRICS}
+    for pool_entry in pool_entries:
+        for top_entry in pool_entry["vdevs"]:
+            for vdev_entry, disk_entry in iter_disk_entries(top_entry):
+                labels = {
+                    'pool': pool_entry["name"],
+                    'vdev': vdev_entry["name"],
+                    'disk': disk_entry["disk"] or disk_label(disk_entry),
+                    'serial': disk_entry["serial"],
+                    'model': disk_entry["model"]
+                }
+                for name, extra_labels, value in disk_metric_samples(disk_entry, labels, now):
+                    samples[name].append(f"{name}{_metric_labels({**labels, **extra_labels})} {value}")
+    
+    lines = []
+    for name, help_text in EXPORTER_METRICS:
+        if samples[name]:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} gauge")
+            lines.extend(samples[name])
+    lines.append("# HELP diskmapper_up Whether the latest refresh of the disk data succeeded")
+    lines.append("# TYPE diskmapper_up gauge")
+    lines.append(f"diskmapper_up {int(refreshed is not None if up is None else up)}")
+    lines.append("# HELP diskmapper_refresh_errors_total Refreshes that failed since the exporter started")
+    lines.append("# TYPE diskmapper_refresh_errors_total counter")
+    lines.append(f"diskmapper_refresh_errors_total {refresh_errors}")
+    if refreshed is not None:
+        lines.append("# HELP diskmapper_last_refresh_timestamp_seconds When the data was last refreshed")
+        lines.append("# TYPE diskmapper_last_refresh_timestamp_seconds gauge")
+        lines.append(f"diskmapper_last_refresh_timestamp_seconds {refreshed:.3f}")
+        lines.append("# HELP diskmapper_refresh_duration_seconds How long the last refresh took")
+        lines.append("# TYPE diskmapper_refresh_duration_seconds gauge")
+        lines.append(f"diskmapper_refresh_duration_seconds {duration:.3f}")
+    return ("\n".join(lines) + "\n").encode()
+
+class MetricsExporter:
+    """Serves Prometheus metrics from an in-memory snapshot.
+
+    A background thread refreshes the snapshot through a DiskWatcher, so a
+    scrape only copies pre-rendered bytes and never runs smartctl. When a
+    refresh fails the last data is kept, with diskmapper_up at 0 and the
+    failure counted, until a refresh succeeds again.
+    """
+
+    def __init__(self, watcher, interval=60):
+        self.watcher = watcher
+        self.interval = interval
+        self.stop = threading.Event()
+        self.refreshed = None
+        self.duration = None
+        self.refresh_errors = 0
+        self._snapshot = render_metrics([])
+        self._lock = threading.Lock()
+
+    @property
+    def snapshot(self):
+        with self._lock:
+            return self._snapshot
+
+    def refresh(self):
+        """Poll once and replace the snapshot; a failed poll is counted and re-raised"""
+        started = time.time()
+        try:
+            self.watcher.poll()
+        except Exception:
+            self.refresh_errors += 1
+            self._render(up=False)
+            raise
+        self.refreshed, self.duration = time.time(), time.time() - started
+        self._render(up=True)
+
+    def _render(self, up):
+        snapshot = render_metrics(self.watcher.pool_entries, self.refreshed, self.duration, up, self.refresh_errors)
+        with self._lock:
+            self._snapshot = snapshot
+
+    def _refresh_loop(self):
+        while not self.stop.is_set():
+            try:
+                self.refresh()
+            except MiddlewareError as e:
+                print(f"\033[1;31mError fetching data: {str(e)}\033[0m", file=sys.stderr)
+            except Exception as e:
+                # The thread has to live on, or the metrics would silently go stale
+                print(f"\033[1;31mError refreshing metrics: {type(e).__name__}: {str(e)}\033[0m", file=sys.stderr)
+            self.stop.wait(self.interval)
+
+    def serve(self, host, port):
+        """Start the refresher and serve /metrics until interrupted"""
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        exporter = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?', 1)[0] == '/metrics':
+                    body = exporter.snapshot
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                else:
+                    body = b'<html><body><a href="/metrics">Metrics</a></body></html>\n'
+                    self.send_response(200 if self.path == '/' else 404)
+                    self.send_header('Content-Type', 'text/html')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+        server.daemon_threads = True
+        threading.Thread(target=self._refresh_loop, daemon=True).start()
+        signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=server.shutdown).start())
+        print(f"\033[1;32mServing metrics on http://{host or '0.0.0.0'}:{port}/metrics\033[0m")
+        sys.stdout.flush()
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop.set()
+            server.server_close()
+
+def parse_listen_address(value):
+    """Split "[HOST:]PORT" for --exporter"""
+    host, _, port = value.rpartition(':')
+    try:
+        return host.strip('[]'), int(port)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid listen address {value!r}, expected [HOST:]PORT")
+
+def new_report(pool_entries=None):
+    """Return a report holding pool_entries, stamped with the current time"""
+    return {
+        "pools": pool_entries if pool_entries is not None else [],
+        "timestamp": datetime.now().isoformat()
+    }
+
+def collect_topology(client, selection=None, sysfs_root=None):
+    """Read the pools and disks from middleware; returns (pool data, guid_to_disk, devname_to_disk).
+
+    The pools are narrowed down to the selection (a DiskSelection); with
+    sysfs_root the disks come from sysfs_disk_inventory().
+    """
+    selection = selection or ALL_DISKS
+    pool_data = client.query('pool.query', selection.pool_filters(), select=POOL_QUERY_FIELDS)
+    disk_data = query_disks(client, pool_data, selection, sysfs_root)
+    guid_to_disk, devname_to_disk = build_disk_index(disk_data)
+    return selection.select(pool_data, guid_to_disk, devname_to_disk), guid_to_disk, devname_to_disk
+
+def collect_smart(devices, collector=None, disk_infos=None):
+    """Read the SMART data of devices (sda, nvme0n1, ...) in parallel; returns {device: result}.
+
+    disk_infos maps devices to their disk.query records, which key the
+    cache and place the disks on their controllers and enclosures.
+    """
+    disk_infos = disk_infos or {}
+    return (collector or SmartCollector()).collect([(device, disk_infos.get(device) or {}) for device in devices])
+
+def analyze(pool_data, guid_to_disk, devname_to_disk, smart_results, trends=None, latency=None,
+            rules=None, peers=None):
+    """Build the report for collected data: every disk with its warnings, and its peer outliers with peers"""
+    report = new_report(build_pool_entries(pool_data, guid_to_disk, devname_to_disk, smart_results, trends,
+                                           latency, rules))
+    if peers is not None:
+        peers.apply(iter_report_disks(report))
+    return report
+
+def scan(client=None, collector=None, selection=None, rules=None, peers=None, sysfs_root=None):
+    """Collect and analyse the pool disks in-process and return the report, without rendering it.
+
+    Without a client one is connected for this call only. A monitoring agent
+    that scans repeatedly should pass its own client, and a collector with a
+    SmartCache so disks read recently are not woken up again. A cache that
+    cannot be saved is reported as a RuntimeWarning; the report is still returned.
+    """
+    own_client = client is None
+    if own_client:
+        client = connect_middleware()
+    try:
+        pool_data, guid_to_disk, devname_to_disk = collect_topology(client, selection, sysfs_root)
+    finally:
+        if own_client:
+            client.close()
+    disks = collect_pool_disks(pool_data, guid_to_disk, devname_to_disk)
+    collector = collector or SmartCollector()
+    smart_results = collector.collect(disks)
+    if collector.cache is not None:
+        try:
+            collector.cache.save()
+        except OSError as e:
+            warnings.warn(f"Error saving SMART cache: {str(e)}", RuntimeWarning, stacklevel=2)
+    return analyze(pool_data, guid_to_disk, devname_to_disk, smart_results, rules=rules, peers=peers)
+
+def run_report(pool_data, guid_to_disk, devname_to_disk, collector, renderer,
+               history=None, trend_window=7, latency_sampler=None, rules=None, peers=None):
+    """Collect SMART data, analyse it and render the report, which is returned.
+
+    A streaming renderer gets every disk as soon as its smartctl finishes;
+    the others get the whole report once all disks are in. Latency is sampled
+    while smartctl runs, so the first streamed disk waits for its window.
+    Peer outliers need every disk, so with peers a streaming renderer gets
+    the disks once they are analysed instead.
+    """
+    disks = collect_pool_disks(pool_data, guid_to_disk, devname_to_disk)
+    trends = {} if history is not None else None
+    latency_future = latency_sampler.start(pool_data, collector.transport) if latency_sampler is not None else None
+    on_result = None
+    streaming = renderer.streaming and peers is None
+    renderer.begin()
+    
+    if streaming:
+        disk_infos = dict(disks)
+        placements = {}
+        for pool_name, vdev, vdev_type, disk_child in iter_topology_disks(pool_data):
+            placements.setdefault(disk_child.get('disk'), []).append((pool_name, vdev, vdev_type, disk_child))
+        
+        def on_result(device, result):
+            if history is not None:
+                trends.update(update_history(history, [(device, disk_infos[device])], {device: result},
+                                             trend_window, prune=False) or {})
+            latency = latency_future.result() if latency_future is not None else None
+            for pool_name, vdev, vdev_type, disk_child in placements.get(device, []):
+                disk_entry = build_disk_entry(disk_child, guid_to_disk, devname_to_disk, {device: result},
+                                              trends, latency, rules)
+                with TRACER.span("render", device):
+                    renderer.disk(pool_name, vdev.get('name', 'UNKNOWN'), vdev_type, disk_entry)
+    
+    smart_results = collector.collect(disks, on_result)
+    timed_out = sorted(device for device, result in smart_results.items() if result.get('timed_out'))
+    if timed_out:
+        print(f"\033[1;33msmartctl timed out on {len(timed_out)} disk(s): {', '.join(timed_out)}\033[0m",
+              file=sys.stderr)
+    if collector.cache is not None:
+        try:
+            with TRACER.span("cache"):
+                collector.cache.save()
+        except OSError as e:
+            print(f"\033[1;31mError saving SMART cache: {str(e)}\033[0m")
+    
+    # Record the counters and work out their trends before the warnings are evaluated
+    if history is not None:
+        if streaming:
+            try:
+                history.prune()
+            except HistoryError as e:
+                print(f"\033[1;31mError updating SMART history: {str(e)}\033[0m")
+        else:
+            trends = update_history(history, disks, smart_results, trend_window)
+    
+    latency = latency_future.result() if latency_future is not None else None
+    report = analyze(pool_data, guid_to_disk, devname_to_disk, smart_results, trends, latency, rules, peers)
+    with TRACER.span("render"):
+        if renderer.streaming and not streaming:
+            for pool_entry in report["pools"]:
+                for top_entry in pool_entry["vdevs"]:
+                    for vdev_entry, disk_entry in iter_disk_entries(top_entry):
+                        renderer.disk(pool_entry["name"], vdev_entry["name"], vdev_entry["type"], disk_entry)
+        renderer.report(report)
+        renderer.end()
+    return report
+
+def parse_inventory(path, options=(), timeout=None):
+    """Read a fleet inventory into (name, transport) pairs.
+
+    One host per line as [user@]host[:port], blank lines and # comments are
+    skipped; an IPv6 address with a port is written [address]:port. "local"
+    or "local:NAME" runs on this machine instead of over ssh.
+    """
+    hosts = []
+    with open(path) as f:
+        for line in f:
+            entry = line.split('#', 1)[0].strip()
+            if not entry:
+                continue
+            if entry == "local" or entry.startswith("local:"):
+                name = entry.partition(':')[2] or "localhost"
+                hosts.append((name, LocalTransport(name, timeout)))
+                continue
+            user, at, address = entry.rpartition('@')
+            port = None
+            if address.startswith('['):
+                address, _, rest = address[1:].partition(']')
+                port = rest[1:] if rest.startswith(':') and rest[1:].isdigit() else None
+            elif address.count(':') == 1 and address.partition(':')[2].isdigit():
+                # More than one colon is a bare IPv6 address, which has no port
+                address, _, port = address.partition(':')
+            host = f"{user}{at}{address}"
+            transport = SshTransport(host, int(port) if port else None, options, timeout)
+            hosts.append((transport.name, transport))
+    return hosts
+
+def collect_host(transport, make_collector, history=None, trend_window=7, selection=ALL_DISKS,
+                 latency_sampler=None, rules=None):
+    """Query middleware and smartctl on one host and return its pool entries"""
+    pool_data, guid_to_disk, devname_to_disk = collect_topology(MidcltClient(transport), selection)
+    disks = collect_pool_disks(pool_data, guid_to_disk, devname_to_disk)
+    latency_future = latency_sampler.start(pool_data, transport) if latency_sampler is not None else None
+    smart_results = make_collector(transport).collect(disks)
+    trends = None
+    if history is not None:
+        trends = update_history(history, disks, smart_results, trend_window)
+    latency = latency_future.result() if latency_future is not None else None
+    return build_pool_entries(pool_data, guid_to_disk, devname_to_disk, smart_results, trends, latency, rules)
+
+def key_fleet_disks(pool_entries):
+    """Key a host's disks by pool, vdev and serial for the merged fleet report"""
+    pools = {}
+    for pool_entry in pool_entries:
+        vdevs = pools.setdefault(pool_entry["name"], {})
+        for top_entry in pool_entry["vdevs"]:
+            for vdev_entry, disk_entry in iter_disk_entries(top_entry):
+                serial = disk_entry["serial"]
+                if serial == 'UNKNOWN':
+                    serial = disk_label(disk_entry)
+                vdevs.setdefault(vdev_entry["name"], {})[serial] = disk_entry
+    return pools
+
+def run_fleet(hosts, make_collector, renderer, workers=8, host_timeout=600,
+              cache=None, history=None, trend_window=7, selection=ALL_DISKS, latency_sampler=None,
+              rules=None, peers=None):
+    """Collect all hosts concurrently and render the merged report, which is returned.
+
+    Each host gets host_timeout seconds from the moment its collection starts;
+    commands still running then are killed and the host is marked as timed out.
+    A streaming renderer gets each host as it finishes, or with peers once
+    every host is in and compared.
+    """
+    report = {"hosts": {}, "timestamp": datetime.now().isoformat()}
+    host_pools = {}
+    streaming = renderer.streaming and peers is None
+    renderer.begin()
+    
+    def collect(name, transport):
+        started = time.monotonic()
+        transport.deadline = started + host_timeout
+        result = {"status": "ok", "error": None}
+        try:
+            with TRACER.span("host", name):
+                host_pools[name] = collect_host(transport, make_collector, history, trend_window, selection,
+                                                latency_sampler, rules)
+            if time.monotonic() >= transport.deadline:
+                result["status"] = "timeout"
+                result["error"] = f"timed out after {host_timeout}s, SMART data is incomplete"
+        except Exception as e:
+            # Whatever goes wrong on one host, the others are still reported
+            result["status"] = "timeout" if time.monotonic() >= transport.deadline else "error"
+            result["error"] = str(e) if isinstance(e, MiddlewareError) else f"{type(e).__name__}: {e}"
+            host_pools[name] = []
+        result["elapsed"] = round(time.monotonic() - started, 3)
+        result["pools"] = key_fleet_disks(host_pools[name])
+        return name, result
+    
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    results = {}
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(hosts)))) as pool:
+        futures = [pool.submit(collect, name, transport) for name, transport in hosts]
+        for future in as_completed(futures):
+            name, result = future.result()
+            results[name] = result
+            if streaming:
+                with TRACER.span("render", name):
+                    renderer.host(name, result, host_pools[name])
+    if cache is not None:
+        try:
+            with TRACER.span("cache"):
+                cache.save()
+        except OSError as e:
+            print(f"\033[1;31mError saving SMART cache: {str(e)}\033[0m")
+    
+    # Disks are compared with their peers on every host
+    if peers is not None:
+        peers.apply(disk_entry for pool_entries in host_pools.values()
+                    for disk_entry in iter_report_disks(new_report(pool_entries)))
+    
+    # The merged report keeps the inventory order
+    for name, transport in hosts:
+        report["hosts"][name] = results[name]
+        if not streaming:
+            with TRACER.span("render", name):
+                renderer.host(name, results[name], host_pools[name])
+    with TRACER.span("render"):
+        renderer.report(report)
+        renderer.end()
+    return report
+
+# Captured bundles are directories or tarballs holding pool.query.json,
+# disk.query.json and smartctl/<device>[.txt|.json] files, optionally with
+# zpool_iostat/<pool>.txt from `zpool iostat -v -l -p -H -g POOL 5 2`
+BUNDLE_QUERIES = ('pool.query.json', 'disk.query.json')
+BUNDLE_SMARTCTL_DIR = "smartctl"
+BUNDLE_IOSTAT_DIR = "zpool_iostat"
+TARBALL_SUFFIXES = ('.tar', '.tar.gz', '.tgz', '.tar.xz', '.txz', '.tar.bz2')
+
+def find_bundles(paths):
+    """Expand bundle paths; a directory without pool.query.json holds bundles"""
+    bundles = []
+    for path in paths:
+        if os.path.isdir(path) and not os.path.exists(os.path.join(path, 'pool.query.json')):
+            bundles.extend(os.path.join(path, name) for name in sorted(os.listdir(path))
+                           if os.path.isdir(os.path.join(path, name)) or name.endswith(TARBALL_SUFFIXES))
+        else:
+            bundles.append(path)
+    return bundles
+
+def bundle_name(path):
+    name = os.path.basename(os.path.normpath(path))
+    for suffix in TARBALL_SUFFIXES:
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return name
+
+class BundleError(Exception):
+    """A captured bundle could not be read or is missing a query"""
+
+def read_bundle(path):
+    """Return the captured middleware responses, {device: (smartctl output, mtime)}
+    and {pool: zpool iostat output}; raises BundleError for an unreadable bundle"""
+    import tarfile
+    responses = {}
+    smart_outputs = {}
+    iostat_outputs = {}
+    
+    def add(parts, read, mtime):
+        if parts[-1] in BUNDLE_QUERIES:
+            responses[parts[-1][:-5]] = json.loads(read())
+        elif len(parts) > 1 and parts[-2] == BUNDLE_SMARTCTL_DIR:
+            device = re.sub(r"\.(txt|json|out)$", "", parts[-1])
+            smart_outputs[device] = (read(), mtime)
+        elif len(parts) > 1 and parts[-2] == BUNDLE_IOSTAT_DIR:
+            iostat_outputs[re.sub(r"\.(txt|out)$", "", parts[-1])] = read()
+    
+    try:
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                for name in files:
+                    file_path = os.path.join(root, name)
+                    with open(file_path, errors='replace') as f:
+                        add(os.path.relpath(file_path, path).split(os.sep), f.read, os.path.getmtime(file_path))
+        else:
+            with tarfile.open(path) as tar:
+                for member in tar:
+                    if member.isfile():
+                        with tar.extractfile(member) as f:
+                            add(member.name.split('/'), lambda: f.read().decode(errors='replace'), member.mtime)
+    except (OSError, ValueError, tarfile.TarError) as e:
+        raise BundleError(f"{path}: {str(e)}") from e
+    
+    missing = [name for name in BUNDLE_QUERIES if name[:-5] not in responses]
+    if missing:
+        raise BundleError(f"{path}: missing {', '.join(missing)}")
+    # Both queries return a list of records
+    for name in BUNDLE_QUERIES:
+        if not isinstance(responses[name[:-5]], list) or not all(isinstance(record, dict)
+                                                                 for record in responses[name[:-5]]):
+            raise BundleError(f"{path}: {name} is not a list of records")
+    return responses, smart_outputs, iostat_outputs
+
+def analyze_bundle(path, selection=ALL_DISKS, rules=None):
+    """Analyse one captured bundle like a live run; returns (name, result, pool entries).
+
+    Runs in a worker process when many bundles are analysed at once.
+    """
+    started = time.monotonic()
+    result = {"status": "ok", "error": None}
+    pool_entries = []
+    try:
+        responses, smart_outputs, iostat_outputs = read_bundle(path)
+        client = StaticMiddlewareClient(responses)
+        pool_data = client.query('pool.query', selection.pool_filters(), select=POOL_QUERY_FIELDS)
+        disk_data = client.query('disk.query', selection.disk_filters(), select=DISK_QUERY_FIELDS)
+        guid_to_disk, devname_to_disk = build_disk_index(disk_data)
+        pool_data = selection.select(pool_data, guid_to_disk, devname_to_disk)
+        
+        smart_results = {}
+        for device, disk_info in collect_pool_disks(pool_data, guid_to_disk, devname_to_disk):
+            smart_output, captured = smart_outputs.get(
+                device, (f"Error: no smartctl output captured for /dev/{device}", time.time()))
+            smart_data = parse_smart_data(smart_output) if not smart_output.startswith("Error") else {}
+            smart_results[device] = {"output": smart_output, "data": smart_data,
+                                     "captured": captured, "cached": False}
+        
+        latency = None
+        if iostat_outputs:
+            samples = {}
+            for pool_name, output in iostat_outputs.items():
+                samples.update(parse_zpool_iostat(output, pool_name))
+            latency = compare_vdev_latency(pool_data, samples)
+        pool_entries = build_pool_entries(pool_data, guid_to_disk, devname_to_disk, smart_results,
+                                          latency=latency, rules=rules)
+    except Exception as e:
+        # Whatever is wrong with one bundle, the others are still reported
+        result["status"] = "error"
+        result["error"] = str(e) if isinstance(e, (BundleError, MiddlewareError)) else f"{type(e).__name__}: {e}"
+    result["elapsed"] = round(time.monotonic() - started, 3)
+    result["pools"] = key_fleet_disks(pool_entries)
+    return path, result, pool_entries
+
+def run_offline(paths, renderer, workers=None, selection=ALL_DISKS, rules=None, peers=None):
+    """Analyse captured bundles, in parallel processes when there are several,
+    and render them like a fleet report with one host per bundle"""
+    bundles = find_bundles(paths)
+    names = [bundle_name(path) for path in bundles]
+    # Bundles that share a name are told apart by their path
+    names = [name if names.count(name) == 1 else path for name, path in zip(names, bundles)]
+    
+    report = {"hosts": {}, "timestamp": datetime.now().isoformat()}
+    renderer.begin()
+    workers = workers or os.cpu_count() or 1
+    if workers > 1 and len(bundles) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        executor = ProcessPoolExecutor(max_workers=min(workers, len(bundles)))
+        results = executor.map(analyze_bundle, bundles, [selection] * len(bundles), [rules] * len(bundles),
+                               chunksize=max(1, len(bundles) // (workers * 4)))
+    else:
+        executor = None
+        results = map(analyze_bundle, bundles, [selection] * len(bundles), [rules] * len(bundles))
+    try:
+        if peers is not None:
+            # Comparing disks across bundles needs them all before the first is rendered
+            results = list(results)
+            peers.apply(disk_entry for path, result, pool_entries in results
+                        for disk_entry in iter_report_disks(new_report(pool_entries)))
+        for name, (path, result, pool_entries) in zip(names, results):
+            report["hosts"][name] = result
+            with TRACER.span("render", name):
+                renderer.host(name, result, pool_entries)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    with TRACER.span("render"):
+        renderer.report(report)
+        renderer.end()
+    return report
 
-def main():
+def main(argv=None):
+    """Run the command line and return its exit status; argv defaults to sys.argv[1:]"""
     parser = argparse.ArgumentParser(description='Disk Mapper with JSON export')
     parser.add_argument('--json', type=str, help='Path to output JSON file')
-    args = parser.parse_args()
+    parser.add_argument('--format', choices=sorted(RENDERERS), default='tree',
+                        help='Report format: colored tree, plain text, JSON, or NDJSON with one disk per line as soon as it is read (default: tree)')
+    parser.add_argument('--output', type=str, metavar='PATH', help='Write the report to PATH instead of stdout')
+    parser.add_argument('--export', type=str, metavar='PATH',
+                        help='Also write every disk record to PATH: as each disk is read with --format ndjson, otherwise once the report is finished')
+    parser.add_argument('--export-format', choices=sorted(EXPORTERS),
+                        help='Format of --export: NDJSON, flat CSV or MessagePack (default: from the extension, else ndjson)')
+    parser.add_argument('--append', action='store_true',
+                        help='Append to the --export file instead of replacing it, to keep a history')
+    parser.add_argument('--middleware', choices=['auto', 'client', 'midclt'], default='auto',
+                        help='How to reach middleware: in-process client, midclt, or client with midclt fallback (default: auto)')
+    parser.add_argument('--middleware-fixture', type=str, metavar='DIR',
+                        help='Serve pool.query/disk.query from <method>.json files in DIR instead of middleware')
+    parser.add_argument('--inventory', choices=['middleware', 'sysfs'], default='middleware',
+                        help='Where disk serials, models and slots come from: disk.query, or sysfs with disk.query only for what it lacks (default: middleware)')
+    parser.add_argument('--sysfs-root', type=str, default=DEFAULT_SYSFS_ROOT, metavar='DIR',
+                        help=f'sysfs mount read by --inventory sysfs (default: {DEFAULT_SYSFS_ROOT})')
+    parser.add_argument('--smart-backend', choices=['auto', 'json', 'text'], default='auto',
+                        help='smartctl output to parse: JSON (-j), classic text, or JSON with text fallback (default: auto)')
+    parser.add_argument('--cache', type=str, default=DEFAULT_CACHE_PATH,
+                        help=f'Path of the shared SMART result cache (default: {DEFAULT_CACHE_PATH})')
+    parser.add_argument('--no-cache', action='store_true', help='Do not read or write the SMART cache')
+    parser.add_argument('--cache-max-age', type=int, default=300,
+                        help='Seconds a cached SMART result stays valid (default: 300)')
+    parser.add_argument('--cache-size', type=int, default=1024,
+                        help='Max number of disks kept in the SMART cache (default: 1024)')
+    parser.add_argument('--refresh', action='store_true',
+                        help='Ignore cached SMART results and re-run smartctl for every disk')
+    parser.add_argument('--wake', action='store_true',
+                        help='Read SMART from disks in standby too, spinning them up (default: report their last cached result)')
+    parser.add_argument('--history', type=str, nargs='?', const=DEFAULT_HISTORY_PATH, metavar='PATH',
+                        help=f'Keep SMART counters in a SQLite history and warn on their rate of change (default path: {DEFAULT_HISTORY_PATH})')
+    parser.add_argument('--history-retention', type=int, default=365, metavar='DAYS',
+                        help='Days of SMART history to keep (default: 365)')
+    parser.add_argument('--history-raw-days', type=int, default=7, metavar='DAYS',
+                        help='Days of SMART history kept at full resolution before downsampling to daily (default: 7)')
+    parser.add_argument('--trend-window', type=int, default=7, metavar='DAYS',
+                        help='Days of SMART history used for rate-of-change warnings (default: 7)')
+    parser.add_argument('--rules', type=str, metavar='PATH',
+                        help='Health rules and per-model/firmware overrides as JSON (see --dump-rules)')
+    parser.add_argument('--dump-rules', action='store_true', help='Print the built-in health rules as JSON and exit')
+    parser.add_argument('--peers', action='store_true',
+                        help='Flag disks whose error counters stand out from the other disks of their model and firmware')
+    parser.add_argument('--peers-from', nargs='+', metavar='REPORT',
+                        help='Also compare with the disks in these saved --json reports, e.g. of other systems (implies --peers)')
+    parser.add_argument('--peer-min-group', type=int, default=PEER_MIN_GROUP, metavar='N',
+                        help=f'Only compare groups of at least N disks (default: {PEER_MIN_GROUP})')
+    parser.add_argument('--peer-threshold', type=float, default=PEER_THRESHOLD, metavar='Z',
+                        help=f'Flag counters more than Z robust standard deviations above the group median (default: {PEER_THRESHOLD})')
+    parser.add_argument('--pool', action='append', metavar='NAME', help='Only look at this pool (repeatable)')
+    parser.add_argument('--vdev', action='append', metavar='NAME',
+                        help='Only look at this vdev, by name (e.g. raidz2-0) or GUID (repeatable)')
+    parser.add_argument('--serial', action='append', metavar='SERIAL', help='Only look at the disk with this serial (repeatable)')
+    parser.add_argument('--device', action='append', metavar='DEVICE',
+                        help='Only look at this disk or partition, e.g. sda or /dev/nvme0n1 (repeatable)')
+    parser.add_argument('--latency', type=int, nargs='?', const=5, metavar='SECONDS',
+                        help='Sample per-disk latency with zpool iostat over SECONDS (default: 5) and flag disks slower than their vdev peers')
+    parser.add_argument('--latency-ratio', type=float, default=2.0,
+                        help='Flag a disk whose latency is this many times the median of its vdev peers (default: 2.0)')
+    parser.add_argument('--latency-min-ms', type=float, default=5.0,
+                        help='Only flag a disk whose latency is also this many milliseconds above its peers (default: 5.0)')
+    parser.add_argument('--self-test', choices=['short', 'long'],
+                        help='Run SMART self-tests on the pool disks a few per vdev at a time, then exit')
+    parser.add_argument('--self-test-per-vdev', type=int, default=1, metavar='N',
+                        help='Disks of a top-level vdev testing at the same time, 0 for no limit (default: 1)')
+    parser.add_argument('--self-test-per-pool', type=int, default=0, metavar='N',
+                        help='Disks of a pool testing at the same time, 0 for no limit (default: 0)')
+    parser.add_argument('--self-test-poll', type=int, default=60, metavar='SECONDS',
+                        help='How often running self-tests are polled (default: 60)')
+    parser.add_argument('--self-test-state', type=str, default=DEFAULT_SELFTEST_STATE_PATH, metavar='PATH',
+                        help=f'Where the self-test progress is kept, to resume an interrupted run (default: {DEFAULT_SELFTEST_STATE_PATH})')
+    parser.add_argument('--self-test-skip-days', type=int, default=0, metavar='DAYS',
+                        help='Skip disks whose last self-test passed less than DAYS ago (default: 0, test every disk)')
+    parser.add_argument('--watch', type=int, metavar='SECONDS',
+                        help='Keep running, re-checking ZFS errors every SECONDS and printing only disks that changed')
+    parser.add_argument('--dashboard', action='store_true',
+                        help='Full-screen live view of the pool disks, refreshed every --watch seconds (default: 60); s sorts, f filters by severity')
+    parser.add_argument('--events', action='store_true',
+                        help='Follow zpool events and refresh only the disks they are about, instead of sweeping every pool; with --watch SECONDS a full sweep still runs every SECONDS')
+    parser.add_argument('--events-from', type=str, metavar='FILE',
+                        help='Replay recorded `zpool events -v` output from FILE instead of following zpool (implies --events)')
+    parser.add_argument('--event-batch', type=float, default=2, metavar='SECONDS',
+                        help='Collect events for SECONDS before refreshing, so a burst costs one refresh (default: 2)')
+    parser.add_argument('--smart-interval', type=int, default=3600, metavar='SECONDS',
+                        help='In watch mode, how often each disk is re-checked with smartctl (default: 3600)')
+    parser.add_argument('--exporter', type=parse_listen_address, metavar='[HOST:]PORT',
+                        help='Serve Prometheus metrics on HOST:PORT, refreshed in the background every --watch seconds (default: 60)')
+    parser.add_argument('--fleet', type=str, metavar='INVENTORY',
+                        help='Collect from every host in INVENTORY ([user@]host[:port] per line) over ssh and merge the reports')
+    parser.add_argument('--fleet-workers', type=int, default=8,
+                        help='Hosts collected at the same time in fleet mode (default: 8)')
+    parser.add_argument('--host-timeout', type=int, default=600, metavar='SECONDS',
+                        help='Give up on a fleet host after SECONDS (default: 600)')
+    parser.add_argument('--command-timeout', type=int, default=120, metavar='SECONDS',
+                        help='Give up on a single midclt or smartctl call on a fleet host after SECONDS (default: 120)')
+    parser.add_argument('--ssh-option', action='append', default=[], metavar='OPTION',
+                        help='Extra ssh option for fleet hosts, e.g. --ssh-option=-oUser=root (repeatable)')
+    parser.add_argument('--offline', nargs='+', metavar='BUNDLE',
+                        help='Analyse captured pool.query/disk.query/smartctl output from bundle directories or tarballs instead of this system')
+    parser.add_argument('--offline-workers', type=int, metavar='N',
+                        help='Processes analysing bundles in parallel (default: number of CPUs)')
+    parser.add_argument('--workers', type=int, default=8,
+                        help='Number of disks to query with smartctl in parallel (default: 8)')
+    parser.add_argument('--smart-timeout', type=int, default=60, metavar='SECONDS',
+                        help='Kill a smartctl call after SECONDS and report the disk as timed out, 0 for no limit (default: 60)')
+    parser.add_argument('--middleware-timeout', type=int, default=60, metavar='SECONDS',
+                        help='Give up on a middleware call after SECONDS, 0 for no limit (default: 60)')
+    parser.add_argument('--deadline', type=int, metavar='SECONDS',
+                        help='Finish a one-shot run within SECONDS: disks not read by then are reported as timed out')
+    parser.add_argument('--retries', type=int, default=1,
+                        help='Retry a failed smartctl or midclt call this many times; timeouts are not retried (default: 1)')
+    parser.add_argument('--retry-backoff', type=float, default=1, metavar='SECONDS',
+                        help='Wait before the first retry, doubled for each one after it (default: 1)')
+    parser.add_argument('--per-controller', type=int, default=4,
+                        help='Max concurrent smartctl calls per controller, 0 for no limit (default: 4)')
+    parser.add_argument('--per-enclosure', type=int, default=0,
+                        help='Max concurrent smartctl calls per enclosure, 0 for no limit (default: 0)')
+    parser.add_argument('--timings', action='store_true',
+                        help='Time every phase (middleware, each smartctl call, parsing, rules, rendering) and print a summary to stderr')
+    parser.add_argument('--trace', type=str, metavar='PATH',
+                        help='Write the phase timings as a Chrome trace (chrome://tracing, Perfetto) to PATH')
+    args = parser.parse_args(argv)
+    
+    if not (args.timings or args.trace):
+        return run(args)
+    TRACER.enable()
+    started = time.perf_counter()
+    try:
+        return run(args)
+    finally:
+        if args.timings:
+            print("\n" + "\n".join(format_timings(TRACER, time.perf_counter() - started)), file=sys.stderr)
+        if args.trace:
+            try:
+                TRACER.write_trace(args.trace)
+                print(f"\033[1;32mTrace saved to {args.trace}\033[0m", file=sys.stderr)
+            except OSError as e:
+                print(f"\033[1;31mError saving trace: {str(e)}\033[0m", file=sys.stderr)
+
+def run(args):
+    """Run the mode the command line asks for; returns 1 if a bundle could not be analysed"""
+    if args.dump_rules:
+        print(json.dumps(DEFAULT_RULES, indent=4))
+        return
+    rules = None
+    if args.rules:
+        try:
+            rules = RuleSet.load(args.rules)
+        except (OSError, ValueError) as e:
+            print(f"Error loading rules: {str(e)}")
+            return
+    long_running = args.watch or args.dashboard or args.exporter or args.self_test or args.events or args.events_from
+    peers = None
+    if (args.peers or args.peers_from) and long_running:
+        # Peers are compared across a finished report, which these modes never have
+        print("--peers only works for one-shot, fleet and offline reports")
+        return
+    if args.peers or args.peers_from:
+        try:
+            peers = PeerAnalysis.load(args.peers_from or (), args.peer_min_group, args.peer_threshold)
+        except (OSError, ValueError) as e:
+            print(f"Error loading peer reports: {str(e)}")
+            return
+    
+    selection = DiskSelection(args.pool, args.vdev, args.serial, args.device)
+    
+    if args.offline:
+        # Bundles are captured output: nothing is sampled, timed or kept between runs
+        live_only = [option for option, given in (("--history", args.history), ("--latency", args.latency),
+                                                  ("--deadline", args.deadline)) if given]
+        if live_only:
+            print(f"{', '.join(live_only)} cannot be used with --offline")
+            return
+        report = write_report(args, lambda renderer: run_offline(args.offline, renderer, args.offline_workers,
+                                                                 selection, rules, peers))
+        # A bundle that could not be analysed fails the run, after the others are reported
+        if report is None or any(result["status"] != "ok" for result in report["hosts"].values()):
+            return 1
+        return
+    
+    cache = None
+    if not args.no_cache:
+        cache = SmartCache(args.cache, args.cache_max_age, args.cache_size).load()
+    # The deadline only means something for a run that ends
+    transport = LocalTransport(deadline=time.monotonic() + args.deadline if args.deadline and not long_running
+                               else None)
+    collector = SmartCollector(args.workers, args.per_controller, args.per_enclosure,
+                               args.smart_backend, cache, args.refresh, transport, args.wake,
+                               args.smart_timeout or None, args.retries, args.retry_backoff)
+    history = None
+    if args.history:
+        history = SmartHistory(args.history, args.history_retention, args.history_raw_days)
+    sysfs_root = args.sysfs_root if args.inventory == 'sysfs' else None
+    latency_sampler = None
+    if args.latency:
+        latency_sampler = LatencySampler(args.latency, args.latency_ratio, args.latency_min_ms)
+    
+    if args.fleet:
+        try:
+            hosts = parse_inventory(args.fleet, args.ssh_option, args.command_timeout)
+        except OSError as e:
+            print(f"Error reading inventory: {str(e)}")
+            return
+        
+        def make_collector(transport):
+            return SmartCollector(args.workers, args.per_controller, args.per_enclosure,
+                                  args.smart_backend, cache, args.refresh, transport, args.wake,
+                                  args.smart_timeout or None, args.retries, args.retry_backoff)
+        
+        write_report(args, lambda renderer: run_fleet(hosts, make_collector, renderer, args.fleet_workers,
+                                                      args.host_timeout, cache, history, args.trend_window,
+                                                      selection, latency_sampler, rules, peers),
+                     history)
+        return
     
-    # Fetch pool and disk data
     try:
-        pool_data = json.loads(subprocess.check_output(["midclt", "call", "pool.query"]))
-        disk_data = json.loads(subprocess.check_output(["midclt", "call", "disk.query"]))
-    except (subprocess.CalledProcessError, json.JSONDecodeError) as e:
+        client = connect_middleware(args.middleware, args.middleware_fixture, transport,
+                                    args.middleware_timeout or None, args.retries, args.retry_backoff)
+    except (ImportError, MiddlewareError) as e:
         print(f"Error fetching data: {str(e)}")
         return
+    
+    with client:
+        if args.self_test:
+            try:
+                SelfTestScheduler(client, args.self_test, args.self_test_per_vdev, args.self_test_per_pool,
+                                  args.self_test_poll, args.self_test_state, args.self_test_skip_days,
+                                  selection, transport, args.smart_timeout or None, sysfs_root).run()
+            except (OSError, MiddlewareError) as e:
+                print(f"\033[1;31mError running self-tests: {str(e)}\033[0m")
+            return
+        if args.exporter:
+            host, port = args.exporter
+            MetricsExporter(DiskWatcher(client, collector, args.smart_interval, history, args.trend_window,
+                                        selection, rules, sysfs_root),
+                            args.watch or 60).serve(host, port)
+            return
+        if args.dashboard:
+            run_dashboard(DiskWatcher(client, collector, args.smart_interval, history, args.trend_window,
+                                      selection, rules, sysfs_root),
+                          args.watch or 60)
+            return
+        if args.events or args.events_from:
+            run_events(DiskWatcher(client, collector, args.smart_interval, history, args.trend_window,
+                                   selection, rules, sysfs_root),
+                       args.events_from, args.watch, args.json, args.event_batch)
+            return
+        if args.watch:
+            # The connection, topology and disk index stay alive between cycles
+            run_watch(DiskWatcher(client, collector, args.smart_interval, history, args.trend_window,
+                                  selection, rules, sysfs_root),
+                      args.watch, args.json)
+            return
+        
+        # Fetch pool and disk data, narrowed down before any smartctl runs
+        try:
+            pool_data, guid_to_disk, devname_to_disk = collect_topology(client, selection, sysfs_root)
+        except MiddlewareError as e:
+            print(f"Error fetching data: {str(e)}")
+            return
 
-    # Create disk lookup tables
-    guid_to_disk = {}
-    devname_to_disk = {}
-    for disk in disk_data:
-        if disk.get('zfs_guid'):
-            guid_to_disk[str(disk['zfs_guid'])] = disk
-        if disk.get('devname'):
-            devname_to_disk[disk['devname']] = disk
-        # Also index by gptid if available
-        if disk.get('name') and disk['name'].startswith('gptid/'):
-            devname_to_disk[disk['name'][6:]] = disk
+    if not pool_data:
+        print("\033[1;33mNo pool devices match the selection\033[0m")
+        return
 
-    # Process each pool
-    for pool in pool_data:
-        pool_name = pool.get('name', 'UNKNOWN')
-        print(f"\n\033[1;36m{' POOL: ' + pool_name + ' ':=^80}\033[0m")
-        
-        # Create pool entry for JSON
-        pool_entry = {
-            "name": pool_name,
-            "vdevs": []
-        }
-        json_output["pools"].append(pool_entry)
-        
-        # Process topology sections
-        topology = pool.get('topology', {})
-        for vdev_type, vdev_list in topology.items():
-            for vdev in vdev_list:
-                process_vdev(vdev, vdev_type, guid_to_disk, devname_to_disk, pool_entry)
+    write_report(args, lambda renderer: run_report(pool_data, guid_to_disk, devname_to_disk, collector,
+                                                   renderer, history, args.trend_window, latency_sampler,
+                                                   rules, peers),
+                 history)
+
+def write_report(args, produce, history=None):
+    """Render the report produce(renderer) makes to --output and save the --json copy.
+    Returns the report, None if the output could not be opened."""
+    exporter = None
+    if args.export:
+        try:
+            exporter = open_exporter(args.export, args.export_format, args.append)
+        except (ImportError, OSError) as e:
+            print(f"\033[1;31mError opening export: {str(e)}\033[0m")
+            return
+    try:
+        stream = open(args.output, 'w') if args.output else sys.stdout
+    except OSError as e:
+        print(f"\033[1;31mError opening output: {str(e)}\033[0m")
+        if exporter is not None:
+            exporter.close()
+        return
+    try:
+        renderer = RENDERERS[args.format](ReportWriter(stream))
+        if exporter is not None:
+            renderer = ExportRenderer(renderer, exporter)
+        report = produce(renderer)
+    finally:
+        if stream is not sys.stdout:
+            stream.close()
+        if exporter is not None:
+            exporter.close()
+        if history is not None:
+            history.close()
 
-    # Save JSON output if requested
+    # Save JSON output if requested; keep machine-readable stdout clean
     if args.json:
+        status = sys.stderr if args.format in ('json', 'ndjson') and not args.output else sys.stdout
         try:
-            with open(args.json, 'w') as f:
-                json.dump(json_output, f, indent=4)
-            print(f"\n\033[1;32mJSON output saved to {args.json}\033[0m")
+            write_json(args.json, report)
+            print(f"\n\033[1;32mJSON output saved to {args.json}\033[0m", file=status)
         except Exception as e:
-            print(f"\n\033[1;31mError saving JSON: {str(e)}\033[0m")
+            print(f"\n\033[1;31mError saving JSON: {str(e)}\033[0m", file=status)
+    return report
 
-def process_vdev(vdev, vdev_type, guid_to_disk, devname_to_disk, pool_entry, indent=1):
-    # Print VDEV header
-    vdev_name = vdev.get('name', 'UNKNOWN')
-    indent_str = "  " * indent
-    print(f"\n{indent_str}\033[1;33mVDEV: {vdev_name} ({vdev_type.upper()})\033[0m")
-    print(f"{indent_str}{'-' * 60}")
-    
-    # Create vdev entry for JSON
+def build_pool_entries(pool_data, guid_to_disk, devname_to_disk, smart_results=None, trends=None,
+                       latency=None, rules=None):
+    """Collect every pool, vdev and disk into JSON-ready entries.
+
+    The health rules are evaluated once over all disks after they are collected.
+    """
+    pool_entries = []
+    pending = []
+    with TRACER.span("build", f"{len(pool_data)} pools"):
+        for pool in pool_data:
+            pool_entry = {
+                "name": pool.get('name', 'UNKNOWN'),
+                "vdevs": []
+            }
+            
+            # Process topology sections
+            topology = pool.get('topology', {})
+            for vdev_type, vdev_list in topology.items():
+                for vdev in vdev_list:
+                    pool_entry["vdevs"].append(
+                        build_vdev_entry(vdev, vdev_type, guid_to_disk, devname_to_disk, smart_results, trends,
+                                         latency, pending))
+            pool_entries.append(pool_entry)
+    (rules or default_rules()).apply(pending)
+    return pool_entries
+
+def build_vdev_entry(vdev, vdev_type, guid_to_disk, devname_to_disk, smart_results=None, trends=None,
+                     latency=None, pending=None):
+    """Collect a vdev and its disks; nested vdevs go under "vdevs\"
+
+    With a pending list the disks' warnings are left for the caller to evaluate.
+    """
     vdev_entry = {
-        "name": vdev_name,
+        "name": vdev.get('name', 'UNKNOWN'),
         "type": vdev_type,
         "children": []
     }
-    pool_entry["vdevs"].append(vdev_entry)
     
-    # Process children
     for child in vdev.get('children', []):
         if child.get('type') == 'DISK':
-            disk_entry = print_disk(child, guid_to_disk, devname_to_disk, indent + 1)
-            vdev_entry["children"].append(disk_entry)
+            vdev_entry["children"].append(
+                build_disk_entry(child, guid_to_disk, devname_to_disk, smart_results, trends, latency,
+                                 pending=pending))
         else:
-            # Recursive call for nested vdevs
-            process_vdev(child, child.get('type', 'UNKNOWN'), guid_to_disk, devname_to_disk, 
-                         vdev_entry, indent + 1)
-    
-    # Add separator after vdev
-    print(f"{indent_str}{'#' * 60}")
+            vdev_entry.setdefault("vdevs", []).append(
+                build_vdev_entry(child, child.get('type', 'UNKNOWN'), guid_to_disk,
+                                 devname_to_disk, smart_results, trends, latency, pending))
+    return vdev_entry
 
-def print_disk(disk_child, guid_to_disk, devname_to_disk, indent):
-    # Get basic disk info
+def disk_label(disk_entry):
+    """/dev/<disk>, or for a removed or faulted member with no disk its GPTID or ZFS GUID"""
+    if disk_entry["disk"]:
+        return f"/dev/{disk_entry['disk']}"
+    if disk_entry["gptid"] != "N/A":
+        return disk_entry["gptid"]
+    return f"guid {disk_entry['zfs_guid']}"
+
+def build_disk_entry(disk_child, guid_to_disk, devname_to_disk, smart_results=None, trends=None,
+                     latency=None, rules=None, pending=None):
+    """Collect a disk's identity, ZFS errors, SMART data and warnings.
+
+    trends maps serials to the counter trends from the SMART history, if kept;
+    latency maps ZFS GUIDs to the latency compared with the vdev peers, if sampled.
+    With a pending list the (entry, SMART data, trends) row is appended to it
+    instead of evaluating the warnings, so many disks can be scored at once.
+    smartctl is never run here: a disk missing from smart_results, or a
+    removed or faulted member with no disk at all, has no SMART data.
+    """
+    # Get basic disk info; a member that is not present has no device (see disk_label)
     part_device = disk_child.get('device', 'UNKNOWN')
     whole_disk = disk_child.get('disk', 'UNKNOWN')
     zfs_guid = disk_child.get('guid', '')
     
     # Find matching disk info
-    disk_info = guid_to_disk.get(str(zfs_guid)) or devname_to_disk.get(whole_disk) or {}
+    disk_info = lookup_disk_info(disk_child, guid_to_disk, devname_to_disk)
     
     # Get stats and errors
     stats = disk_child.get('stats', {})
-    read_errors = stats.get('read_errors', 0)
-    write_errors = stats.get('write_errors', 0)
-    checksum_errors = stats.get('checksum_errors', 0)
-    
-    errors = f"ZFS Read: \033[1;31m{read_errors}\033[0m, " \
-             f"ZFS Write: \033[1;31m{write_errors}\033[0m, " \
-             f"ZFS Checksum: \033[1;31m{checksum_errors}\033[0m"
     
     # Format size
     raw_size = disk_info.get('size', 0)
@@ -312,26 +3865,14 @@ def print_disk(disk_child, guid_to_disk, devname_to_disk, indent):
     elif 'path' in disk_child and 'gptid' in disk_child['path']:
         gptid = disk_child['path']
     
-    # Print disk information
-    indent_str = "  " * indent
-    print(f"{indent_str}\033[1;32mPool Device: /dev/{part_device}\033[0m")
-    print(f"{indent_str}├─ ZFS GUID: \033[1;35m{zfs_guid}\033[0m")
-    print(f"{indent_str}├─ Physical Disk: /dev/{whole_disk}")
-    print(f"{indent_str}├─ Errors: {errors}")
-    print(f"{indent_str}├─ Serial: \033[1;34m{disk_info.get('serial', 'UNKNOWN')}\033[0m")
-    print(f"{indent_str}├─ Model: {disk_info.get('model', 'UNKNOWN')}")
-    print(f"{indent_str}├─ Size: {size_human} ({raw_size} bytes)")
-    print(f"{indent_str}└─ GPTID: \033[1;35m{gptid}\033[0m")
-    
-    # Create disk entry for JSON
     disk_entry = {
         "partition": part_device,
         "disk": whole_disk,
         "zfs_guid": zfs_guid,
         "errors": {
-            "read": read_errors,
-            "write": write_errors,
-            "checksum": checksum_errors
+            "read": stats.get('read_errors', 0),
+            "write": stats.get('write_errors', 0),
+            "checksum": stats.get('checksum_errors', 0)
         },
         "serial": disk_info.get('serial', 'UNKNOWN'),
         "model": disk_info.get('model', 'UNKNOWN'),
@@ -342,53 +3883,32 @@ def print_disk(disk_child, guid_to_disk, devname_to_disk, indent):
     }
     
     # Get and parse SMART data
-    print(f"{indent_str}{'-' * 60}")
-    print(f"{indent_str}\033[1;34mSMART DATA FOR /dev/{whole_disk}:\033[0m")
-    
-    smart_output = get_smart_data(whole_disk)
-    smart_data = parse_smart_data(smart_output) if not smart_output.startswith("Error") else {}
+    if whole_disk is None:
+        smart_result = {"output": f"Error: no disk present for {disk_label(disk_entry)}", "data": {}}
+    elif smart_results is not None and whole_disk in smart_results:
+        smart_result = smart_results[whole_disk]
+    else:
+        smart_result = {"output": f"Error: no SMART data collected for /dev/{whole_disk}", "data": {}}
+    smart_output = smart_result['output']
+    smart_data = smart_result['data']
     
     if smart_data:
-        # Health status with color coding
         health_status = smart_data.get('health_status', 'UNKNOWN')
-        status_color = "\033[1;32m" if health_status == "PASSED" else "\033[1;31m"
         drive_type = smart_data.get('drive_type', 'UNKNOWN')
         power_on_hours = smart_data.get('power_on_hours', 'N/A')
         
-        print(f"{indent_str}├─ Drive Type: {drive_type}")
-        print(f"{indent_str}├─ Health Status: {status_color}{health_status}\033[0m")
-        print(f"{indent_str}├─ Power On Hours: \033[1;33m{power_on_hours}\033[0m")
-        
         # Handle different drive types
         if drive_type == "NVMe":
-            media_errors = smart_data.get('media_errors', 0)
-            error_log_entries = smart_data.get('error_log_entries', 0)
-            print(f"{indent_str}├─ Media Integrity Errors: \033[1;31m{media_errors}\033[0m")
-            print(f"{indent_str}├─ Error Log Entries: \033[1;31m{error_log_entries}\033[0m")
-            
-            # Add to JSON
             disk_entry["smart_data"] = {
                 "drive_type": drive_type,
                 "health_status": health_status,
                 "power_on_hours": power_on_hours,
-                "media_errors": media_errors,
-                "error_log_entries": error_log_entries
+                "media_errors": smart_data.get('media_errors', 0),
+                "error_log_entries": smart_data.get('error_log_entries', 0),
+                "health_log": smart_data['nvme_health'].as_dict() if smart_data.get('nvme_health') else None
             }
             
         elif drive_type == "SAS":
-            print(f"{indent_str}├─ Uncorrected Errors:")
-            print(f"{indent_str}│  ├─ Read: \033[1;31m{smart_data.get('read_errors', 0)}\033[0m")
-            print(f"{indent_str}│  ├─ Write: \033[1;31m{smart_data.get('write_errors', 0)}\033[0m")
-            print(f"{indent_str}│  └─ Verify: \033[1;31m{smart_data.get('verify_errors', 0)}\033[0m")
-            print(f"{indent_str}├─ Grown Defects: \033[1;31m{smart_data.get('grown_defects', 0)}\033[0m")
-            
-            # Show corrected errors for SAS drives
-            print(f"{indent_str}├─ Corrected Errors:")
-            print(f"{indent_str}│  ├─ Read: \033[1;33m{smart_data.get('read_corrected', 0)}\033[0m")
-            print(f"{indent_str}│  ├─ Write: \033[1;33m{smart_data.get('write_corrected', 0)}\033[0m")
-            print(f"{indent_str}│  └─ Verify: \033[1;33m{smart_data.get('verify_corrected', 0)}\033[0m")
-            
-            # Add to JSON
             disk_entry["smart_data"] = {
                 "drive_type": drive_type,
                 "health_status": health_status,
@@ -403,17 +3923,14 @@ def print_disk(disk_child, guid_to_disk, devname_to_disk, indent):
                     "read": smart_data.get('read_corrected', 0),
                     "write": smart_data.get('write_corrected', 0),
                     "verify": smart_data.get('verify_corrected', 0)
+                },
+                "error_counters": {
+                    operation: counter.as_dict()
+                    for operation, counter in smart_data.get('error_counters', {}).items()
                 }
             }
             
         else:  # SATA
-            print(f"{indent_str}├─ SMART Attributes:")
-            print(f"{indent_str}│  ├─ Raw Read Error Rate: \033[1;31m{smart_data.get('raw_read_error_rate', 0)}\033[0m")
-            print(f"{indent_str}│  ├─ Seek Error Rate: \033[1;31m{smart_data.get('seek_error_rate', 0)}\033[0m")
-            print(f"{indent_str}│  ├─ Offline Uncorrectable: \033[1;31m{smart_data.get('offline_uncorrectable', 0)}\033[0m")
-            print(f"{indent_str}│  └─ UDMA CRC Error Count: \033[1;31m{smart_data.get('udma_crc_error_count', 0)}\033[0m")
-            
-            # Add to JSON
             disk_entry["smart_data"] = {
                 "drive_type": drive_type,
                 "health_status": health_status,
@@ -421,175 +3938,807 @@ def print_disk(disk_child, guid_to_disk, devname_to_disk, indent):
                 "raw_read_error_rate": smart_data.get('raw_read_error_rate', 0),
                 "seek_error_rate": smart_data.get('seek_error_rate', 0),
                 "offline_uncorrectable": smart_data.get('offline_uncorrectable', 0),
-                "udma_crc_error_count": smart_data.get('udma_crc_error_count', 0)
+                "udma_crc_error_count": smart_data.get('udma_crc_error_count', 0),
+                "attributes": [attribute.as_dict() for attribute in smart_data.get('attributes', [])]
             }
         
         # Last test information with time ago
         last_test = smart_data.get('last_test', {})
-        test_description = last_test.get('description', 'N/A')
-        test_status = last_test.get('status', 'N/A')
         test_hours = last_test.get('lifetime_hours', 'N/A')
         
         # Calculate time since test if possible
         time_since = "N/A"
-        if power_on_hours != "极N/A" and test_hours != "N/A" and isinstance(power_on_hours, int) and isinstance(test_hours, int):
+        if isinstance(power_on_hours, int) and isinstance(test_hours, int):
             time_since = format_time_ago(power_on_hours, test_hours)
         
-        print(f"{indent_str}└─ Last Test: \033[1;35m{test_description}\033[0m")
-        print(f"{indent_str}   ├─ Status: {test_status}")
-        print(f"{indent_str}   ├─ Lifetime Hours: {test_hours}")
-        print(f"{indent_str}   └─ Time Since: {time_since}")
-        
-        # Add last test to JSON
-        if disk_entry["smart_data"]:
-            disk_entry["smart_data"]["last_test"] = {
-                "description": test_description,
-                "status": test_status,
-                "lifetime_hours": test_hours,
-                "time_since": time_since
-            }
+        disk_entry["smart_data"]["firmware"] = smart_data.get('firmware')
+        disk_entry["smart_data"]["last_test"] = {
+            "description": last_test.get('description', 'N/A'),
+            "status": last_test.get('status', 'N/A'),
+            "lifetime_hours": test_hours,
+            "time_since": time_since
+        }
+        disk_entry["smart_data"]["captured"] = datetime.fromtimestamp(smart_result['captured']).isoformat()
+        disk_entry["smart_data"]["cached"] = smart_result['cached']
     else:
-        print(f"{indent_str}\033[1;31mSMART data unavailable: {smart_output[:200]}{'...' if len(smart_output) > 200 else ''}\033[0m")
         disk_entry["smart_data"] = {
             "error": smart_output[:200] + ('...' if len(smart_output) > 200 else '')
         }
+    if smart_result.get('standby'):
+        disk_entry["smart_data"]["standby"] = smart_result['standby']
+    if smart_result.get('timed_out'):
+        disk_entry["smart_data"]["timed_out"] = smart_result['timed_out']
     
-    # Initialize warning variables
-    critical_reasons = []
-    caution_reasons = []
-    slowdown_reasons = []
-    test_warning = False
-    
-    # Check critical conditions (immediate replacement)
-    if read_errors > 0 or write_errors > 0 or checksum_errors > 0:
-        if read_errors > 0:
-            critical_reasons.append(f"ZFS Read errors: {read_errors}")
-        if write_errors > 0:
-            critical_reasons.append(f"ZFS Write errors: {write_errors}")
-        if checksum_errors > 0:
-            critical_reasons.append(f"ZFS Checksum errors: {checksum_errors}")
-    
-    # Check drive-specific critical conditions
-    if smart_data:
-        drive_type = smart_data.get('drive_type', 'UNKNOWN')
+    disk_trends = None
+    if trends is not None:
+        disk_trends = trends.get(disk_entry["serial"], {})
+        disk_entry["trends"] = disk_trends
+    if latency is not None:
+        disk_entry["latency"] = latency.get(str(zfs_guid))
+    
+    if pending is not None:
+        pending.append((disk_entry, smart_data, disk_trends))
+    else:
+        disk_entry["warnings"] = evaluate_warnings(disk_entry, smart_data, disk_trends, rules)
+    return disk_entry
+
+# Health rules, applied in order. Each compares a metric column (see
+# MetricTable) with a value; "when" adds conditions on other columns and
+# "critical_reasons" counts the critical reasons found by earlier rules.
+# --rules FILE replaces the rules and/or adds overrides for models and
+# firmwares; --dump-rules prints these defaults as a starting point.
+DEFAULT_RULES = {
+    "rules": [
+        {"id": "zfs-read-errors", "metric": "zfs_read_errors", "op": ">", "value": 0,
+         "severity": "critical", "message": "ZFS Read errors: {value}"},
+        {"id": "zfs-write-errors", "metric": "zfs_write_errors", "op": ">", "value": 0,
+         "severity": "critical", "message": "ZFS Write errors: {value}"},
+        {"id": "zfs-checksum-errors", "metric": "zfs_checksum_errors", "op": ">", "value": 0,
+         "severity": "critical", "message": "ZFS Checksum errors: {value}"},
         
-        if drive_type == "NVMe":
-            media_errors = smart_data.get('media_errors', 0)
-            if media_errors > 0:
-                critical_reasons.append(f"Media Integrity Errors: {media_errors}")
-                
-        elif drive_type == "SAS":
-            # SAS-specific critical errors
-            sas_read_errors = smart_data.get('read_errors', 0)
-            sas_write_errors = smart_data.get('write_errors', 0)
-            sas_verify_errors = smart_data.get('verify_errors', 0)
-            
-            if sas_read_errors > 0:
-                critical_reasons.append(f"SAS Read Errors: {sas_read_errors}")
-            if sas_write_errors > 0:
-                critical_reasons.append(f"SAS Write Errors: {sas_write_errors}")
-            if sas_verify_errors > 0:
-                critical_reasons.append(f"SAS Verify Errors: {sas_verify_errors}")
-                
-            # Check for critical corrected errors
-            read_corrected = smart_data.get('read_corrected', 0)
-            write_corrected = smart_data.get('write_corrected', 0)
-            verify_corrected = smart_data.get('verify_corrected', 0)
-            
-            # Critical threshold (>1,000,000)
-            if read_corrected > 1000000:
-                critical_reasons.append(f"Critical corrected read errors: {read_corrected}")
-            if write_corrected > 1000000:
-                critical_reasons.append(f"Critical corrected write errors: {write_corrected}")
-            if verify_corrected > 1000000:
-                critical_reasons.append(f"Critical corrected verify errors: {verify_corrected}")
-                
-            # Performance threshold (>100,000)
-            if read_corrected > 100000:
-                slowdown_reasons.append(f"Corrected read errors: {read_corrected}")
-            if write_corrected > 100000:
-                slowdown_reasons.append(f"Corrected write errors: {write_corrected}")
-            if verify_corrected > 100000:
-                slowdown_reasons.append(f"Corrected verify errors: {verify_corrected}")
-                
-            # Caution threshold (>10,000)
-            if 10000 < read_corrected <= 100000:
-                caution_reasons.append(f"Corrected read errors: {read_corrected}")
-            if 10000 < write_corrected <= 100000:
-                caution_reasons.append(f"Corrected write errors: {write_corrected}")
-            if 10000 < verify_corrected <= 100000:
-                caution_reasons.append(f"Corrected verify errors: {verify_corrected}")
-                
-            # Grown defects as caution
-            grown_defects = smart_data.get('grown_defects', 0)
-            if grown_defects > 0:
-                caution_reasons.append(f"Grown Defects: {grown_defects}")
-                
-        else:  # SATA
-            # SATA-specific critical errors
-            offline_uncorrect = smart_data.get('offline_uncorrectable', 0)
-            if offline_uncorrect > 0:
-                critical_reasons.append(f"Offline Uncorrectable: {offline_uncorrect}")
-            
-            # Check caution conditions for the other attributes
-            raw_read = smart_data.get('raw_read_error_rate', 0)
-            seek = smart_data.get('seek_error_rate', 0)
-            udma = smart_data.get('udma_crc_error_count', 0)
+        {"id": "nvme-media-errors", "drive_type": "NVMe", "metric": "media_errors", "op": ">", "value": 0,
+         "severity": "critical", "message": "Media Integrity Errors: {value}"},
+        
+        {"id": "sas-read-uncorrected", "drive_type": "SAS", "metric": "read_errors", "op": ">", "value": 0,
+         "severity": "critical", "message": "SAS Read Errors: {value}"},
+        {"id": "sas-write-uncorrected", "drive_type": "SAS", "metric": "write_errors", "op": ">", "value": 0,
+         "severity": "critical", "message": "SAS Write Errors: {value}"},
+        {"id": "sas-verify-uncorrected", "drive_type": "SAS", "metric": "verify_errors", "op": ">", "value": 0,
+         "severity": "critical", "message": "SAS Verify Errors: {value}"},
+        # Some firmware counts corrected errors high by design; a count that isn't moving is not a problem
+        {"id": "sas-read-corrected-critical", "drive_type": "SAS", "metric": "read_corrected", "op": ">",
+         "value": 1000000, "when": {"read_corrected_flat": {"!=": True}},
+         "severity": "critical", "message": "Critical corrected read errors: {value}"},
+        {"id": "sas-write-corrected-critical", "drive_type": "SAS", "metric": "write_corrected", "op": ">",
+         "value": 1000000, "when": {"write_corrected_flat": {"!=": True}},
+         "severity": "critical", "message": "Critical corrected write errors: {value}"},
+        {"id": "sas-verify-corrected-critical", "drive_type": "SAS", "metric": "verify_corrected", "op": ">",
+         "value": 1000000, "when": {"verify_corrected_flat": {"!=": True}},
+         "severity": "critical", "message": "Critical corrected verify errors: {value}"},
+        {"id": "sas-read-corrected-slowdown", "drive_type": "SAS", "metric": "read_corrected", "op": ">",
+         "value": 100000, "when": {"read_corrected_flat": {"!=": True}},
+         "severity": "slowdown", "message": "Corrected read errors: {value}"},
+        {"id": "sas-write-corrected-slowdown", "drive_type": "SAS", "metric": "write_corrected", "op": ">",
+         "value": 100000, "when": {"write_corrected_flat": {"!=": True}},
+         "severity": "slowdown", "message": "Corrected write errors: {value}"},
+        {"id": "sas-verify-corrected-slowdown", "drive_type": "SAS", "metric": "verify_corrected", "op": ">",
+         "value": 100000, "when": {"verify_corrected_flat": {"!=": True}},
+         "severity": "slowdown", "message": "Corrected verify errors: {value}"},
+        {"id": "sas-read-corrected-caution", "drive_type": "SAS", "metric": "read_corrected", "op": ">",
+         "value": 10000, "when": {"read_corrected": {"<=": 100000}, "read_corrected_flat": {"!=": True}},
+         "severity": "caution", "message": "Corrected read errors: {value}"},
+        {"id": "sas-write-corrected-caution", "drive_type": "SAS", "metric": "write_corrected", "op": ">",
+         "value": 10000, "when": {"write_corrected": {"<=": 100000}, "write_corrected_flat": {"!=": True}},
+         "severity": "caution", "message": "Corrected write errors: {value}"},
+        {"id": "sas-verify-corrected-caution", "drive_type": "SAS", "metric": "verify_corrected", "op": ">",
+         "value": 10000, "when": {"verify_corrected": {"<=": 100000}, "verify_corrected_flat": {"!=": True}},
+         "severity": "caution", "message": "Corrected verify errors: {value}"},
+        {"id": "sas-grown-defects", "drive_type": "SAS", "metric": "grown_defects", "op": ">", "value": 0,
+         "severity": "caution", "message": "Grown Defects: {value}"},
+        
+        {"id": "sata-offline-uncorrectable", "drive_type": "SATA", "metric": "offline_uncorrectable",
+         "op": ">", "value": 0, "severity": "critical", "message": "Offline Uncorrectable: {value}"},
+        {"id": "sata-raw-read-error-rate", "drive_type": "SATA", "metric": "raw_read_error_rate",
+         "op": ">", "value": 0, "when": {"critical_reasons": {"==": 0}},
+         "severity": "caution", "message": "Raw Read Error Rate: {value}"},
+        {"id": "sata-seek-error-rate", "drive_type": "SATA", "metric": "seek_error_rate",
+         "op": ">", "value": 0, "when": {"critical_reasons": {"==": 0}},
+         "severity": "caution", "message": "Seek Error Rate: {value}"},
+        {"id": "sata-udma-crc-errors", "drive_type": "SATA", "metric": "udma_crc_error_count",
+         "op": ">", "value": 0, "when": {"critical_reasons": {"==": 0}},
+         "severity": "caution", "message": "UDMA CRC Error Count: {value}"},
+        
+        {"id": "nvme-error-log-entries", "drive_type": "NVMe", "metric": "error_log_entries",
+         "op": ">", "value": 0, "when": {"critical_reasons": {"==": 0}},
+         "severity": "caution", "message": "Error Log Entries: {value}"},
+        
+        {"id": "sata-read-errors", "drive_type": "SATA", "metric": "read_errors", "op": ">", "value": 0,
+         "when": {"read_errors": {"<=": 10}, "critical_reasons": {"==": 0}},
+         "severity": "caution", "message": "SATA Read Errors: {value}"},
+        {"id": "sata-write-errors", "drive_type": "SATA", "metric": "write_errors", "op": ">", "value": 0,
+         "when": {"write_errors": {"<=": 10}, "critical_reasons": {"==": 0}},
+         "severity": "caution", "message": "SATA Write Errors: {value}"},
+        {"id": "sata-verify-errors", "drive_type": "SATA", "metric": "verify_errors", "op": ">", "value": 0,
+         "when": {"verify_errors": {"<=": 10}, "critical_reasons": {"==": 0}},
+         "severity": "caution", "message": "SATA Verify Errors: {value}"},
+        
+        # Rate of change, from the SMART history (<counter>_recent_delta and friends)
+        {"id": "sas-read-corrected-accelerating", "drive_type": "SAS", "metric": "read_corrected_recent_delta",
+         "op": ">=", "value": 1000, "when": {"read_corrected_accelerating": {"==": True}}, "severity": "slowdown",
+         "message": "Corrected read errors accelerating: +{read_corrected_recent_per_day:g}/day "
+                    "(was +{read_corrected_earlier_per_day:g}/day)"},
+        {"id": "sas-write-corrected-accelerating", "drive_type": "SAS", "metric": "write_corrected_recent_delta",
+         "op": ">=", "value": 1000, "when": {"write_corrected_accelerating": {"==": True}}, "severity": "slowdown",
+         "message": "Corrected write errors accelerating: +{write_corrected_recent_per_day:g}/day "
+                    "(was +{write_corrected_earlier_per_day:g}/day)"},
+        {"id": "sas-verify-corrected-accelerating", "drive_type": "SAS", "metric": "verify_corrected_recent_delta",
+         "op": ">=", "value": 1000, "when": {"verify_corrected_accelerating": {"==": True}}, "severity": "slowdown",
+         "message": "Corrected verify errors accelerating: +{verify_corrected_recent_per_day:g}/day "
+                    "(was +{verify_corrected_earlier_per_day:g}/day)"},
+        {"id": "sas-grown-defects-accelerating", "drive_type": "SAS", "metric": "grown_defects_recent_delta",
+         "op": ">=", "value": 1, "when": {"grown_defects_accelerating": {"==": True}}, "severity": "critical",
+         "message": "Grown Defects accelerating: +{grown_defects_recent_per_day:g}/day "
+                    "(was +{grown_defects_earlier_per_day:g}/day)"},
+        {"id": "nvme-media-errors-accelerating", "drive_type": "NVMe", "metric": "media_errors_recent_delta",
+         "op": ">=", "value": 1, "when": {"media_errors_accelerating": {"==": True}}, "severity": "critical",
+         "message": "Media Integrity Errors accelerating: +{media_errors_recent_per_day:g}/day "
+                    "(was +{media_errors_earlier_per_day:g}/day)"},
+        {"id": "nvme-error-log-entries-accelerating", "drive_type": "NVMe",
+         "metric": "error_log_entries_recent_delta", "op": ">=", "value": 1,
+         "when": {"error_log_entries_accelerating": {"==": True}}, "severity": "caution",
+         "message": "Error Log Entries accelerating: +{error_log_entries_recent_per_day:g}/day "
+                    "(was +{error_log_entries_earlier_per_day:g}/day)"},
+        {"id": "sata-offline-uncorrectable-accelerating", "drive_type": "SATA",
+         "metric": "offline_uncorrectable_recent_delta", "op": ">=", "value": 1,
+         "when": {"offline_uncorrectable_accelerating": {"==": True}}, "severity": "critical",
+         "message": "Offline Uncorrectable accelerating: +{offline_uncorrectable_recent_per_day:g}/day "
+                    "(was +{offline_uncorrectable_earlier_per_day:g}/day)"},
+        {"id": "sata-udma-crc-errors-accelerating", "drive_type": "SATA",
+         "metric": "udma_crc_error_count_recent_delta", "op": ">=", "value": 1,
+         "when": {"udma_crc_error_count_accelerating": {"==": True}}, "severity": "caution",
+         "message": "UDMA CRC Error Count accelerating: +{udma_crc_error_count_recent_per_day:g}/day "
+                    "(was +{udma_crc_error_count_earlier_per_day:g}/day)"},
+        {"id": "sas-read-corrected-onset", "drive_type": "SAS", "metric": "read_corrected_recent_delta",
+         "op": ">=", "value": 1000, "when": {"read_corrected_onset": {"==": True}}, "severity": "slowdown",
+         "message": "Corrected read errors started growing: +{read_corrected_recent_per_day:g}/day, was flat"},
+        {"id": "sas-write-corrected-onset", "drive_type": "SAS", "metric": "write_corrected_recent_delta",
+         "op": ">=", "value": 1000, "when": {"write_corrected_onset": {"==": True}}, "severity": "slowdown",
+         "message": "Corrected write errors started growing: +{write_corrected_recent_per_day:g}/day, was flat"},
+        {"id": "sas-verify-corrected-onset", "drive_type": "SAS", "metric": "verify_corrected_recent_delta",
+         "op": ">=", "value": 1000, "when": {"verify_corrected_onset": {"==": True}}, "severity": "slowdown",
+         "message": "Corrected verify errors started growing: +{verify_corrected_recent_per_day:g}/day, was flat"},
+        {"id": "sas-grown-defects-onset", "drive_type": "SAS", "metric": "grown_defects_recent_delta",
+         "op": ">=", "value": 1, "when": {"grown_defects_onset": {"==": True}}, "severity": "critical",
+         "message": "Grown Defects started growing: +{grown_defects_recent_per_day:g}/day, was flat"},
+        {"id": "nvme-media-errors-onset", "drive_type": "NVMe", "metric": "media_errors_recent_delta",
+         "op": ">=", "value": 1, "when": {"media_errors_onset": {"==": True}}, "severity": "critical",
+         "message": "Media Integrity Errors started growing: +{media_errors_recent_per_day:g}/day, was flat"},
+        {"id": "nvme-error-log-entries-onset", "drive_type": "NVMe",
+         "metric": "error_log_entries_recent_delta", "op": ">=", "value": 1,
+         "when": {"error_log_entries_onset": {"==": True}}, "severity": "caution",
+         "message": "Error Log Entries started growing: +{error_log_entries_recent_per_day:g}/day, was flat"},
+        {"id": "sata-offline-uncorrectable-onset", "drive_type": "SATA",
+         "metric": "offline_uncorrectable_recent_delta", "op": ">=", "value": 1,
+         "when": {"offline_uncorrectable_onset": {"==": True}}, "severity": "critical",
+         "message": "Offline Uncorrectable started growing: +{offline_uncorrectable_recent_per_day:g}/day, was flat"},
+        {"id": "sata-udma-crc-errors-onset", "drive_type": "SATA",
+         "metric": "udma_crc_error_count_recent_delta", "op": ">=", "value": 1,
+         "when": {"udma_crc_error_count_onset": {"==": True}}, "severity": "caution",
+         "message": "UDMA CRC Error Count started growing: +{udma_crc_error_count_recent_per_day:g}/day, was flat"},
+        
+        # Measured with --latency against the other disks in the vdev
+        {"id": "read-latency", "metric": "read_latency_slow", "op": "==", "value": True, "severity": "slowdown",
+         "message": "Read latency: {read_latency_ms:.1f} ms, {read_latency_ratio} its vdev peers "
+                    "({read_latency_peer_ms:.1f} ms)"},
+        {"id": "write-latency", "metric": "write_latency_slow", "op": "==", "value": True, "severity": "slowdown",
+         "message": "Write latency: {write_latency_ms:.1f} ms, {write_latency_ratio} its vdev peers "
+                    "({write_latency_peer_ms:.1f} ms)"},
+        
+        {"id": "smart-test-overdue", "metric": "days_since_test", "op": ">", "value": 60,
+         "when": {"critical_reasons": {"==": 0}, "test_completed": {"==": True}},
+         "severity": "caution", "test_warning": True,
+         "message": "Last SMART test was {days_since_test!i} days ago - recommend running a new test"},
+    ],
+    # e.g. {"model": "ST*", "firmware": "E00*", "rules": {"sas-read-corrected-caution": {"value": 50000}}}
+    "overrides": [],
+}
+
+RULE_OPERATORS = {
+    ">": operator.gt, ">=": operator.ge, "<": operator.lt, "<=": operator.le,
+    "==": operator.eq, "!=": operator.ne,
+}
+RULE_SEVERITIES = ('critical', 'caution', 'slowdown')
+RULE_FIELDS = ('id', 'drive_type', 'metric', 'op', 'value', 'when', 'severity', 'message', 'test_warning',
+               'enabled')
+
+class RuleFormatter(string.Formatter):
+    """str.format with an extra !i conversion that truncates to an int"""
+
+    def convert_field(self, value, conversion):
+        if conversion == 'i':
+            return int(value)
+        return super().convert_field(value, conversion)
+
+RULE_FORMATTER = RuleFormatter()
+
+class Rule:
+    """One compiled health rule"""
+    __slots__ = ('id', 'drive_types', 'metric', 'op', 'value', 'when', 'severity', 'message',
+                 'fields', 'test_warning', 'enabled', 'spec')
+
+    def __init__(self, spec):
+        unknown = set(spec) - set(RULE_FIELDS)
+        if unknown:
+            raise ValueError(f"rule {spec.get('id')!r}: unknown field {', '.join(sorted(unknown))}")
+        for field in ('id', 'metric', 'op', 'severity', 'message'):
+            if field not in spec:
+                raise ValueError(f"rule {spec.get('id')!r}: missing {field!r}")
+        if spec['severity'] not in RULE_SEVERITIES:
+            raise ValueError(f"rule {spec['id']!r}: severity must be one of {', '.join(RULE_SEVERITIES)}")
+        self.spec = spec
+        self.id = spec['id']
+        drive_type = spec.get('drive_type')
+        self.drive_types = None if drive_type is None else \
+            frozenset([drive_type] if isinstance(drive_type, str) else drive_type)
+        self.metric = spec['metric']
+        self.op = self._operator(spec['op'])
+        self.value = spec.get('value')
+        self.when = [(column, self._operator(op), value)
+                     for column, conditions in spec.get('when', {}).items()
+                     for op, value in conditions.items()]
+        self.severity = spec['severity']
+        self.message = spec['message']
+        # Columns the message refers to, besides {value}
+        self.fields = {re.match(r"\w*", field).group(0)
+                       for _, field, _, _ in RULE_FORMATTER.parse(self.message) if field} - {'value'}
+        self.test_warning = bool(spec.get('test_warning'))
+        self.enabled = spec.get('enabled', True)
+
+    def _operator(self, op):
+        if op not in RULE_OPERATORS:
+            raise ValueError(f"rule {self.spec['id']!r}: unknown operator {op!r}")
+        return RULE_OPERATORS[op]
+
+    def patched(self, changes):
+        """Return this rule with some fields replaced, as an override does"""
+        if 'id' in changes:
+            raise ValueError(f"override of rule {self.id!r} cannot change its id")
+        return Rule(dict(self.spec, **changes))
+
+    def select(self, table, rows=None):
+        """Return the rows (indices) this rule fires for, one column at a time;
+        rows limits it to some disks"""
+        if self.drive_types is not None:
+            if rows is None:
+                rows = sorted(i for drive_type in self.drive_types for i in table.drive_type_rows(drive_type))
+            else:
+                drive_types = table.column('drive_type')
+                rows = [i for i in rows if drive_types[i] in self.drive_types]
+        elif rows is None:
+            rows = range(table.size)
+        # The metric first, it rules out most disks
+        rows = _filter(self.op, table.column(self.metric), rows, self.value)
+        for column_name, op, value in self.when:
+            rows = _filter(op, table.column(column_name), rows, value)
+        return rows
+
+    def columns(self):
+        """Every column this rule reads"""
+        columns = {self.metric, *self.fields, *(column for column, op, value in self.when)}
+        return columns | {'drive_type'} if self.drive_types is not None else columns
+
+    def reason(self, table, i):
+        values = table.row(i, self.fields)
+        value = table.column(self.metric)[i]
+        if '!i' in self.message:
+            return RULE_FORMATTER.format(self.message, value=value, **values)
+        return self.message.format(value=value, **values)
+
+def _compare(op, left, right):
+    """op(left, right); a missing value only passes "!=", and values that don't compare fail"""
+    if left is None:
+        return op is operator.ne
+    try:
+        return op(left, right)
+    except TypeError:
+        return False
+
+def _filter(op, column, rows, value):
+    """The rows whose value in column passes op(value in column, value), see _compare"""
+    if op is operator.ne:
+        return [i for i in rows if column[i] != value]
+    try:
+        return [i for i in rows if column[i] is not None and op(column[i], value)]
+    except TypeError:
+        return [i for i in rows if _compare(op, column[i], value)]
+
+# Fields of a counter trend (see analyze_trend), longest first for matching column names
+TREND_FIELDS = ('earlier_per_day', 'recent_per_day', 'recent_delta', 'accelerating', 'span_days',
+                'per_day', 'onset', 'delta', 'flat')
+# Counters that have trends; another SMART key with a trend field suffix is just a SMART key
+TREND_COUNTERS = frozenset(itertools.chain.from_iterable(HISTORY_COUNTERS.values()))
+
+class MetricTable:
+    """The metrics of many disks, one list per column, for evaluating rules in batch.
+
+    Columns: zfs_{read,write,checksum}_errors, model, serial, any scalar of
+    the parsed SMART data (drive_type, firmware, read_corrected, media_errors,
+    ...), attribute_<id> for SATA raw values, nvme_<field> for the NVMe health
+    log, <counter>_<field> for the trends of HISTORY_COUNTERS (accelerating,
+    recent_delta, flat, ...), {read,write}_latency_{ms,peer_ms,slow,ratio}, days_since_test
+    and test_completed. Missing values are None.
+    """
+
+    def __init__(self, rows, columns):
+        """rows: (disk_entry, parsed SMART data, trends) for each disk; only
+        the named columns are filled in, in a single pass over the disks"""
+        self.size = len(rows)
+        self.columns = {}
+        self._drive_type_rows = None
+        entries = [disk_entry for disk_entry, _, _ in rows]
+        smart_datas = [smart_data or {} for _, smart_data, _ in rows]
+
+        # Columns with one source per disk are built a column at a time, the
+        # sparse ones (latency, trends) a disk at a time
+        latency, trend = [], {}
+        for name in columns:
+            if name.startswith("zfs_") and name.endswith("_errors"):
+                error_type = name[4:-7]
+                column = [disk_entry["errors"].get(error_type) for disk_entry in entries]
+            elif name in ("model", "serial"):
+                column = [disk_entry[name] for disk_entry in entries]
+            elif name.startswith("attribute_") and name[10:].isdigit():
+                attribute_id = int(name[10:])
+                column = [next((attribute.raw for attribute in smart_data.get('attributes', ())
+                                if attribute.id == attribute_id), None) for smart_data in smart_datas]
+            elif name.startswith("nvme_") and name[5:] in NvmeHealth.__slots__:
+                field = name[5:]
+                column = [getattr(smart_data['nvme_health'], field)
+                          if smart_data.get('nvme_health') is not None else None for smart_data in smart_datas]
+            elif name in ("days_since_test", "test_completed"):
+                column = [self._test(smart_data, name) if smart_data else None for smart_data in smart_datas]
+            elif name.startswith(("read_latency_", "write_latency_")):
+                direction, _, field = name.partition("_latency_")
+                column = [None] * self.size
+                latency.append((direction, field, column))
+            else:
+                # Trend columns are <counter>_<field> of a history counter, anything else is a SMART key
+                field = next((field for field in TREND_FIELDS if name.endswith(f"_{field}")
+                              and name[:-len(field) - 1] in TREND_COUNTERS), None)
+                if field is not None:
+                    column = [None] * self.size
+                    trend[(name[:-len(field) - 1], field)] = column
+                else:
+                    column = [smart_data.get(name) for smart_data in smart_datas]
+            self.columns[name] = column
+
+        if not (latency or trend):
+            return
+        for i, (disk_entry, _, trends) in enumerate(rows):
+            if latency and disk_entry.get("latency"):
+                for direction, field, column in latency:
+                    column[i] = self._latency(disk_entry["latency"], direction, field)
+            if trends and trend:
+                for counter, counter_trend in trends.items():
+                    for field, value in counter_trend.items():
+                        column = trend.get((counter, field))
+                        if column is not None:
+                            column[i] = value
+
+    @staticmethod
+    def _latency(latency, direction, field):
+        if not latency:
+            return None
+        value = latency[f"{direction}_ms"]
+        peer = latency[f"peer_{direction}_ms"]
+        if field == "slow":
+            return direction in latency["slow"]
+        if field == "ratio":
+            if value is None or peer is None:
+                return None
+            return f"{value / peer:.1f}x" if peer else "far above"
+        return {"ms": value, "peer_ms": peer}.get(field)
+
+    @staticmethod
+    def _test(smart_data, name):
+        last_test = smart_data.get('last_test', {})
+        if name == "test_completed":
+            test_status = (last_test.get('status') or '').lower()
+            return 'completed' in test_status or 'success' in test_status
+        days_since = calculate_days_since(smart_data.get('power_on_hours', 'N/A'),
+                                          last_test.get('lifetime_hours', 'N/A'))
+        return days_since if isinstance(days_since, float) else None
+
+    def column(self, name):
+        column = self.columns.get(name)
+        return column if column is not None else [None] * self.size
+
+    def drive_type_rows(self, drive_type):
+        """Indices of the disks of a drive type"""
+        if self._drive_type_rows is None:
+            self._drive_type_rows = {}
+            for i, value in enumerate(self.column('drive_type')):
+                self._drive_type_rows.setdefault(value, []).append(i)
+        return self._drive_type_rows.get(drive_type, [])
+
+    def row(self, i, names):
+        """The values of row i in the named columns"""
+        return {name: self.columns[name][i] if name in self.columns else None for name in names}
+
+class RuleSet:
+    """Health rules compiled once and evaluated over a MetricTable of many disks.
+
+    Overrides match disks by model, firmware and drive type (shell-style
+    patterns) and replace fields of rules by id for those disks only.
+    """
+
+    def __init__(self, config=None):
+        config = DEFAULT_RULES if config is None else config
+        self.rules = [Rule(spec) for spec in config.get('rules', DEFAULT_RULES['rules'])]
+        ids = [rule.id for rule in self.rules]
+        duplicates = {rule_id for rule_id in ids if ids.count(rule_id) > 1}
+        if duplicates:
+            raise ValueError(f"duplicate rule ids: {', '.join(sorted(duplicates))}")
+        by_id = {rule.id: rule for rule in self.rules}
+        
+        self.overrides = []
+        for override in config.get('overrides', []):
+            patterns = {field: override[field] for field in ('model', 'firmware', 'drive_type') if field in override}
+            patched = {}
+            for rule_id, changes in override.get('rules', {}).items():
+                if rule_id not in by_id:
+                    raise ValueError(f"override for unknown rule {rule_id!r}")
+                patched[rule_id] = by_id[rule_id].patched(changes)
+            self.overrides.append((patterns, patched))
+        
+        self.columns = set()
+        for rule in self.rules:
+            self.columns |= rule.columns()
+        for patterns, patched in self.overrides:
+            self.columns.update(patterns)
+            for rule in patched.values():
+                self.columns |= rule.columns()
+
+    @classmethod
+    def load(cls, path):
+        """Compile the rules in a JSON file"""
+        with open(path) as f:
+            return cls(json.load(f))
+
+    def _variants(self, table):
+        """{rule id: {row: overridden rule}} for the disks an override matches"""
+        variants = {}
+        for patterns, patched in self.overrides:
+            rows = range(table.size)
+            for field, pattern in patterns.items():
+                column = table.column(field)
+                rows = [i for i in rows if column[i] is not None and fnmatch.fnmatchcase(str(column[i]), pattern)]
+            for rule_id, rule in patched.items():
+                variants.setdefault(rule_id, {}).update(dict.fromkeys(rows, rule))
+        return variants
+
+    def evaluate(self, rows):
+        """Return the warnings (critical, caution and slowdown reasons) for every
+        (disk_entry, smart_data, trends) row, evaluating one rule at a time over all disks"""
+        table = MetricTable(rows, self.columns)
+        warnings = [{"critical": [], "caution": [], "slowdown": [], "test_warning": False}
+                    for _ in range(table.size)]
+        # Rules can depend on the critical reasons found so far
+        critical_reasons = table.columns["critical_reasons"] = [0] * table.size
+        variants = self._variants(table)
+        
+        for rule in self.rules:
+            overridden = variants.get(rule.id, {})
+            if not overridden:
+                groups = [(rule, None)]
+            else:
+                groups = [(rule, [i for i in range(table.size) if i not in overridden])]
+            by_variant = {}
+            for i, variant in overridden.items():
+                by_variant.setdefault(id(variant), (variant, []))[1].append(i)
+            groups.extend(by_variant.values())
             
-            if raw_read > 0 and not critical_reasons:
-                caution_reasons.append(f"Raw Read Error Rate: {raw_read}")
-            if seek > 0 and not critical_reasons:
-                caution_reasons.append(f"Seek Error Rate: {seek}")
-            if udma > 0 and not critical_reasons:
-                caution_reasons.append(f"UDMA CRC Error Count: {udma}")
-    
-    # Check caution conditions (monitor closely)
-    if smart_data:
-        drive_type = smart_data.get('drive_type', 'UNKNOWN')
+            for variant, group_rows in groups:
+                if not variant.enabled or group_rows == []:
+                    continue
+                for i in variant.select(table, group_rows):
+                    warnings[i][variant.severity].append(variant.reason(table, i))
+                    if variant.test_warning:
+                        warnings[i]["test_warning"] = True
+                    if variant.severity == "critical":
+                        critical_reasons[i] += 1
+        return warnings
+
+    def apply(self, rows):
+        """Evaluate the rows and store the warnings in their disk entries"""
+        with TRACER.span("rules", f"{len(rows)} disks"):
+            results = self.evaluate(rows)
+        for (disk_entry, smart_data, trends), warnings in zip(rows, results):
+            disk_entry["warnings"] = warnings
+
+_default_rules = None
+
+def default_rules():
+    """The built-in RuleSet, compiled on first use"""
+    global _default_rules
+    if _default_rules is None:
+        _default_rules = RuleSet()
+    return _default_rules
+
+def evaluate_warnings(disk_entry, smart_data, trends=None, rules=None):
+    """Work out the critical, caution and slowdown reasons for a single disk.
+
+    With counter trends from the SMART history, corrected error counts that
+    stayed flat are not flagged and counters that are accelerating are. A
+    measured latency well above the vdev peers is a slowdown reason.
+    """
+    with TRACER.span("rules", disk_entry.get("disk")):
+        return (rules or default_rules()).evaluate([(disk_entry, smart_data, trends)])[0]
+
+# Counters compared between disks of the same model and firmware; higher is worse for all of them
+PEER_ZFS_METRICS = (("zfs_read_errors", "read"), ("zfs_write_errors", "write"), ("zfs_checksum_errors", "checksum"))
+# Paths into the report's smart_data of every drive type
+PEER_METRICS = {
+    "SAS": (("read_corrected", ("corrected_errors", "read")), ("write_corrected", ("corrected_errors", "write")),
+            ("verify_corrected", ("corrected_errors", "verify")), ("read_uncorrected", ("uncorrected_errors", "read")),
+            ("write_uncorrected", ("uncorrected_errors", "write")),
+            ("verify_uncorrected", ("uncorrected_errors", "verify")), ("grown_defects", ("grown_defects",))),
+    "NVMe": (("media_errors", ("media_errors",)), ("error_log_entries", ("error_log_entries",))),
+    "SATA": (("offline_uncorrectable", ("offline_uncorrectable",)),
+             ("udma_crc_error_count", ("udma_crc_error_count",))),
+}
+# SATA attributes compared by raw value (1 and 7 are packed differently by every vendor)
+PEER_ATTRIBUTES = {"reallocated_sectors": 5, "reported_uncorrect": 187, "command_timeout": 188,
+                   "pending_sectors": 197}
+PEER_MIN_GROUP = 5
+PEER_THRESHOLD = 3.5
+# The MAD of normally distributed values times this is their standard deviation
+MAD_TO_SIGMA = 1.4826
+# Spread assumed when nearly all peers agree (all zero, say), so a single count is no outlier
+PEER_MIN_SCALE = 1.0
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+def _format_number(value):
+    return f"{value:g}" if isinstance(value, float) else str(value)
+
+def peer_columns(disk_entries, drive_type):
+    """{metric: [value per disk]} of the counters of disks of one drive type, a column at a time.
+
+    With the SMART history kept, the daily growth of the history counters
+    is compared too, as <counter>_per_day.
+    """
+    columns = {}
+    for name, error_type in PEER_ZFS_METRICS:
+        columns[name] = [disk_entry["errors"].get(error_type) for disk_entry in disk_entries]
+    smart_datas = [disk_entry["smart_data"] for disk_entry in disk_entries]
+    for name, path in PEER_METRICS.get(drive_type, ()):
+        columns[name] = [_record_value(smart_data, path) for smart_data in smart_datas]
+    if drive_type == "SATA":
+        attributes = [{attribute.get("id"): attribute.get("raw") for attribute in smart_data.get("attributes") or ()}
+                      for smart_data in smart_datas]
+        for name, attribute_id in PEER_ATTRIBUTES.items():
+            columns[name] = [raw.get(attribute_id) for raw in attributes]
+    for counter in HISTORY_COUNTERS.get(drive_type, ()):
+        if counter != 'power_on_hours':
+            columns[f"{counter}_per_day"] = [((disk_entry.get("trends") or {}).get(counter) or {}).get("per_day")
+                                             for disk_entry in disk_entries]
+    return columns
+
+def peer_group(disk_entry):
+    """The (drive type, model, firmware) a disk is compared within, None without SMART data"""
+    smart_data = disk_entry.get("smart_data") or {}
+    if "drive_type" not in smart_data or disk_entry.get("model") in (None, 'UNKNOWN'):
+        return None
+    return smart_data["drive_type"], disk_entry["model"], smart_data.get("firmware")
+
+def iter_report_disks(report):
+    """Yield the disk entries of a single-host or fleet report"""
+    for pool_entry in report.get("pools", []):
+        for top_entry in pool_entry["vdevs"]:
+            for vdev_entry, disk_entry in iter_disk_entries(top_entry):
+                yield disk_entry
+    for host in report.get("hosts", {}).values():
+        for vdevs in (host.get("pools") or {}).values():
+            for disks in vdevs.values():
+                yield from disks.values()
+
+class PeerAnalysis:
+    """Flags disks whose counters stand out from the other disks of their model and firmware.
+
+    Every counter is compared across the group as a column: a disk is an
+    outlier when it is more than `threshold` robust standard deviations
+    (MAD based) above the group median. Reference disks, e.g. from the
+    reports of other systems, make the groups bigger but are not flagged.
+    """
+
+    def __init__(self, min_group=PEER_MIN_GROUP, threshold=PEER_THRESHOLD, reference=()):
+        self.min_group = min_group
+        self.threshold = threshold
+        self.reference = list(reference)
+
+    @classmethod
+    def load(cls, paths, min_group=PEER_MIN_GROUP, threshold=PEER_THRESHOLD):
+        """Use the disks of saved --json reports as reference; for a serial seen twice the first one counts"""
+        reference = {}
+        for path in paths:
+            with open(path) as f:
+                report = json.load(f)
+            for disk_entry in iter_report_disks(report):
+                reference.setdefault(disk_entry.get("serial"), disk_entry)
+        reference.pop('UNKNOWN', None)
+        return cls(min_group, threshold, reference.values())
+
+    def apply(self, disk_entries):
+        """Store each disk's peer group and outliers under "peers" and add a caution reason per outlier"""
+        disk_entries = list(disk_entries)
+        own = {disk_entry.get("serial") for disk_entry in disk_entries}
+        groups = {}
+        with TRACER.span("peers", f"{len(disk_entries)} disks"):
+            for flag, entries in ((True, disk_entries),
+                                  (False, [entry for entry in self.reference if entry.get("serial") not in own])):
+                for disk_entry in entries:
+                    group = peer_group(disk_entry)
+                    if group is not None:
+                        groups.setdefault(group, []).append((disk_entry, flag))
+            for (drive_type, model, firmware), members in groups.items():
+                self._compare(drive_type, model, firmware, members)
+
+    def _compare(self, drive_type, model, firmware, members):
+        import statistics
+        found = [[] for _ in members]
+        if len(members) >= self.min_group:
+            columns = peer_columns([disk_entry for disk_entry, flag in members], drive_type)
+            for metric, values in columns.items():
+                column = [(i, value) for i, value in enumerate(values) if _is_number(value)]
+                if len(column) < self.min_group:
+                    continue
+                values = sorted(value for _, value in column)
+                median = statistics.median(values)
+                mad = statistics.median([abs(value - median) for value in values])
+                cutoff = median + self.threshold * max(MAD_TO_SIGMA * mad, PEER_MIN_SCALE)
+                if values[-1] < cutoff:
+                    continue
+                for i, value in column:
+                    if value >= cutoff and members[i][1]:
+                        found[i].append({
+                            "metric": metric,
+                            "value": value,
+                            "median": median,
+                            "mad": mad,
+                            "score": round((value - median) / max(MAD_TO_SIGMA * mad, PEER_MIN_SCALE), 1),
+                            # The share of the other disks that are lower
+                            "percentile": round(100 * bisect.bisect_left(values, value) / (len(values) - 1), 1),
+                            "peers": len(values) - 1
+                        })
+        group = {"model": model, "firmware": firmware}
+        group_name = f"{model} {firmware}" if firmware else model
+        for (disk_entry, flag), outliers in zip(members, found):
+            if not flag:
+                continue
+            disk_entry["peers"] = {"group": group, "size": len(members), "outliers": outliers}
+            warnings = disk_entry.setdefault("warnings", {"critical": [], "caution": [], "slowdown": [],
+                                                           "test_warning": False})
+            for outlier in outliers:
+                warnings["caution"].append(
+                    f"Peer outlier: {outlier['metric']} {_format_number(outlier['value'])} vs median "
+                    f"{_format_number(outlier['median'])} of {group_name} peers, "
+                    f"above {outlier['percentile']:g}% of {outlier['peers']}")
+
+def format_pool(pool_entry):
+    """Return the tree lines for a pool and everything below it"""
+    lines = [f"\n\033[1;36m{' POOL: ' + pool_entry['name'] + ' ':=^80}\033[0m"]
+    for vdev_entry in pool_entry["vdevs"]:
+        lines.extend(format_vdev(vdev_entry))
+    return lines
+
+def format_vdev(vdev_entry, indent=1):
+    """Return the tree lines for a vdev header, its disks and any nested vdevs"""
+    indent_str = "  " * indent
+    lines = [f"\n{indent_str}\033[1;33mVDEV: {vdev_entry['name']} ({vdev_entry['type'].upper()})\033[0m",
+             f"{indent_str}{'-' * 60}"]
+    
+    for disk_entry in vdev_entry["children"]:
+        lines.extend(format_disk(disk_entry, indent + 1))
+    for child_entry in vdev_entry.get("vdevs", []):
+        lines.extend(format_vdev(child_entry, indent + 1))
+    
+    # Add separator after vdev
+    lines.append(f"{indent_str}{'#' * 60}")
+    return lines
+
+def format_disk(disk_entry, indent):
+    """Return the tree lines for a disk entry as built by build_disk_entry"""
+    lines = []
+    errors = disk_entry["errors"]
+    error_text = f"ZFS Read: \033[1;31m{errors['read']}\033[0m, " \
+                 f"ZFS Write: \033[1;31m{errors['write']}\033[0m, " \
+                 f"ZFS Checksum: \033[1;31m{errors['checksum']}\033[0m"
+    
+    # Print disk information
+    indent_str = "  " * indent
+    pool_device = f"/dev/{disk_entry['partition']}" if disk_entry["partition"] else disk_label(disk_entry)
+    lines.append(f"{indent_str}\033[1;32mPool Device: {pool_device}\033[0m")
+    lines.append(f"{indent_str}├─ ZFS GUID: \033[1;35m{disk_entry['zfs_guid']}\033[0m")
+    lines.append(f"{indent_str}├─ Physical Disk: {disk_label(disk_entry) if disk_entry['disk'] else 'not present'}")
+    lines.append(f"{indent_str}├─ Errors: {error_text}")
+    if disk_entry.get("latency"):
+        lines.append(f"{indent_str}├─ Latency: {format_latency(disk_entry['latency'])}")
+    lines.append(f"{indent_str}├─ Serial: \033[1;34m{disk_entry['serial']}\033[0m")
+    lines.append(f"{indent_str}├─ Model: {disk_entry['model']}")
+    lines.append(f"{indent_str}├─ Size: {disk_entry['size_human']} ({disk_entry['size_bytes']} bytes)")
+    lines.append(f"{indent_str}└─ GPTID: \033[1;35m{disk_entry['gptid']}\033[0m")
+    
+    smart_data = disk_entry["smart_data"]
+    cached_note = ""
+    if smart_data.get('standby'):
+        cached_note = f" \033[1;36m(disk in {smart_data['standby'].lower()}, not woken up"
+        if smart_data.get('cached'):
+            age = time.time() - datetime.fromisoformat(smart_data['captured']).timestamp()
+            cached_note += f"; data from {format_age(age)} ago"
+        cached_note += ")\033[0m"
+    elif smart_data.get('timed_out') and 'error' not in smart_data:
+        age = time.time() - datetime.fromisoformat(smart_data['captured']).timestamp()
+        cached_note = f" \033[1;33m(smartctl timed out; data from {format_age(age)} ago)\033[0m"
+    elif smart_data.get('timed_out'):
+        cached_note = " \033[1;33m(smartctl timed out)\033[0m"
+    elif smart_data.get('cached'):
+        age = time.time() - datetime.fromisoformat(smart_data['captured']).timestamp()
+        cached_note = f" (cached {int(age)}s ago)"
+    lines.append(f"{indent_str}{'-' * 60}")
+    lines.append(f"{indent_str}\033[1;34mSMART DATA FOR {disk_label(disk_entry)}:\033[0m{cached_note}")
+    
+    if 'error' not in smart_data:
+        # Health status with color coding
+        health_status = smart_data['health_status']
+        status_color = "\033[1;32m" if health_status == "PASSED" else "\033[1;31m"
+        drive_type = smart_data['drive_type']
+        
+        lines.append(f"{indent_str}├─ Drive Type: {drive_type}")
+        lines.append(f"{indent_str}├─ Health Status: {status_color}{health_status}\033[0m")
+        lines.append(f"{indent_str}├─ Power On Hours: \033[1;33m{smart_data['power_on_hours']}\033[0m")
         
+        # Handle different drive types
         if drive_type == "NVMe":
-            error_log_entries = smart_data.get('error_log_entries', 0)
-            if error_log_entries > 0 and not critical_reasons:
-                caution_reasons.append(f"Error Log Entries: {error_log_entries}")
-                
+            lines.append(f"{indent_str}├─ Media Integrity Errors: \033[1;31m{smart_data['media_errors']}\033[0m")
+            lines.append(f"{indent_str}├─ Error Log Entries: \033[1;31m{smart_data['error_log_entries']}\033[0m")
+            
         elif drive_type == "SAS":
-            # Already handled above
-            pass
-                
-        else:  # SATA
-            # SATA-specific caution conditions
-            sata_read_errors = smart_data.get('read_errors', 0)
-            sata_write_errors = smart_data.get('write_errors', 0)
-            sata_verify_errors = smart_data.get('verify_errors', 0)
+            uncorrected = smart_data['uncorrected_errors']
+            lines.append(f"{indent_str}├─ Uncorrected Errors:")
+            lines.append(f"{indent_str}│  ├─ Read: \033[1;31m{uncorrected['read']}\033[0m")
+            lines.append(f"{indent_str}│  ├─ Write: \033[1;31m{uncorrected['write']}\033[0m")
+            lines.append(f"{indent_str}│  └─ Verify: \033[1;31m{uncorrected['verify']}\033[0m")
+            lines.append(f"{indent_str}├─ Grown Defects: \033[1;31m{smart_data['grown_defects']}\033[0m")
             
-            if (0 < sata_read_errors <= 10) and not critical_reasons:
-                caution_reasons.append(f"SATA Read Errors: {sata_read_errors}")
-            if (0 < sata_write_errors <= 10) and not critical_reasons:
-                caution_reasons.append(f"SATA Write Errors: {sata_write_errors}")
-            if (0 < sata_verify_errors <= 10) and not critical_reasons:
-                caution_reasons.append(f"SATA Verify Errors: {sata_verify_errors}")
-    
-    # Check for old SMART test (for all drive types)
-    if smart_data and not critical_reasons:
-        last_test = smart_data.get('last_test', {})
-        test_status = last_test.get('status', '')
-        test_hours = last_test.get('lifetime_hours', 'N/A')
-        power_on_hours = smart_data.get('power_on_hours', 'N/A')
+            # Show corrected errors for SAS drives
+            corrected = smart_data['corrected_errors']
+            lines.append(f"{indent_str}├─ Corrected Errors:")
+            lines.append(f"{indent_str}│  ├─ Read: \033[1;33m{corrected['read']}\033[0m")
+            lines.append(f"{indent_str}│  ├─ Write: \033[1;33m{corrected['write']}\033[0m")
+            lines.append(f"{indent_str}│  └─ Verify: \033[1;33m{corrected['verify']}\033[0m")
+            
+        else:  # SATA
+            lines.append(f"{indent_str}├─ SMART Attributes:")
+            lines.append(f"{indent_str}│  ├─ Raw Read Error Rate: \033[1;31m{smart_data['raw_read_error_rate']}\033[0m")
+            lines.append(f"{indent_str}│  ├─ Seek Error Rate: \033[1;31m{smart_data['seek_error_rate']}\033[0m")
+            lines.append(f"{indent_str}│  ├─ Offline Uncorrectable: \033[1;31m{smart_data['offline_uncorrectable']}\033[0m")
+            lines.append(f"{indent_str}│  └─ UDMA CRC Error Count: \033[1;31m{smart_data['udma_crc_error_count']}\033[0m")
         
-        # Only proceed if test completed successfully
-        if test_status and ('completed' in test_status.lower() or 'success' in test_status.lower()):
-            days_since = calculate_days_since(power_on_hours, test_hours)
-            if isinstance(days_since, float) and days_since > 60:
-                test_warning = True
-                caution_reasons.append(f"Last SMART test was {int(days_since)} days ago - recommend running a new test")
-    
-    # Add warnings to JSON
-    disk_entry["warnings"] = {
-        "critical": critical_reasons,
-        "caution": caution_reasons,
-        "slowdown": slowdown_reasons,
-        "test_warning": test_warning
-    }
+        last_test = smart_data['last_test']
+        lines.append(f"{indent_str}└─ Last Test: \033[1;35m{last_test['description']}\033[0m")
+        lines.append(f"{indent_str}   ├─ Status: {last_test['status']}")
+        lines.append(f"{indent_str}   ├─ Lifetime Hours: {last_test['lifetime_hours']}")
+        lines.append(f"{indent_str}   └─ Time Since: {last_test['time_since']}")
+    else:
+        lines.append(f"{indent_str}\033[1;31mSMART data unavailable: {smart_data['error']}\033[0m")
+    
+    warnings = disk_entry["warnings"]
+    critical_reasons = warnings["critical"]
+    caution_reasons = warnings["caution"]
+    slowdown_reasons = warnings["slowdown"]
+    test_warning = warnings["test_warning"]
     
     # Print warnings if needed
     if critical_reasons:
@@ -601,9 +4750,9 @@ def print_disk(disk_child, guid_to_disk, devname_to_disk, indent):
         warning_box.extend([f"  • {reason}" for reason in critical_reasons])
         warning_box.append("************************************************************")
         
-        print(f"\n{indent_str}")
+        lines.append(f"\n{indent_str}")
         for line in warning_box:
-            print(f"{indent_str}{line}")
+            lines.append(f"{indent_str}{line}")
     
     elif caution_reasons:
         warning_box = [
@@ -618,32 +4767,368 @@ def print_disk(disk_child, guid_to_disk, devname_to_disk, indent):
             warning_box.append("  • Run a new SMART short test")
         warning_box.append("------------------------------------------------------------")
         
-        print(f"\n{indent_str}")
+        lines.append(f"\n{indent_str}")
         for line in warning_box:
-            print(f"{indent_str}{line}")
+            lines.append(f"{indent_str}{line}")
     
     # Print slowdown warnings for SAS with new format
     if slowdown_reasons:
         slowdown_box = [
             "------------------------------------------------------------",
             "\033[1;33mPERFORMANCE WARNING: DRIVE MAY BE SLOWING DOWN ITS VDEV\033[0m",
-            "High error correction rates may be impacting performance:",
-            "For some drive models and firmwares, higher numbers may be part of \"normal\" operation. ",
         ]
+        latency_slow = disk_entry.get("latency") and disk_entry["latency"]["slow"]
+        if len(slowdown_reasons) > len(latency_slow or ()):
+            slowdown_box.append("High error correction rates may be impacting performance:")
+            slowdown_box.append("For some drive models and firmwares, higher numbers may be part of \"normal\" operation. ")
+        if latency_slow:
+            slowdown_box.append("Measured latency is well above the other disks in the vdev:")
         slowdown_box.extend([f"  • {reason}" for reason in slowdown_reasons])
         slowdown_box.append("Recommendations:")
         slowdown_box.append("  • Consider replacing this drive")
         slowdown_box.append("  • Monitor vdev performance metrics")
         slowdown_box.append("------------------------------------------------------------")
         
-        print(f"\n{indent_str}")
+        lines.append(f"\n{indent_str}")
         for line in slowdown_box:
-            print(f"{indent_str}{line}")
+            lines.append(f"{indent_str}{line}")
     
     # Add separator
-    print(f"{indent_str}{'.' * 60}")
-    
-    return disk_entry
+    lines.append(f"{indent_str}{'.' * 60}")
+    return lines
+
+def format_age(seconds):
+    """Return an age like 45s, 12m, 5h or 3d"""
+    for unit, size in (('d', 86400), ('h', 3600), ('m', 60)):
+        if seconds >= size:
+            return f"{int(seconds // size)}{unit}"
+    return f"{int(seconds)}s"
+
+def format_latency(latency):
+    """Return the read/write latency of a disk next to its vdev peers, e.g. for the tree"""
+    parts = []
+    for direction in ('read', 'write'):
+        value = latency[f"{direction}_ms"]
+        if value is None:
+            parts.append(f"{direction.capitalize()}: idle")
+            continue
+        text = f"{value:.1f} ms"
+        if direction in latency["slow"]:
+            text = f"\033[1;31m{text}\033[0m"
+        peer = latency[f"peer_{direction}_ms"]
+        if peer is not None:
+            text += f" (peers {peer:.1f} ms)"
+        parts.append(f"{direction.capitalize()}: {text}")
+    return ", ".join(parts)
+
+def print_pool(pool_entry):
+    """Print a pool and everything below it"""
+    sys.stdout.write("\n".join(format_pool(pool_entry)) + "\n")
+
+def print_disk(disk_entry, indent):
+    """Print a disk entry as built by build_disk_entry"""
+    sys.stdout.write("\n".join(format_disk(disk_entry, indent)) + "\n")
+
+# Color codes are dropped by the plain renderer
+ANSI_ESCAPE = re.compile(r"\033\[[0-9;]*m")
+
+class ReportWriter:
+    """Buffers rendered text and writes it to the stream in one go on flush()"""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self._parts = []
+
+    def write(self, text):
+        self._parts.append(text)
+
+    def flush(self):
+        if self._parts:
+            self.stream.write("".join(self._parts))
+            self._parts.clear()
+        self.stream.flush()
+
+class Renderer:
+    """Base for report renderers.
+
+    Streaming renderers get disk() for every disk as soon as its SMART data is
+    in; all renderers get the finished report(). end() flushes the writer.
+    """
+    streaming = False
+
+    def __init__(self, writer):
+        self.writer = writer
+
+    def begin(self):
+        pass
+
+    def disk(self, pool_name, vdev_name, vdev_type, disk_entry):
+        pass
+
+    def host(self, name, host_result, pool_entries):
+        """Called per host in fleet mode, with the host's status and pool entries"""
+        pass
+
+    def report(self, report):
+        pass
+
+    def end(self):
+        self.writer.flush()
+
+class TreeRenderer(Renderer):
+    """The colored tree"""
+
+    def text(self, lines):
+        return "\n".join(lines) + "\n"
+
+    def host(self, name, host_result, pool_entries):
+        lines = [f"\n\033[1;35m{' HOST: ' + name + ' ':#^80}\033[0m"]
+        if host_result["error"]:
+            lines.append(f"\033[1;31mHost {host_result['status']}: {host_result['error']}\033[0m")
+        for pool_entry in pool_entries:
+            lines.extend(format_pool(pool_entry))
+        self.writer.write(self.text(lines))
+
+    def report(self, report):
+        for pool_entry in report.get("pools", []):
+            self.writer.write(self.text(format_pool(pool_entry)))
+
+class PlainRenderer(TreeRenderer):
+    """The tree without colors, for log files and mail"""
+
+    def text(self, lines):
+        return ANSI_ESCAPE.sub("", super().text(lines))
+
+class JsonRenderer(Renderer):
+    """The whole report as one JSON document"""
+
+    def report(self, report):
+        self.writer.write(json.dumps(report, indent=4) + "\n")
+
+class NdjsonRenderer(Renderer):
+    """One JSON object per disk, flushed as soon as the disk's SMART data is in"""
+    streaming = True
+
+    def disk(self, pool_name, vdev_name, vdev_type, disk_entry, host=None):
+        self.writer.write(json.dumps(disk_record(pool_name, vdev_name, vdev_type, disk_entry, host)) + "\n")
+        self.writer.flush()
+
+    def host(self, name, host_result, pool_entries):
+        if host_result["error"]:
+            self.writer.write(json.dumps({"host": name, "status": host_result["status"],
+                                          "error": host_result["error"]}) + "\n")
+        for pool_entry in pool_entries:
+            for top_entry in pool_entry["vdevs"]:
+                for vdev_entry, disk_entry in iter_disk_entries(top_entry):
+                    self.disk(pool_entry["name"], vdev_entry["name"], vdev_entry["type"], disk_entry, name)
+        self.writer.flush()
+
+RENDERERS = {
+    'tree': TreeRenderer,
+    'plain': PlainRenderer,
+    'json': JsonRenderer,
+    'ndjson': NdjsonRenderer,
+}
+
+# Columns of the CSV export: header and the path of the value in a disk record
+CSV_COLUMNS = (
+    ("timestamp", ("timestamp",)), ("host", ("host",)), ("pool", ("pool",)), ("vdev", ("vdev",)),
+    ("vdev_type", ("vdev_type",)), ("partition", ("partition",)), ("disk", ("disk",)),
+    ("zfs_guid", ("zfs_guid",)), ("serial", ("serial",)), ("model", ("model",)), ("size_bytes", ("size_bytes",)),
+    ("zfs_read_errors", ("errors", "read")), ("zfs_write_errors", ("errors", "write")),
+    ("zfs_checksum_errors", ("errors", "checksum")),
+    ("drive_type", ("smart_data", "drive_type")), ("health_status", ("smart_data", "health_status")),
+    ("power_on_hours", ("smart_data", "power_on_hours")), ("firmware", ("smart_data", "firmware")),
+    ("read_uncorrected", ("smart_data", "uncorrected_errors", "read")),
+    ("write_uncorrected", ("smart_data", "uncorrected_errors", "write")),
+    ("verify_uncorrected", ("smart_data", "uncorrected_errors", "verify")),
+    ("read_corrected", ("smart_data", "corrected_errors", "read")),
+    ("write_corrected", ("smart_data", "corrected_errors", "write")),
+    ("verify_corrected", ("smart_data", "corrected_errors", "verify")),
+    ("grown_defects", ("smart_data", "grown_defects")), ("media_errors", ("smart_data", "media_errors")),
+    ("error_log_entries", ("smart_data", "error_log_entries")),
+    ("raw_read_error_rate", ("smart_data", "raw_read_error_rate")),
+    ("seek_error_rate", ("smart_data", "seek_error_rate")),
+    ("offline_uncorrectable", ("smart_data", "offline_uncorrectable")),
+    ("udma_crc_error_count", ("smart_data", "udma_crc_error_count")),
+    ("last_test", ("smart_data", "last_test", "description")),
+    ("last_test_status", ("smart_data", "last_test", "status")),
+    ("last_test_hours", ("smart_data", "last_test", "lifetime_hours")),
+    ("smart_captured", ("smart_data", "captured")), ("standby", ("smart_data", "standby")),
+    ("smart_error", ("smart_data", "error")),
+    ("read_latency_ms", ("latency", "read_ms")), ("write_latency_ms", ("latency", "write_ms")),
+    ("critical", ("warnings", "critical")), ("caution", ("warnings", "caution")),
+    ("slowdown", ("warnings", "slowdown")),
+)
+
+def disk_record(pool_name, vdev_name, vdev_type, disk_entry, host=None, timestamp=None):
+    """A disk entry with its place in the topology, as written by NDJSON and the exporters"""
+    record = {"timestamp": timestamp} if timestamp is not None else {}
+    if host is not None:
+        record["host"] = host
+    record.update({"pool": pool_name, "vdev": vdev_name, "vdev_type": vdev_type})
+    record.update(disk_entry)
+    return record
+
+def _record_value(record, path):
+    for key in path:
+        if not isinstance(record, dict):
+            return None
+        record = record.get(key)
+    return record
+
+class DiskExporter:
+    """Base for the --export formats.
+
+    Every disk record is written as soon as it is produced and nothing is
+    kept, so memory does not grow with the number of disks or hosts. With
+    append, records are added to an existing file, building up a history.
+    """
+    mode = 'w'
+
+    def __init__(self, path, append=False):
+        self.path = path
+        self.append = append
+        self.file = None
+        self.timestamp = None
+
+    def open(self):
+        self.file = open(self.path, self.mode.replace('w', 'a') if self.append else self.mode,
+                         **({} if 'b' in self.mode else {'newline': ''}))
+        self.timestamp = datetime.now().isoformat()
+        return self
+
+    def disk(self, pool_name, vdev_name, vdev_type, disk_entry, host=None):
+        self.write(disk_record(pool_name, vdev_name, vdev_type, disk_entry, host, self.timestamp))
+
+    def host_error(self, name, host_result):
+        """A fleet host or bundle that failed, in formats that can tell it apart from a disk"""
+        pass
+
+    def write(self, record):
+        raise NotImplementedError
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+class NdjsonExporter(DiskExporter):
+    """One JSON object per line, like --format ndjson with a timestamp"""
+
+    def write(self, record):
+        self.file.write(json.dumps(record) + "\n")
+
+    def host_error(self, name, host_result):
+        self.write({"timestamp": self.timestamp, "host": name, "status": host_result["status"],
+                    "error": host_result["error"]})
+
+class CsvExporter(DiskExporter):
+    """One row per disk with the flat CSV_COLUMNS; the header is only written to an empty file"""
+
+    def open(self):
+        import csv
+        super().open()
+        self.writer = csv.writer(self.file)
+        if self.file.tell() == 0:
+            self.writer.writerow([header for header, path in CSV_COLUMNS])
+        return self
+
+    def write(self, record):
+        row = []
+        for header, path in CSV_COLUMNS:
+            value = _record_value(record, path)
+            if isinstance(value, list):
+                value = "; ".join(str(item) for item in value)
+            row.append("" if value is None else value)
+        self.writer.writerow(row)
+
+class MsgpackExporter(DiskExporter):
+    """One MessagePack map per disk, back to back; needs the msgpack package"""
+    mode = 'wb'
+
+    def open(self):
+        # Only needed for this format, so only imported for it
+        try:
+            import msgpack
+        except ImportError as e:
+            raise ImportError("the msgpack export needs the msgpack package (pip install msgpack)") from e
+        self.packer = msgpack.Packer()
+        return super().open()
+
+    def write(self, record):
+        self.file.write(self.packer.pack(record))
+
+    def host_error(self, name, host_result):
+        self.write({"timestamp": self.timestamp, "host": name, "status": host_result["status"],
+                    "error": host_result["error"]})
+
+EXPORTERS = {
+    'ndjson': NdjsonExporter,
+    'csv': CsvExporter,
+    'msgpack': MsgpackExporter,
+}
+
+EXPORT_EXTENSIONS = {'.ndjson': 'ndjson', '.jsonl': 'ndjson', '.csv': 'csv', '.msgpack': 'msgpack', '.mpk': 'msgpack'}
+
+def open_exporter(path, export_format=None, append=False):
+    """Open the exporter for a path, in the format its extension says unless one is given"""
+    if export_format is None:
+        export_format = EXPORT_EXTENSIONS.get(os.path.splitext(path)[1].lower(), 'ndjson')
+    return EXPORTERS[export_format](path, append).open()
+
+class ExportRenderer(Renderer):
+    """Hands every disk to an exporter and everything to the renderer it wraps.
+
+    It streams when the wrapped renderer does, exporting every disk as it
+    comes in; otherwise disks are exported from the finished report, so the
+    export has everything the report has.
+    """
+
+    def __init__(self, renderer, exporter):
+        super().__init__(renderer.writer)
+        self.renderer = renderer
+        self.exporter = exporter
+
+    @property
+    def streaming(self):
+        return self.renderer.streaming
+
+    def begin(self):
+        self.renderer.begin()
+
+    def disk(self, pool_name, vdev_name, vdev_type, disk_entry):
+        with TRACER.span("export", disk_entry.get("disk")):
+            self.exporter.disk(pool_name, vdev_name, vdev_type, disk_entry)
+        self.renderer.disk(pool_name, vdev_name, vdev_type, disk_entry)
+
+    def export_pools(self, pool_entries, host=None):
+        for pool_entry in pool_entries:
+            for top_entry in pool_entry["vdevs"]:
+                for vdev_entry, disk_entry in iter_disk_entries(top_entry):
+                    self.exporter.disk(pool_entry["name"], vdev_entry["name"], vdev_entry["type"], disk_entry, host)
+
+    def host(self, name, host_result, pool_entries):
+        with TRACER.span("export", name):
+            if host_result["error"]:
+                self.exporter.host_error(name, host_result)
+            self.export_pools(pool_entries, name)
+            self.exporter.flush()
+        self.renderer.host(name, host_result, pool_entries)
+
+    def report(self, report):
+        # Streamed disks are already out; fleet reports went out host by host
+        if not self.streaming:
+            with TRACER.span("export"):
+                self.export_pools(report.get("pools", []))
+        self.renderer.report(report)
+
+    def end(self):
+        self.exporter.flush()
+        self.renderer.end()
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
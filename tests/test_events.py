@@ -0,0 +1,119 @@
+import json
+import os
+import signal
+import subprocess
+import time
+
+import diskmapper
+from conftest import FIXTURES
+
+EVENTS_PATH = os.path.join(FIXTURES, "zpool-events.txt")
+
+# zpool events prints GUIDs in hex, middleware in decimal
+POOL_GUID = str(0xbadc0ffee123456)
+RAIDZ_GUID = str(0x7a2b3c4d5e6f7081)
+DISK_GUIDS = {"sda": str(0x1b7c3e5a9d2f4e01), "sdb": str(0x314fb7dfd82c07cd), "sdc": str(0x6e0d9a1b2c3f4a55)}
+
+SMARTCTL_JSON = json.dumps({"smartctl": {"exit_status": 0}, "device": {"protocol": "ATA"},
+                            "smart_status": {"passed": True}, "power_on_time": {"hours": 100}})
+
+
+class CannedTransport(diskmapper.LocalTransport):
+    """Answers every smartctl call with the same report and records the devices asked for"""
+    local = False
+
+    def __init__(self):
+        super().__init__("test")
+        self.devices = []
+
+    def run(self, argv, timeout=None):
+        self.devices.append(os.path.basename(argv[-1]))
+        return subprocess.CompletedProcess(argv, 0, SMARTCTL_JSON, "")
+
+
+class CountingClient(diskmapper.StaticMiddlewareClient):
+    def __init__(self, responses):
+        super().__init__(responses)
+        self.calls = []
+
+    def call(self, method, *params):
+        self.calls.append(method)
+        return super().call(method, *params)
+
+
+def make_watcher():
+    children = [{"type": "DISK", "name": f"uuid-{disk}", "guid": guid, "device": f"{disk}1", "disk": disk,
+                 "status": "ONLINE", "children": [],
+                 "stats": {"read_errors": 0, "write_errors": 0, "checksum_errors": 0}}
+                for disk, guid in DISK_GUIDS.items()]
+    pools = [{"name": "tank", "guid": POOL_GUID, "status": "ONLINE", "scan": None, "topology": {
+        "data": [{"type": "RAIDZ1", "name": "raidz1-0", "guid": RAIDZ_GUID, "children": children}]}}]
+    disks = [{"name": disk, "devname": disk, "serial": f"SER{disk.upper()}", "model": "ST8000NM0055",
+              "size": 8001563222016, "zfs_guid": guid} for disk, guid in DISK_GUIDS.items()]
+    client = CountingClient({"pool.query": pools, "disk.query": disks})
+    transport = CannedTransport()
+    collector = diskmapper.SmartCollector(workers=1, transport=transport)
+    return diskmapper.DiskWatcher(client, collector), client, transport
+
+
+def read_events():
+    with open(EVENTS_PATH) as f:
+        return list(diskmapper.parse_zfs_events(f))
+
+
+def test_parse_zfs_events():
+    events = read_events()
+    assert [event["class"] for event in events] == [
+        "sysevent.fs.zfs.history_event", "ereport.fs.zfs.checksum", "ereport.fs.zfs.delay",
+        "ereport.fs.zfs.delay", "resource.fs.zfs.statechange", "sysevent.fs.zfs.vdev_attach"]
+    checksum = events[1]
+    assert checksum["pool"] == "tank"
+    assert checksum["vdev_guid"] == 0x314fb7dfd82c07cd
+    assert checksum["vdev_cksum_errors"] == 3
+    # The detector's fields stay in the detector
+    assert "version" not in checksum and "scheme" not in checksum and "vdev" not in checksum
+    assert diskmapper.zfs_event_time(checksum) == 0x6711b8e5
+
+
+def test_events_map_to_disks():
+    watcher, client, transport = make_watcher()
+    watcher.poll()
+    events = read_events()
+    
+    assert diskmapper.plan_event_refresh(watcher, events[:4]) == ({"tank": {"sdb", "sdc"}}, False)
+    # A raidz vdev changing state re-reads its pool without smartctl
+    assert diskmapper.plan_event_refresh(watcher, events[4:5]) == ({"tank": set()}, False)
+    # Disks that came or went need a full sweep
+    assert diskmapper.plan_event_refresh(watcher, events[5:])[1] is True
+
+
+def test_event_refresh_cooldown():
+    watcher, client, transport = make_watcher()
+    watcher.poll()
+    assert sorted(transport.devices) == ["sda", "sdb", "sdc"]
+    transport.devices.clear()
+    
+    targets, sweep = diskmapper.plan_event_refresh(watcher, read_events()[1:4])
+    # Just read: the pool is re-read but the disks are not polled again
+    watcher.refresh_disks(targets, diskmapper.ZFS_EVENT_SMART_COOLDOWN)
+    assert transport.devices == []
+    assert client.calls[-1] == "pool.query"
+    
+    watcher.smart_results["sdc"]["captured"] = time.time() - diskmapper.ZFS_EVENT_SMART_COOLDOWN - 1
+    watcher.refresh_disks(targets, diskmapper.ZFS_EVENT_SMART_COOLDOWN)
+    assert transport.devices == ["sdc"]
+
+
+def test_run_events_replay(capsys):
+    watcher, client, transport = make_watcher()
+    handler = signal.getsignal(signal.SIGTERM)
+    try:
+        diskmapper.run_events(watcher, EVENTS_PATH, batch=0)
+    finally:
+        signal.signal(signal.SIGTERM, handler)
+    out = capsys.readouterr().out
+    assert "raidz1-0" in out
+    # The first poll reads every disk; the events come too soon after it for more smartctl
+    assert sorted(transport.devices) == ["sda", "sdb", "sdc"]
+    # The initial poll and the sweep after vdev_attach, at least
+    assert client.calls.count("pool.query") >= 2
@@ -0,0 +1,73 @@
+import io
+import json
+import os
+import stat
+import sys
+
+import diskmapper
+
+POOLS = [{"name": "tank", "status": "ONLINE", "scan": None, "topology": {"data": [
+    {"type": "MIRROR", "name": "mirror-0", "guid": "900", "children": [
+        {"type": "DISK", "name": f"uuid-{disk}", "guid": guid, "device": f"{disk}1", "disk": disk,
+         "status": "ONLINE", "children": [], "stats": {"read_errors": 0, "write_errors": 0, "checksum_errors": 0}}
+        for disk, guid in (("sda", "1000"), ("sdb", "1001"))]}]}}]
+DISKS = [{"name": disk, "devname": disk, "serial": f"SER{disk.upper()}", "model": "ST8000NM0055",
+          "size": 8001563222016, "zfs_guid": guid} for disk, guid in (("sda", "1000"), ("sdb", "1001"))]
+SMARTCTL_JSON = {"smartctl": {"exit_status": 0}, "device": {"protocol": "ATA"},
+                 "smart_status": {"passed": True}, "power_on_time": {"hours": 100}}
+
+
+def write_script(path, body):
+    path.write_text(f"#!{sys.executable}\nimport json, os, sys\n{body}")
+    path.chmod(path.stat().st_mode | stat.S_IXUSR)
+
+
+def fake_truenas(tmp_path, monkeypatch):
+    """midclt, sudo and smartctl stand-ins on the PATH, for the local transport to run"""
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    (tmp_path / "pool.query.json").write_text(json.dumps(POOLS))
+    (tmp_path / "disk.query.json").write_text(json.dumps(DISKS))
+    write_script(bin_dir / "midclt",
+                 f"sys.stdout.write(open(os.path.join({str(tmp_path)!r}, sys.argv[2] + '.json')).read())\n")
+    write_script(bin_dir / "sudo", "os.execvp(sys.argv[1], sys.argv[1:])\n")
+    write_script(bin_dir / "smartctl", f"print(json.dumps({SMARTCTL_JSON!r}))\n")
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+
+
+def test_parse_inventory(tmp_path):
+    inventory = tmp_path / "hosts.txt"
+    inventory.write_text("local\nlocal:nas1  # this box\n\nroot@nas2:2222\n2001:db8::1\n"
+                         "root@[2001:db8::2]:2222\n[fe80::1]\n")
+    hosts = diskmapper.parse_inventory(str(inventory))
+    assert [name for name, transport in hosts] == [
+        "localhost", "nas1", "root@nas2:2222", "2001:db8::1", "root@[2001:db8::2]:2222", "fe80::1"]
+    assert hosts[1][1].local and hosts[1][1].name == "nas1"
+    assert [(transport.host, transport.port) for name, transport in hosts[2:]] == [
+        ("root@nas2", 2222), ("2001:db8::1", None), ("root@2001:db8::2", 2222), ("fe80::1", None)]
+
+
+def test_run_fleet_local(tmp_path, monkeypatch):
+    fake_truenas(tmp_path, monkeypatch)
+    inventory = tmp_path / "hosts.txt"
+    inventory.write_text("local:nas1\nlocal:broken\n")
+    hosts = diskmapper.parse_inventory(str(inventory), timeout=30)
+    
+    def make_collector(transport):
+        if transport.name == "broken":
+            raise RuntimeError("collector exploded")
+        return diskmapper.SmartCollector(workers=2, transport=transport)
+    
+    output = io.StringIO()
+    report = diskmapper.run_fleet(hosts, make_collector, diskmapper.JsonRenderer(diskmapper.ReportWriter(output)))
+    
+    assert list(report["hosts"]) == ["nas1", "broken"]
+    nas1 = report["hosts"]["nas1"]
+    assert nas1["status"] == "ok"
+    assert sorted(nas1["pools"]["tank"]["mirror-0"]) == ["SERSDA", "SERSDB"]
+    assert nas1["pools"]["tank"]["mirror-0"]["SERSDA"]["smart_data"]["health_status"] == "PASSED"
+    # One host failing in an unexpected way does not take the fleet down
+    broken = report["hosts"]["broken"]
+    assert broken["status"] == "error"
+    assert broken["error"] == "RuntimeError: collector exploded"
+    assert json.loads(output.getvalue())["hosts"]["broken"]["status"] == "error"
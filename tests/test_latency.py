@@ -0,0 +1,81 @@
+import os
+import subprocess
+
+import diskmapper
+from conftest import FIXTURES
+
+IOSTAT_PATH = os.path.join(FIXTURES, "zpool-iostat-tank.txt")
+
+
+def read_iostat():
+    with open(IOSTAT_PATH) as f:
+        return f.read()
+
+
+def disk(guid):
+    return {"type": "DISK", "guid": guid, "disk": f"disk{guid}", "children": []}
+
+
+def pool_data(data_type="RAIDZ2"):
+    return [{"name": "tank", "topology": {
+        "data": [{"type": data_type, "name": "raidz2-0", "guid": "900", "children": [
+            disk("1000"), disk("1001"), disk("1002"), disk("1003")]}],
+        "log": [{"type": "MIRROR", "name": "mirror-1", "guid": "901", "children": [disk("1010"), disk("1011")]}]}}]
+
+
+class CannedTransport(diskmapper.LocalTransport):
+    def __init__(self, returncode=0, stdout="", stderr=""):
+        super().__init__("test")
+        self.result = (returncode, stdout, stderr)
+        self.argv = None
+
+    def run(self, argv, timeout=None):
+        self.argv = argv
+        return subprocess.CompletedProcess(argv, *self.result)
+
+
+def test_parse_zpool_iostat_uses_last_report():
+    stats = diskmapper.parse_zpool_iostat(read_iostat(), "tank")
+    # The second report covers the interval, the first everything since import
+    assert stats["1002"]["read_ops"] == 121
+    assert stats["1002"]["disk_wait_read"] == 39000000
+    assert stats["1011"]["disk_wait_read"] is None
+    assert stats["1000"]["alloc"] is None
+    assert stats["tank"]["free"] == 42880953417728
+
+
+def test_parse_zpool_iostat_other_pool():
+    assert diskmapper.parse_zpool_iostat(read_iostat(), "other") == {}
+
+
+def test_slow_disk_against_vdev_peers():
+    samples = diskmapper.parse_zpool_iostat(read_iostat(), "tank")
+    latency = diskmapper.compare_vdev_latency(pool_data(), samples)
+    
+    assert latency["1002"]["slow"] == ["read", "write"]
+    assert latency["1002"]["read_ms"] == 39.0
+    assert latency["1002"]["peer_read_ms"] == 6.2
+    assert all(latency[guid]["slow"] == [] for guid in ("1000", "1001", "1003", "1010", "1011"))
+    # One read in the window is too few to judge
+    assert latency["1010"]["read_ms"] is None
+    assert latency["1010"]["write_ms"] == 0.085
+
+
+def test_replacing_vdev_is_not_compared():
+    samples = diskmapper.parse_zpool_iostat(read_iostat(), "tank")
+    latency = diskmapper.compare_vdev_latency(pool_data("REPLACING"), samples)
+    assert latency["1002"]["slow"] == []
+    assert latency["1002"]["peer_read_ms"] == 6.2
+
+
+def test_sample_pool():
+    transport = CannedTransport(stdout=read_iostat())
+    stats = diskmapper.LatencySampler(interval=5).sample_pool("tank", transport)
+    assert transport.argv == ["zpool", "iostat", "-v", "-l", "-p", "-H", "-g", "tank", "5", "2"]
+    assert stats["1002"]["disk_wait_write"] == 13200000
+
+
+def test_sample_pool_failure(capsys):
+    transport = CannedTransport(returncode=1, stderr="cannot open 'tank': no such pool")
+    assert diskmapper.LatencySampler().sample_pool("tank", transport) == {}
+    assert "no such pool" in capsys.readouterr().out
@@ -0,0 +1,49 @@
+import json
+import os
+import subprocess
+
+from conftest import FIXTURES
+
+import diskmapper
+
+BUNDLES = os.path.join(FIXTURES, "bundles")
+
+
+def no_smartctl(self, argv, timeout=None):
+    raise AssertionError(f"offline analysis ran {argv}")
+
+
+def test_removed_member_is_not_read(monkeypatch):
+    monkeypatch.setattr(diskmapper.LocalTransport, "run", no_smartctl)
+    monkeypatch.setattr(subprocess, "run", no_smartctl)
+    path, result, pool_entries = diskmapper.analyze_bundle(os.path.join(BUNDLES, "removed"))
+    assert result["status"] == "ok"
+    present, removed = pool_entries[0]["vdevs"][0]["children"]
+    assert present["smart_data"]["power_on_hours"] == 32886
+    assert removed["disk"] is None
+    assert removed["smart_data"] == {
+        "error": "Error: no disk present for /dev/gptid/9d8e7f6a-5b4c-4d3e-8f2a-1b0c9d8e7f6a"}
+    lines = diskmapper.format_disk(removed, 0)
+    assert not any("/dev/None" in line for line in lines)
+
+
+def test_bad_bundle_does_not_stop_the_others(capsys):
+    status = diskmapper.main(["--offline", os.path.join(BUNDLES, "removed"), os.path.join(BUNDLES, "broken"),
+                              "--offline-workers", "1", "--format", "json"])
+    assert status == 1
+    report = json.loads(capsys.readouterr().out)
+    assert report["hosts"]["removed"]["status"] == "ok"
+    assert report["hosts"]["broken"]["status"] == "error"
+    assert "pool.query.json is not a list of records" in report["hosts"]["broken"]["error"]
+
+
+def test_unexpected_bundle_error_is_reported(tmp_path):
+    (tmp_path / "pool.query.json").write_text(json.dumps([{"name": "tank", "topology": [1]}]))
+    (tmp_path / "disk.query.json").write_text("[]")
+    path, result, pool_entries = diskmapper.analyze_bundle(str(tmp_path))
+    assert result["status"] == "error"
+    assert result["error"].startswith("AttributeError: ")
+
+
+def test_good_bundle_exits_cleanly(capsys):
+    assert diskmapper.main(["--offline", os.path.join(BUNDLES, "removed"), "--format", "json"]) is None
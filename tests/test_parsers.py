@@ -0,0 +1,97 @@
+import json
+import os
+
+import pytest
+
+import diskmapper
+
+CORPUS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks", "corpus")
+PAIRS = ("nvme_samsung", "sas_hgst_ultrastar", "sas_seagate_exos", "sata_failing", "sata_wdc_ultrastar")
+
+
+def parse_text(name):
+    with open(os.path.join(CORPUS, f"{name}.txt")) as f:
+        return diskmapper.parse_smart_text(f.read())
+
+
+def parse_json(name):
+    with open(os.path.join(CORPUS, f"{name}.json")) as f:
+        return diskmapper.parse_smart_json(json.load(f))
+
+
+def temperature(smart_data):
+    if smart_data["drive_type"] == "NVMe":
+        return smart_data["nvme_health"].temperature
+    return next((attribute.raw for attribute in smart_data.get("attributes", ()) if attribute.id == 194), None)
+
+
+def counters(smart_data):
+    """The error counters the health rules read, by drive type"""
+    fields = {
+        "NVMe": ("media_errors", "error_log_entries"),
+        "SAS": ("read_errors", "write_errors", "verify_errors", "read_corrected", "write_corrected",
+                "verify_corrected", "grown_defects"),
+        "SATA": ("raw_read_error_rate", "seek_error_rate", "offline_uncorrectable", "udma_crc_error_count"),
+    }[smart_data["drive_type"]]
+    return {field: smart_data[field] for field in fields}
+
+
+@pytest.mark.parametrize("name", PAIRS)
+def test_text_and_json_agree(name):
+    # The parsers see no serial (that comes from disk.query); firmware identifies the drive instead
+    text, document = parse_text(name), parse_json(name)
+    for field in ("drive_type", "health_status", "firmware", "power_on_hours", "last_test"):
+        assert text[field] == document[field], field
+    assert temperature(text) == temperature(document)
+    assert counters(text) == counters(document)
+    if text["drive_type"] == "SAS":
+        assert ({operation: counter.as_dict() for operation, counter in text["error_counters"].items()} ==
+                {operation: counter.as_dict() for operation, counter in document["error_counters"].items()})
+    if text["drive_type"] == "NVMe":
+        assert text["nvme_health"].as_dict() == document["nvme_health"].as_dict()
+    # smartctl -j leaves out some vendor attributes the text report lists
+    text_attributes = {attribute.id: attribute.raw for attribute in text.get("attributes", ())}
+    for attribute in document.get("attributes", ()):
+        assert text_attributes[attribute.id] == attribute.raw
+
+
+def test_failing_sata():
+    smart_data = parse_text("sata_failing")
+    assert smart_data["health_status"] == "FAILED"
+    assert smart_data["last_test"] == {"description": "Short offline", "status": "Completed: read failure",
+                                       "lifetime_hours": 22490}
+    assert (smart_data["offline_uncorrectable"], smart_data["udma_crc_error_count"]) == (96, 3)
+    assert temperature(smart_data) == 39
+
+
+def test_self_test_in_progress():
+    smart_data = parse_text("sata_seagate_ironwolf")
+    assert smart_data["last_test"] == {"description": "Extended offline", "status": "Self-test routine in progress",
+                                       "lifetime_hours": 29341}
+    assert smart_data["power_on_hours"] == 29341
+    assert smart_data["firmware"] == "SC60"
+    assert (smart_data["raw_read_error_rate"], smart_data["seek_error_rate"]) == (204317560, 1307433122)
+
+
+def test_nvme_without_self_test_log():
+    smart_data = parse_text("nvme_no_selftest")
+    assert smart_data["drive_type"] == "NVMe"
+    assert smart_data["last_test"] == {"description": "N/A", "status": "N/A", "lifetime_hours": "N/A"}
+    assert (smart_data["power_on_hours"], smart_data["media_errors"], smart_data["error_log_entries"]) == (38912, 2, 0)
+    assert smart_data["nvme_health"].temperature == 33
+
+
+def test_usb_bridge_without_smart():
+    smart_data = parse_text("usb_bridge")
+    assert smart_data["drive_type"] == "SATA"
+    assert smart_data["health_status"] == "UNKNOWN"
+    assert smart_data["power_on_hours"] == "N/A"
+    assert smart_data["attributes"] == []
+    assert smart_data["firmware"] is None
+
+
+def test_parse_smart_data_picks_the_parser():
+    with open(os.path.join(CORPUS, "sas_hgst_ultrastar.json")) as f:
+        assert diskmapper.parse_smart_data(f.read())["power_on_hours"] == 37363
+    with open(os.path.join(CORPUS, "sas_hgst_ultrastar.txt")) as f:
+        assert diskmapper.parse_smart_data(f.read())["power_on_hours"] == 37363
@@ -0,0 +1,95 @@
+import json
+import subprocess
+import time
+
+import diskmapper
+
+SMARTCTL_JSON = json.dumps({"smartctl": {"exit_status": 0}, "device": {"protocol": "ATA"},
+                            "smart_status": {"passed": True}, "power_on_time": {"hours": 100}})
+SMARTCTL_TEXT = """smartctl 6.6 2017-11-05 r4594 [x86_64-linux-5.10.0] (local build)
+
+=== START OF INFORMATION SECTION ===
+Device Model:     ST8000NM0055-1RM112
+Serial Number:    ZA1B2C3D
+
+=== START OF READ SMART DATA SECTION ===
+SMART overall-health self-assessment test result: PASSED
+"""
+
+
+class ScriptedTransport(diskmapper.LocalTransport):
+    """Answers smartctl calls with (returncode, stdout, stderr) from json_replies and text_replies in turn"""
+
+    def __init__(self, json_replies=(), text_replies=()):
+        super().__init__("test")
+        self.replies = {True: list(json_replies), False: list(text_replies)}
+        self.calls = []
+
+    def run(self, argv, timeout=None):
+        json_call = "-j" in argv
+        self.calls.append("json" if json_call else "text")
+        return subprocess.CompletedProcess(argv, *self.replies[json_call].pop(0))
+
+
+def test_broken_json_falls_back_for_one_call():
+    transport = ScriptedTransport(json_replies=[(0, '{"smartctl": {"exit_st', ""), (0, SMARTCTL_JSON, "")],
+                                  text_replies=[(0, SMARTCTL_TEXT, "")])
+    assert diskmapper.get_smart_data("sda", transport=transport) == SMARTCTL_TEXT
+    assert transport.smartctl_json_supported
+    assert diskmapper.get_smart_data("sdb", transport=transport) == SMARTCTL_JSON
+    assert transport.calls == ["json", "text", "json"]
+
+
+def test_old_smartctl_turns_json_off():
+    refused = (1, "smartctl 6.6 2017-11-05 r4594\n\n=======> UNRECOGNIZED OPTION: j\n", "")
+    transport = ScriptedTransport(json_replies=[refused], text_replies=[(0, SMARTCTL_TEXT, "")] * 2)
+    assert diskmapper.get_smart_data("sda", transport=transport) == SMARTCTL_TEXT
+    assert not transport.smartctl_json_supported
+    assert diskmapper.get_smart_data("sdb", transport=transport) == SMARTCTL_TEXT
+    assert transport.calls == ["json", "text", "text"]
+
+
+def test_json_backend_reports_broken_json():
+    transport = ScriptedTransport(json_replies=[(0, "not json", "")])
+    assert diskmapper.get_smart_data("sda", "json", transport) == "Error: smartctl did not print valid JSON"
+
+
+def test_text_informational_exit_bits():
+    # Bit 6: the device error log has entries; the report is still complete
+    transport = ScriptedTransport(text_replies=[(64, SMARTCTL_TEXT, "")])
+    assert diskmapper.get_smart_data("sda", "text", transport) == SMARTCTL_TEXT
+
+
+def test_open_failure_is_transient():
+    transport = ScriptedTransport(text_replies=[(2, "Smartctl open device: /dev/sda failed: No such device\n", "")])
+    result = diskmapper.get_smart_result("sda", backend="text", transport=transport)
+    assert result["output"] == "Error: Smartctl open device: /dev/sda failed: No such device"
+    assert result["transient"]
+
+
+def test_refused_command_line_is_not_transient():
+    transport = ScriptedTransport(text_replies=[(1, "=======> INVALID ARGUMENT TO -d: foo\n", "")])
+    result = diskmapper.get_smart_result("sda", backend="text", transport=transport)
+    assert result["output"] == "Error: =======> INVALID ARGUMENT TO -d: foo"
+    assert not result.get("transient")
+
+
+def test_json_open_failure_is_transient():
+    document = {"smartctl": {"exit_status": 2, "messages": [{"string": "Smartctl open device: /dev/sda failed"}]}}
+    transport = ScriptedTransport(json_replies=[(2, json.dumps(document), "")])
+    result = diskmapper.get_smart_result("sda", backend="json", transport=transport)
+    assert result["output"] == "Error: Smartctl open device: /dev/sda failed"
+    assert result["transient"]
+
+
+class MissingSudo(diskmapper.LocalTransport):
+    def run(self, argv, timeout=None):
+        raise FileNotFoundError(2, "No such file or directory", "sudo")
+
+
+def test_missing_sudo_is_not_retried():
+    collector = diskmapper.SmartCollector(transport=MissingSudo(), retries=3, backoff=60)
+    started = time.monotonic()
+    result = collector.collect([("sda", {})])["sda"]
+    assert time.monotonic() - started < 5
+    assert result["output"].startswith("Error: ") and not result.get("transient")
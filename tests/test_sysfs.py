@@ -0,0 +1,78 @@
+import os
+
+import diskmapper
+from conftest import FIXTURES
+
+SYSFS_ROOT = os.path.join(FIXTURES, "sysfs")
+
+
+def disk_child(guid, device, disk=None):
+    child = {"type": "DISK", "name": f"uuid-{device}", "guid": guid, "device": device, "children": [],
+             "stats": {"read_errors": 0, "write_errors": 0, "checksum_errors": 0}}
+    if disk:
+        child["disk"] = disk
+    return child
+
+
+def pool_data():
+    return [{"name": "tank", "topology": {"data": [{"type": "RAIDZ1", "name": "raidz1-0", "guid": "900", "children": [
+        disk_child("1000", "sda1", "sda"),
+        # Older topologies only name the partition
+        disk_child("1001", "sdb1"),
+        disk_child("1002", "sdc1", "sdc"),
+        disk_child("1003", "sdd1", "sdd"),
+    ]}]}}]
+
+
+def client():
+    return diskmapper.StaticMiddlewareClient({"disk.query": [
+        {"name": "sdc", "devname": "sdc", "serial": "OTHER", "model": "MZ7LH960", "size": 960197124096,
+         "zfs_guid": "1002"},
+        {"name": "sdd", "devname": "sdd", "serial": "SERSDD", "model": "ST8000NM0055", "size": 8001563222016,
+         "zfs_guid": "1003"},
+    ]})
+
+
+def test_read_sysfs_disks():
+    disks = {disk["devname"]: disk for disk in diskmapper.read_sysfs_disks(SYSFS_ROOT)}
+    # The CD drive and the virtual loop device are not disks
+    assert sorted(disks) == ["sda", "sdb", "sdc"]
+    assert disks["sda"]["serial"] == "SERSDA"
+    assert disks["sda"]["lunid"] == "5000cca000000001"
+    assert disks["sda"]["size"] == 15628053168 * 512
+    assert disks["sda"]["type"] == "HDD"
+    assert disks["sda"]["partitions"] == ["sda1", "sda2"]
+    assert disks["sda"]["enclosure"] == {"id": "0:0:5:0", "slot": 3}
+    # No serial attribute, only the VPD page
+    assert disks["sdb"]["serial"] == "SERSDB"
+    assert disks["sdc"]["type"] == "SSD"
+    assert disks["sdc"]["model"] is None
+
+
+def test_disk_index_from_sysfs():
+    pools = pool_data()
+    disk_data = diskmapper.query_disks(client(), pools, sysfs_root=SYSFS_ROOT)
+    guid_to_disk, devname_to_disk = diskmapper.build_disk_index(disk_data)
+    
+    # Every pool member resolves by its ZFS GUID, sysfs or not
+    assert {guid: disk["devname"] for guid, disk in guid_to_disk.items()} == {
+        "1000": "sda", "1001": "sdb", "1002": "sdc", "1003": "sdd"}
+    # The partition-only entry got its disk filled in
+    assert pools[0]["topology"]["data"][0]["children"][1]["disk"] == "sdb"
+    assert devname_to_disk["sda2"]["devname"] == "sda"
+    # Middleware only fills in what sysfs lacks
+    assert guid_to_disk["1002"]["model"] == "MZ7LH960"
+    assert guid_to_disk["1002"]["serial"] == "SERSDC"
+    assert guid_to_disk["1003"]["serial"] == "SERSDD"
+
+
+def test_sysfs_inventory_skips_middleware_when_complete():
+    pools = pool_data()
+    del pools[0]["topology"]["data"][0]["children"][2:]
+    
+    class NoMiddleware(diskmapper.StaticMiddlewareClient):
+        def call(self, method, *params):
+            raise AssertionError(f"unexpected middleware call {method}")
+    
+    disks = diskmapper.sysfs_disk_inventory(NoMiddleware({}), pools, SYSFS_ROOT)
+    assert {disk["devname"]: disk["zfs_guid"] for disk in disks} == {"sda": "1000", "sdb": "1001", "sdc": None}
@@ -0,0 +1,50 @@
+import pytest
+
+import diskmapper
+
+DAY = 86400
+
+
+def test_flat_counter():
+    trend = diskmapper.analyze_trend([(0, 3), (DAY, 3), (2 * DAY, 3)])
+    assert trend["flat"] and not trend["accelerating"] and not trend["onset"]
+
+
+def test_accelerating_counter():
+    trend = diskmapper.analyze_trend([(0, 0), (DAY, 1), (2 * DAY, 5)])
+    assert trend["accelerating"] and not trend["onset"]
+    assert (trend["earlier_per_day"], trend["recent_per_day"]) == (1.0, 4.0)
+
+
+def test_onset_is_not_acceleration():
+    trend = diskmapper.analyze_trend([(0, 0), (DAY, 0), (2 * DAY, 1)])
+    assert trend["onset"] and not trend["accelerating"]
+
+
+def test_onset_rule():
+    disk_entry = {"disk": "sda", "model": "ST8000NM0055", "serial": "SERSDA",
+                  "errors": {"read": 0, "write": 0, "checksum": 0}}
+    smart_data = {"drive_type": "SATA", "offline_uncorrectable": 1, "attributes": []}
+    trends = {"offline_uncorrectable": diskmapper.analyze_trend([(0, 0), (DAY, 0), (2 * DAY, 1)])}
+    warnings = diskmapper.evaluate_warnings(disk_entry, smart_data, trends)
+    assert "Offline Uncorrectable started growing: +1/day, was flat" in warnings["critical"]
+    assert not any("accelerating" in reason for reason in warnings["critical"])
+
+
+def test_unreadable_history(tmp_path):
+    path = tmp_path / "history.sqlite"
+    path.write_text("not a database")
+    history = diskmapper.SmartHistory(str(path))
+    with pytest.raises(diskmapper.HistoryError, match=str(path)):
+        history.prune()
+    errors = []
+    assert diskmapper.update_history(history, [], {}, on_error=errors.append) is None
+    assert errors[0].startswith("Error updating SMART history: ")
+
+
+def test_trend_columns_only_for_history_counters():
+    disk_entry = {"errors": {"read": 0, "write": 0, "checksum": 0}, "model": "M", "serial": "S"}
+    trends = {"media_errors": diskmapper.analyze_trend([(0, 0), (DAY, 0), (2 * DAY, 2)])}
+    table = diskmapper.MetricTable([(disk_entry, {"drive_type": "NVMe", "spare_delta": 5}, trends)],
+                                   ["spare_delta", "media_errors_recent_delta", "media_errors_onset"])
+    assert table.columns == {"spare_delta": [5], "media_errors_recent_delta": [2], "media_errors_onset": [True]}